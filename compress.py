@@ -0,0 +1,46 @@
+import numpy as np
+import argparse
+
+import torch
+from PIL import Image
+
+from encoder import container, mera
+
+
+parser = argparse.ArgumentParser(description="")
+
+parser.add_argument("-folder", default=None, help="Path to load the trained model")
+parser.add_argument("-cuda", type=int, default=-1, help="Which device to use with -1 standing for CPU, number bigger than -1 is N.O. of GPU.")
+parser.add_argument("-nbins", type=int, default=4096, help="bin number of ran alg.")
+parser.add_argument("-precision", type=int, default=24, help="precision of CDF")
+parser.add_argument("-window", type=float, default=0, help="code CDF tables over this many scales around the mean with an escape symbol, 0 for full nbins tables")
+parser.add_argument("-cdfChunk", type=int, default=4096, help="num of symbols per CDF chunk streamed into the coder")
+parser.add_argument("-tableLog", type=int, default=12, help="log2 of tANS tables to code levels with static priors with, 0 to code every level with rANS")
+parser.add_argument("-tile", type=int, default=0, help="code tiles of this many sub-band pixels apart for decoding crops, 0 for no tiles")
+parser.add_argument("-best", action='store_false', help="if load the best model")
+parser.add_argument("-valbest", action='store_true', help="if load the best val. model")
+parser.add_argument("-img", default=None, help="Path of the image to compress")
+parser.add_argument("-out", default=None, help="Path of the compressed file, default to the image path with .nwf")
+
+args = parser.parse_args()
+
+device = torch.device("cpu" if args.cuda < 0 else "cuda:" + str(args.cuda))
+
+if args.folder is None:
+    raise Exception("No loading")
+if args.img is None:
+    raise Exception("No image")
+if args.out is None:
+    args.out = args.img.rsplit('.', 1)[0] + '.nwf'
+
+img = np.array(Image.open(args.img).convert('RGB'))
+if img.shape[0] != img.shape[1]:
+    raise Exception("Only square images are supported")
+x = torch.from_numpy(img).permute([2, 0, 1]).unsqueeze(0).float().to(device)
+
+f, name, config = mera.loadFlow(args.folder, x.shape[-1], device, args.best, args.valbest)
+
+c = mera.compress(f, x, container.fingerprint(name), config.get('HUE', True), args.nbins, args.precision, args.window if args.window > 0 else None, args.cdfChunk, args.tableLog, args.tile)[0]
+container.save(args.out, c)
+
+print("Compressed", args.img, "to", args.out, ":", len(c), "bytes,", 8 * len(c) / np.prod(x.shape), "bits per dimension")
@@ -0,0 +1,131 @@
+import os
+import time
+import argparse
+import collections
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import torch
+
+from encoder import container, mera, manifest, cache
+
+
+parser = argparse.ArgumentParser(description="")
+
+parser.add_argument("-folder", default=None, help="Path to load the trained model")
+parser.add_argument("-cuda", type=int, default=-1, help="Which device to use with -1 standing for CPU, number bigger than -1 is N.O. of GPU.")
+parser.add_argument("-nbins", type=int, default=4096, help="bin number of ran alg.")
+parser.add_argument("-precision", type=int, default=24, help="precision of CDF")
+parser.add_argument("-window", type=float, default=0, help="code CDF tables over this many scales around the mean with an escape symbol, 0 for full nbins tables")
+parser.add_argument("-cdfChunk", type=int, default=4096, help="num of symbols per CDF chunk streamed into the coder")
+parser.add_argument("-tableLog", type=int, default=12, help="log2 of tANS tables to code levels with static priors with, 0 to code every level with rANS")
+parser.add_argument("-tile", type=int, default=0, help="code tiles of this many sub-band pixels apart for decoding crops, 0 for no tiles")
+parser.add_argument("-best", action='store_false', help="if load the best model")
+parser.add_argument("-valbest", action='store_true', help="if load the best val. model")
+parser.add_argument("-dir", default=None, help="Directory of the images to compress, walked recursively")
+parser.add_argument("-out", default=None, help="Directory of the compressed files, laid out as -dir, default to -dir with _nwf")
+parser.add_argument("-manifest", default=None, help="Path of the manifest of the job, default to manifest.jsonl in -out")
+parser.add_argument("-procs", type=int, default=4, help="num of processes decoding images")
+parser.add_argument("-batch", type=int, default=16, help="num of images of a size run through the flow together")
+parser.add_argument("-cache", default=None, help="Folder of a cache of compressed images by content, repeated images are linked to the first file instead of compressed again")
+parser.add_argument("-cacheSize", type=int, default=1024, help="MB the cache keeps, least recently used images evicted first")
+
+args = parser.parse_args()
+
+device = torch.device("cpu" if args.cuda < 0 else "cuda:" + str(args.cuda))
+
+if args.folder is None:
+    raise Exception("No loading")
+if args.dir is None:
+    raise Exception("No directory")
+if args.out is None:
+    args.out = args.dir.rstrip(os.sep) + '_nwf'
+if args.manifest is None:
+    args.manifest = os.path.join(args.out, 'manifest.jsonl')
+
+# the model is built for one image size, rebuilt once per size met
+flows = {}
+fingerprint = None
+HUE = True
+
+
+def compressBucket(length, bucket):
+    global fingerprint, HUE
+    if length not in flows:
+        flows[length], name, config = mera.loadFlow(args.folder, length, device, args.best, args.valbest)
+        fingerprint = container.fingerprint(name)
+        HUE = config.get('HUE', True)
+    x = torch.from_numpy(np.stack([img for _, img in bucket])).permute([0, 3, 1, 2]).float().to(device)
+    if contents is None:
+        cs = mera.compress(flows[length], x, fingerprint, HUE, args.nbins, args.precision, args.window if args.window > 0 else None, args.cdfChunk, args.tableLog, args.tile)
+        keys = [None] * len(cs)
+    else:
+        cs, keys = cache.compress(contents, flows[length], x, fingerprint, HUE, args.nbins, args.precision, args.window if args.window > 0 else None, args.cdfChunk, args.tableLog, args.tile)
+    for (path, _), c, key in zip(bucket, cs, keys):
+        out = manifest.outPath(path)
+        record = {'path': path, 'out': out, 'size': os.path.getsize(os.path.join(args.dir, path)), 'bytes': len(c), 'dims': int(np.prod(c.shape))}
+        ref = stored.get(key)
+        if ref is not None and job.done(ref, args.out):
+            manifest.linkFile(os.path.join(args.out, job.records[ref]['out']), os.path.join(args.out, out))
+            record['ref'] = ref
+        else:
+            manifest.writeFile(os.path.join(args.out, out), c.toBytes())
+        if key is not None:
+            record['key'] = key
+            if 'ref' not in record:
+                stored[key] = path
+        job.add(record)
+        done.append(path)
+
+
+def images(paths):
+    # images are decoded in the processes while the flow runs, at most a few batches ahead
+    ahead = 2 * args.procs * args.batch
+    with ProcessPoolExecutor(args.procs) as pool:
+        futures = collections.deque()
+        for path in paths:
+            futures.append((path, pool.submit(manifest.readImage, os.path.join(args.dir, path))))
+            if len(futures) >= ahead:
+                path, future = futures.popleft()
+                yield path, future.result()
+        while futures:
+            path, future = futures.popleft()
+            yield path, future.result()
+
+
+contents = None if args.cache is None else cache.ContainerCache(args.cache, args.cacheSize << 20)
+
+with manifest.Manifest(args.manifest) as job:
+    # the first image of every content compressed so far, repeats are linked to its file
+    stored = {}
+    for record in job.records.values():
+        if 'key' in record and 'ref' not in record:
+            stored.setdefault(record['key'], record['path'])
+    paths = manifest.walk(args.dir)
+    todo = [path for path in paths if not job.done(path, args.out)]
+    print("Compressing", len(todo), "of", len(paths), "images of", args.dir, "to", args.out, ",", len(paths) - len(todo), "already done")
+
+    done = []
+    skipped = 0
+    buckets = collections.OrderedDict()
+    start = time.time()
+    for path, (img, reason) in images(todo):
+        if img is None:
+            skipped += 1
+            print("Skipped", path, ":", reason)
+            continue
+        bucket = buckets.setdefault(img.shape[0], [])
+        bucket.append((path, img))
+        if len(bucket) >= args.batch:
+            compressBucket(img.shape[0], buckets.pop(img.shape[0]))
+    for length, bucket in buckets.items():
+        compressBucket(length, bucket)
+    duration = time.time() - start
+
+    run = job.summary(done)
+    total = job.summary([path for path in paths if path in job.records])
+    print("Compressed", run['count'], "images, skipped", skipped, "in", duration, "s:", run['count'] / max(duration, 1e-9), "images/s,", run['size'] / 1e6 / max(duration, 1e-9), "MB/s")
+    print("This run: actual BPD:", run['bpd'], ", saving:", run['saving'], "of", run['size'], "bytes,", run['refs'], "repeats linked")
+    print("Whole directory:", total['count'], "images, actual BPD:", total['bpd'], ", saving:", total['saving'], "of", total['size'], "bytes,", total['refs'], "repeats linked")
+    if contents is not None:
+        print("Cache:", contents.hits, "hits,", contents.misses, "misses,", contents.refs, "repeats in a batch,", len(contents), "images,", contents.size, "bytes")
@@ -0,0 +1,65 @@
+import numpy as np
+import argparse
+
+import torch
+from PIL import Image
+
+from encoder import container, mera, scheduler
+
+
+parser = argparse.ArgumentParser(description="")
+
+parser.add_argument("-folder", default=None, help="Path to load the trained model")
+parser.add_argument("-liftingFolder", default=None, help="Path to load the lifting model (main.py -lifting) files of the fast tier were compressed with, default to -folder")
+parser.add_argument("-cuda", type=int, default=-1, help="Which device to use with -1 standing for CPU, number bigger than -1 is N.O. of GPU.")
+parser.add_argument("-cdfChunk", type=int, default=256, help="num of symbols, over the batch, per CDF chunk streamed into the coder")
+parser.add_argument("-best", action='store_false', help="if load the best model")
+parser.add_argument("-valbest", action='store_true', help="if load the best val. model")
+parser.add_argument("-tableBits", type=int, default=8, help="log2 of buckets in decoding lookup tables, 0 to search the CDFs")
+parser.add_argument("-levels", type=int, default=-1, help="only read and decode this many coarsest levels, finer details are filled with the prior's mean, -1 for all")
+parser.add_argument("-crop", type=int, nargs=4, default=None, metavar=('TOP', 'BOTTOM', 'LEFT', 'RIGHT'), help="only decode this crop of tiled files")
+parser.add_argument("-workers", type=int, default=0, help="num of threads undoing the couplings of tiled files while their tiles are popped, reporting the critical path, 0 to decode tile after tile")
+parser.add_argument("-batch", type=int, default=64, help="num of files decoded in lockstep")
+parser.add_argument("-file", default=None, nargs='+', help="Paths of the compressed files")
+parser.add_argument("-out", default=None, help="Path of the decoded image when decoding a single file, default to the file path with .png")
+
+args = parser.parse_args()
+
+device = torch.device("cpu" if args.cuda < 0 else "cuda:" + str(args.cuda))
+
+if args.folder is None:
+    raise Exception("No loading")
+if args.file is None:
+    raise Exception("No file")
+if args.out is not None and len(args.file) > 1:
+    raise Exception("-out is only supported when decoding a single file")
+
+levels = None if args.levels < 0 else args.levels
+containers = [container.load(path, levels) for path in args.file]
+
+# the model is built for one image size, files of the fast tier need the lifting one
+lengths = {}
+for path, c in zip(args.file, containers):
+    lengths.setdefault((c.shape[-1], c.lifting), []).append(path)
+
+for (length, lifting), paths in lengths.items():
+    folder = args.liftingFolder if lifting and args.liftingFolder is not None else args.folder
+    f, name, config = mera.loadFlow(folder, length, device, args.best, args.valbest)
+    cs = [containers[args.file.index(path)] for path in paths]
+    if args.workers > 0 and all(c.tile for c in cs):
+        xs = []
+        with scheduler.DecodeScheduler(f, args.workers) as s:
+            for path, c in zip(paths, cs):
+                xs.append(s.decode(c, args.crop, container.fingerprint(name), args.tableBits, args.cdfChunk))
+                print(path, "Wall Time:", s.wall, "Critical Path:", s.critical, "Time per Task:", s.times)
+    elif args.crop is not None:
+        xs = [mera.decompressRegion(f, c, args.crop, container.fingerprint(name), args.tableBits, args.cdfChunk) for c in cs]
+    elif levels is None:
+        xs = mera.decompressBatch(f, cs, container.fingerprint(name), args.tableBits, args.cdfChunk, args.batch)
+    else:
+        xs = [mera.preview(f, c, levels, container.fingerprint(name), args.tableBits, args.cdfChunk) for c in cs]
+    for path, x in zip(paths, xs):
+        out = args.out if args.out is not None else path.rsplit('.', 1)[0] + '.png'
+        img = torch.clamp(torch.round(x[0]), 0, 255).permute([1, 2, 0]).cpu().numpy().astype(np.uint8)
+        Image.fromarray(img).save(out)
+        print("Decompressed", path, "to", out)
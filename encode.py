@@ -1,14 +1,13 @@
 import numpy as np
 import argparse, json, math
-import os, glob
+import os, glob, time
 
 import flow, utils, source
 
 import torch, torchvision
 from torch import nn
 
-from encoder import rans, coder
-from utils import cdfDiscreteLogitstic, cdfMixDiscreteLogistic
+from encoder import rans, coder, executor, mera, tans, container, archive, pipeline, accounting, pyramid
 
 
 parser = argparse.ArgumentParser(description="")
@@ -18,6 +17,19 @@ parser.add_argument("-cuda", type=int, default=-1, help="Which device to use wit
 parser.add_argument("-nbins", type=int, default=4096, help="bin number of ran alg.")
 parser.add_argument("-batch", type=int, default=-1, help="batch size")
 parser.add_argument("-precision", type=int, default=24, help="precision of CDF")
+parser.add_argument("-nstates", type=int, default=1, help="num of interleaved rANS states per image")
+parser.add_argument("-workers", type=int, default=0, help="num of processes doing entropy coding, 0 to code in the main process")
+parser.add_argument("-chunk", type=int, default=1, help="num of images per entropy coding task when using workers")
+parser.add_argument("-tableBits", type=int, default=8, help="log2 of buckets in decoding lookup tables, 0 to search the CDFs")
+parser.add_argument("-window", type=float, default=0, help="code CDF tables over this many scales around the mean with an escape symbol, 0 for full nbins tables")
+parser.add_argument("-cdfChunk", type=int, default=0, help="num of symbols per CDF chunk when streaming CDFs into the coder, 0 to build the CDFs of a batch at once")
+parser.add_argument("-tableLog", type=int, default=0, help="log2 of tANS tables to code levels with static priors with, 0 to code every level with rANS")
+parser.add_argument("-bits", action='store_true', help="report the bits of every level, of its channels and of its bands under the coded CDFs")
+parser.add_argument("-pipeline", type=int, default=0, help="run loading, the flow, encoding, decoding and checking of batches each in a thread of its own with queues of this many batches between them, 0 to run them one after the other")
+parser.add_argument("-standalone", action='store_true', help="code every image to a container and decode the batch in lockstep, level by level from the bitstreams alone, reporting latencies")
+parser.add_argument("-shared", action='store_true', help="with -standalone, code every batch into a single container instead of one per image")
+parser.add_argument("-archive", default=None, help="with -standalone, also store the containers in this archive, ids being their indices")
+parser.add_argument("-pyramid", default=None, help="Pyramid store of the test set (see pyramid.py) to read z from instead of running the flow")
 parser.add_argument("-earlyStop", type=int, default=-1, help="epoches to run")
 parser.add_argument("-best", action='store_false', help="if load the best model")
 parser.add_argument("-valbest", action='store_true', help="if load the best val. model")
@@ -26,6 +38,24 @@ parser.add_argument('-target', type=str, default='original', choices=['original'
 
 args = parser.parse_args()
 
+# windowed tables differ in size between levels and are always streamed, as are tANS coded levels
+stream = args.cdfChunk > 0 or args.window > 0 or args.tableLog > 0
+
+if (args.archive is not None or args.shared) and not args.standalone:
+    raise Exception("-archive and -shared need -standalone")
+
+if args.pyramid is not None and args.standalone:
+    raise Exception("-pyramid is not supported with -standalone")
+
+if args.standalone and args.pipeline > 0:
+    raise Exception("-pipeline is not supported with -standalone")
+
+if args.standalone and (args.workers > 0 or args.nstates > 1 or args.cdfChunk > 0):
+    raise Exception("-standalone codes every image on its own with the single state coder in the main process")
+
+if stream and (args.workers > 0 or args.nstates > 1):
+    raise Exception("-window, -cdfChunk and -tableLog are only supported by the single state coder in the main process")
+
 device = torch.device("cpu" if args.cuda < 0 else "cuda:" + str(args.cuda))
 
 if args.folder is None:
@@ -179,160 +209,128 @@ if args.target != 'original':
     else:
         f.prior.priorList = prior.priorList
 
-tmpLine = targetSize[-1] ** 2 // 4
-shapeList = []
-while tmpLine != 1:
-    shapeList.append([3, tmpLine, 3])
-    tmpLine = tmpLine // 4
-
-shapeList.append([3, 1, 4])
-
-
-def im2grp(t):
-    return t.reshape(t.shape[0], t.shape[1], t.shape[2] // 2, 2, t.shape[3] // 2, 2).permute([0, 1, 2, 4, 3, 5]).reshape(t.shape[0], t.shape[1], -1, 4)
-
-
-def grp2im(t):
-    return t.reshape(t.shape[0], t.shape[1], int(t.shape[2] ** 0.5), int(t.shape[2] ** 0.5), 2, 2).permute([0, 1, 2, 4, 3, 5]).reshape(t.shape[0], t.shape[1], int(t.shape[2] ** 0.5) * 2, int(t.shape[2] ** 0.5) * 2)
-
-
-def divide(z):
-    parts = []
-    ul = z
-    for no in range(int(math.log(blockLength, 2))):
-        if no == int(math.log(blockLength, 2)) - 1:
-            z_ = ul.reshape(*ul.shape[:2], 1, 4) - torch.round(decimal.forward_(f.prior.lastPrior.mean.permute([1, 2, 3, 0])) * torch.softmax(f.prior.lastPrior.mixing, dim=-1)).sum(-1).reshape(1, *f.prior.lastPrior.mean.shape[1:]) + args.nbins // 2
-
-        else:
-            _x = im2grp(ul)
-            z_ = _x[:, :, :, 1:].contiguous() - torch.round(decimal.forward_(f.meanList[no])) + args.nbins // 2
-            ul = _x[:, :, :, 0].reshape(*_x.shape[:2], int(_x.shape[2] ** 0.5), int(_x.shape[2] ** 0.5)).contiguous()
-        parts.append(z_.reshape(z_.shape[0], -1).int().detach())
-    return torch.cat(parts, -1).numpy()
-
-
-def join(rcnZ):
-    zparts = []
-    for no in range(int(math.log(blockLength, 2))):
-        rcnZpart = rcnZ[:, :np.prod(shapeList[no])].reshape(rcnZ.shape[0], *shapeList[no])
-        rcnZ = rcnZ[:, np.prod(shapeList[no]):]
-
-        if no == int(math.log(blockLength, 2)) - 1:
-            rcnZpart = rcnZpart + torch.round(decimal.forward_(f.prior.lastPrior.mean.permute([1, 2, 3, 0])) * torch.softmax(f.prior.lastPrior.mixing, dim=-1)).sum(-1).reshape(1, *f.prior.lastPrior.mean.shape[1:]) - args.nbins // 2
-        else:
-            rcnZpart = rcnZpart + torch.round(decimal.forward_(f.meanList[no])) - args.nbins // 2
-        zparts.append(rcnZpart)
-
-    retZ = grp2im(zparts[-1]).contiguous()
-    for term in reversed(zparts[:-1]):
-        tmp = term.reshape(*retZ.shape, 3)
-        retZ = retZ.reshape(*retZ.shape, 1)
-        tmp = torch.cat([retZ, tmp], -1).reshape(*retZ.shape[:2], -1, 4)
-        retZ = grp2im(tmp).contiguous()
-    return retZ
-
-
-def cdf2int(cdf):
-    return (cdf * ((1 << args.precision) - args.nbins)).int().detach() + torch.arange(args.nbins).reshape(-1, 1, 1, 1, 1)
-
-
-def calCDF(batch):
-    CDF = []
-    _bins = torch.arange(-args.nbins // 2, args.nbins // 2).reshape(-1, 1, 1, 1, 1)
-    for no, mean in enumerate(f.meanList):
-        bins = _bins - 1 + torch.round(decimal.forward_(mean))
-        cdf = cdfDiscreteLogitstic(bins, mean, f.scaleList[no], decimal=f.decimal)
-        CDF.append(cdf2int(cdf).reshape(args.nbins, batch, -1))
-
-    bins = _bins - 1 + torch.round(decimal.forward_(f.prior.lastPrior.mean.permute([1, 2, 3, 0])) * torch.softmax(f.prior.lastPrior.mixing, dim=-1)).sum(-1).reshape(1, *f.prior.lastPrior.mean.shape[1:])
-    cdf = cdfMixDiscreteLogistic(bins, f.prior.lastPrior.mean, f.prior.lastPrior.logscale, f.prior.lastPrior.mixing, decimal=f.decimal).repeat(1, batch, 1, 1, 1)
-    CDF.append(cdf2int(cdf).reshape(args.nbins, batch, -1))
-    CDF = torch.cat(CDF, -1).numpy()
-    return CDF
-
-
-def calPDF(state, CDF):
-    sumprob = 0
-    for i in range(state.shape[0]):
-        logprob = np.log((CDF[:, i][state[i] + 1] - CDF[:, i][state[i]]) / (1 << args.precision))
-        sumprob += logprob
-    return -sumprob
-
-
-def calsinglePDF(state, CDF):
-    probs = []
-    for no in range(state.shape[0]):
-        prob_ = np.log((CDF[state[no] + 1, no] - CDF[state[no], no]) / (1 << args.precision))
-        probs.append(prob_)
-    return np.array(probs)
-
 
 def testBPD(loader, earlyStop=-1):
     actualBPD = []
     theoryBPD = []
     ERR = []
+    cost = []
 
     if not HUE:
         yccERR = []
 
-    count = 0
-    with torch.no_grad():
-        for RGBsamples, _ in loader:
-            if HUE:
-                samples = RGBsamples
-            else:
-                samples = utils.rgb2ycc(RGBsamples, True, True)
+    # with -pipeline every stage runs in a thread of its own, batch n + 1 going through the flow while batch n is entropy coded;
+    # only the first stage runs f.inverse, the others take the prior parameters it leaves in f.meanList from the batch
+    @torch.no_grad()
+    def model(item):
+        lo, RGBsamples = item
+        if HUE:
+            samples = RGBsamples
+        else:
+            samples = utils.rgb2ycc(RGBsamples, True, True)
+        batch = {'RGBsamples': RGBsamples, 'samples': samples}
 
-            count += 1
-            z, _ = f.inverse(samples)
-
-            zparts = divide(z)
-
-            CDF = calCDF(samples.shape[0])
-
-            state = []
-
-            for i in range(samples.shape[0]):
-                symbols = zparts[i]
-                s = rans.x_init
-                for j in reversed(range(symbols.shape[-1])):
-                    cdf = CDF[:, i, j]
-                    s = coder.encoder(cdf, symbols[j], s, precision=args.precision)
-                state.append(rans.flatten(s))
-
-            '''
-            def compare(idx):
-                print(calPDF(zparts[idx], CDF[:, idx, :]) / (np.prod(samples.shape[1:]) * np.log(2.)))
-                print(-f.logProbability(samples[idx:idx + 1]) / (np.prod(samples.shape[1:]) * np.log(2.)))
-                print(32 / (np.prod(samples.shape[1:])) * (state[idx]).shape[0])
-
-            compare(0)
-            import pdb
-            pdb.set_trace()
-            '''
-            actualBPD.append(32 / (np.prod(samples.shape[1:])) * np.mean([s.shape[0] for s in state]))
-            theoryBPD.append((-f.logProbability(samples).mean() / (np.prod(samples.shape[1:]) * np.log(2.))).detach().item())
-
-            rcnParts = []
-            for i in range(samples.shape[0]):
-                s = rans.unflatten(state[i])
-                symbols = []
+        if args.pyramid is None:
+            z, logp = f.inverse(samples)
+        else:
+            # the store holds the images of the loader in order
+            z, logp = store.inverse(f, slice(lo, lo + samples.shape[0]))
+            if z.shape[0] != samples.shape[0]:
+                raise Exception("Pyramid store holds fewer images than the test set")
+        zparts = mera.divide(f, z, args.nbins)
+        batch['levels'] = np.cumsum([term.shape[-1] for term in zparts])[:-1]
+        batch['params'] = mera.levelParams(f, samples.shape[0], blockLength)
+
+        if stream:
+            batch['windows'] = mera.calWindows(f, samples.shape[0], args.nbins, blockLength, args.window if args.window > 0 else None)
+            batch['zparts'] = zparts
+        else:
+            batch['zparts'] = np.concatenate(zparts, -1)
+            batch['CDF'] = np.concatenate(mera.calCDF(f, samples.shape[0], args.nbins, args.precision, blockLength), -1)
+
+        batch['theoryBPD'] = (-accounting.logProbability(f, z, logp).mean() / (np.prod(samples.shape[1:]) * np.log(2.))).detach().item()
+        return batch
+
+    @torch.no_grad()
+    def encode(batch):
+        samples = batch['samples']
+        zparts = batch['zparts']
+        if stream:
+            s, writer, _ = mera.encodeLevels(f, zparts, blockLength, args.nbins, args.precision, range(len(zparts)), batch['windows'], chunk, args.tableLog, params=batch['params'])
+            state = s.flatten()
+            batch['bits'] = writer.flatten()
+        else:
+            CDF = batch['CDF']
+            if args.workers > 0:
+                state, batch['rcnParts'] = codingExecutor.run(CDF, zparts)
+            elif args.nstates > 1:
+                state = coder.interleavedEncoder(CDF, zparts, args.nstates, precision=args.precision)
+            else:
+                s = rans.BatchStack(samples.shape[0])
+                for j in reversed(range(zparts.shape[-1])):
+                    s = coder.batchEncoder(CDF[:, :, j], zparts[:, j], s, precision=args.precision)
+                state = s.flatten()
+        batch['state'] = state
+
+        if args.bits:
+            if stream:
+                bits = accounting.levelBits(f, zparts, blockLength, args.nbins, args.precision, batch['windows'], chunk, batch['params'])
+            else:
+                bits = accounting.levelBits(f, np.split(zparts, batch['levels'], -1), blockLength, args.nbins, args.precision, CDF=np.split(batch['CDF'], batch['levels'], -1))
+            batch['cost'] = accounting.summary(bits)
+
+        batch['actualBPD'] = 32 / (np.prod(samples.shape[1:])) * np.mean([s.shape[0] for s in state])
+        if stream:
+            batch['actualBPD'] += 8 / (np.prod(samples.shape[1:])) * np.mean([term.shape[0] for term in batch['bits']])
+        return batch
+
+    @torch.no_grad()
+    def decode(batch):
+        state = batch['state']
+        if stream:
+            _, rcnParts = mera.decodeLevels(f, rans.BatchStack.unflatten(state), tans.BitReader(batch['bits']), blockLength, args.nbins, args.precision, range(len(batch['zparts'])), batch['windows'], chunk, args.tableBits, args.tableLog, params=batch['params'])
+            batch['rcnParts'] = np.concatenate(rcnParts, -1)
+        elif args.workers <= 0:
+            CDF = batch['CDF']
+            table = coder.buildTable(CDF, args.precision, args.tableBits) if args.tableBits > 0 else None
+            if args.nstates > 1:
+                batch['rcnParts'] = coder.interleavedDecoder(CDF, state, precision=args.precision, table=table)
+            else:
+                s = rans.BatchStack.unflatten(state)
+                rcnParts = []
                 for j in range(np.prod(targetSize)):
-                    cdf = CDF[:, i, j]
-                    s, rcnSymbol = coder.decoder(cdf, s, precision=args.precision)
-                    symbols.append(rcnSymbol)
-                rcnParts.append(torch.tensor(symbols).reshape(1, -1))
-            rcnParts = torch.cat(rcnParts, 0)
-
-            rcnZ = join(rcnParts)
+                    s, rcnSymbol = coder.batchDecoder(CDF[:, :, j], s, precision=args.precision, table=None if table is None else table[:, :, j])
+                    rcnParts.append(rcnSymbol)
+                batch['rcnParts'] = np.stack(rcnParts, 1)
+        return batch
+
+    @torch.no_grad()
+    def check(batch):
+        rcnZ = mera.join(f, np.split(batch['rcnParts'], batch['levels'], -1), args.nbins, batch['params'])
+        rcnSamples, _ = f.forward(rcnZ.float())
+        samples = batch['samples']
+
+        if not HUE:
+            batch['yccERR'] = torch.abs(batch['RGBsamples'] - utils.ycc2rgb(rcnSamples, True, True).contiguous()).mean().item()
+            batch['ERR'] = torch.abs(samples.contiguous() - rcnSamples).sum().item()
+        else:
+            batch['ERR'] = torch.abs(samples - rcnSamples).sum().item()
+        return batch
 
-            rcnSamples, _ = f.forward(rcnZ.float())
+    chunk = args.cdfChunk if args.cdfChunk > 0 else np.prod(targetSize)
+    stages = pipeline.Pipeline([('model', model), ('encode', encode), ('decode', decode), ('check', check)], args.pipeline)
 
+    count = 0
+    with torch.no_grad():
+        for batch in stages.run((i * loader.batch_size, RGBsamples) for i, (RGBsamples, _) in enumerate(loader)):
+            count += 1
+            actualBPD.append(batch['actualBPD'])
+            theoryBPD.append(batch['theoryBPD'])
+            ERR.append(batch['ERR'])
+            if args.bits:
+                cost.append(batch['cost'])
             if not HUE:
-                yccERR.append(torch.abs(RGBsamples - utils.ycc2rgb(rcnSamples, True, True).contiguous()).mean().item())
-                ERR.append(torch.abs(samples.contiguous() - rcnSamples).sum().item())
-            else:
-                ERR.append(torch.abs(samples - rcnSamples).sum().item())
+                yccERR.append(batch['yccERR'])
 
             if count >= earlyStop and earlyStop > 0:
                 break
@@ -350,11 +348,87 @@ def testBPD(loader, earlyStop=-1):
     else:
         print("===========================SUMMARY==================================")
         print("Actual Mean BPD:", actualBPD.mean(), "Theory Mean BPD:", theoryBPD.mean(), "Mean Error:", ERR.mean(), "ycc Mean Error:", yccERR.mean())
+    print("Wall Time:", stages.wall, "Time per Stage:", stages.times)
+
+    if args.bits:
+        dims = np.prod(targetSize)
+        for no in range(len(cost[0]['level'])):
+            print("Level", no, "BPD:", np.mean([term['level'][no] for term in cost]) / dims, "Channels:", np.mean([term['channel'][no] for term in cost], 0) / dims, "Bands:", np.mean([term['band'][no] for term in cost], 0) / dims)
 
     return actualBPD, theoryBPD, ERR
 
 
-print("Train Set:")
-#testBPD(targetTrainLoader, earlyStop=args.earlyStop)
-print("Test Set:")
-testBPD(targetTestLoader, earlyStop=args.earlyStop)
+def testStandalone(loader, earlyStop=-1):
+    # the receiver only has the containers, the model runs in float64 on both sides to agree on the CDFs
+    g = f.double()
+    key = container.fingerprint(name)
+    k = args.window if args.window > 0 else None
+    actualBPD = []
+    theoryBPD = []
+    ERR = []
+    encodeTime = []
+    decodeTime = []
+    writer = archive.ArchiveWriter(args.archive) if args.archive is not None else None
+
+    count = 0
+    # an interrupted run still gets an archive with an index of the containers written
+    try:
+        with torch.no_grad():
+            for RGBsamples, _ in loader:
+                count += 1
+                RGBsamples = RGBsamples.double()
+                samples = RGBsamples if HUE else utils.rgb2ycc(RGBsamples, True, True)
+
+                start = time.time()
+                containers = mera.compress(g, RGBsamples, key, HUE, args.nbins, args.precision, k, tableLog=args.tableLog, shared=args.shared)
+                encodeTime.append((time.time() - start) / samples.shape[0])
+
+                if writer is not None:
+                    for term in containers:
+                        writer.add(len(writer.index), term)
+
+                start = time.time()
+                rcnSamples = torch.cat(mera.decompressBatch(g, containers, key, args.tableBits, batch=len(containers)), 0)
+                decodeTime.append((time.time() - start) / samples.shape[0])
+
+                actualBPD.append(8 / (np.prod(samples.shape)) * np.sum([len(term) for term in containers]))
+                theoryBPD.append((-g.logProbability(samples).mean() / (np.prod(samples.shape[1:]) * np.log(2.))).item())
+                ERR.append(torch.abs(RGBsamples.float() - rcnSamples).sum().item())
+
+                if count >= earlyStop and earlyStop > 0:
+                    break
+    finally:
+        if writer is not None:
+            writer.close()
+
+    actualBPD = np.array(actualBPD)
+    theoryBPD = np.array(theoryBPD)
+    ERR = np.array(ERR)
+
+    print("===========================SUMMARY==================================")
+    print("Actual Mean BPD:", actualBPD.mean(), "Theory Mean BPD:", theoryBPD.mean(), "Mean Error:", ERR.mean())
+    print("Mean Encoding Time per Image:", np.mean(encodeTime), "Mean Decoding Time per Image:", np.mean(decodeTime))
+
+    return actualBPD, theoryBPD, ERR
+
+if args.pyramid is not None:
+    store = pyramid.Pyramid(args.pyramid)
+    if store.fingerprint != container.fingerprint(name):
+        raise Exception("Pyramid store was built with a different model")
+    if store.length != blockLength or store.HUE != HUE:
+        raise Exception("Pyramid store doesn't hold images of the target")
+
+codingExecutor = executor.CodingExecutor(args.workers, args.precision, args.nstates, args.tableBits, args.chunk) if args.workers > 0 else None
+
+# the worker processes, and the shared memory they map, go away with the run even if a batch raises
+try:
+    print("Train Set:")
+    #testBPD(targetTrainLoader, earlyStop=args.earlyStop)
+    print("Test Set:")
+    if args.standalone:
+        testStandalone(targetTestLoader, earlyStop=args.earlyStop)
+    else:
+        testBPD(targetTestLoader, earlyStop=args.earlyStop)
+finally:
+    if codingExecutor is not None:
+        codingExecutor.shutdown()
@@ -0,0 +1,66 @@
+'''
+Bit accounting of coded images: the cost of every symbol under its integer
+CDF, summed per level, per channel and per band, and the theoretical cost
+under the model's prior from the output of a single inverse.
+'''
+import numpy as np
+
+from . import mera
+
+
+def symbolBits(CDF, symbols, precision, nbins=None):
+    """Bits every symbol of shape [batch, n] costs with CDF, of shape
+    [nbins, batch, n], or windowed ([2 * window + 3, batch, n]) given nbins,
+    as coder.batchEncoder and coder.escapeEncoder code them."""
+    CDF = np.asarray(CDF, dtype=np.int64)
+    s = np.asarray(symbols, dtype=np.int64)
+    if nbins is None:
+        return precision - np.log2(np.take_along_axis(CDF, s[None] + 1, 0)[0] - np.take_along_axis(CDF, s[None], 0)[0])
+    window = (CDF.shape[0] - 3) // 2
+    escape = 2 * window + 1
+    rawBits = mera.rawBits(nbins)
+    s = s - nbins // 2 + window
+    inside = (s >= 0) & (s < escape)
+    s = np.where(inside, s, escape)
+    freq = np.take_along_axis(CDF, s[None] + 1, 0)[0] - np.take_along_axis(CDF, s[None], 0)[0]
+    escapeFreq = CDF[escape + 1] - CDF[escape]
+    escaped = ~inside | ((freq << rawBits) < escapeFreq)
+    return precision - np.log2(np.where(escaped, escapeFreq, freq)) + escaped * rawBits
+
+
+def levelBits(f, parts, length, nbins, precision, windows=None, chunk=4096, params=None, CDF=None):
+    """Bits of the symbols of every level of parts, as given by divide, of
+    shape [batch, 3, n, 3] for detail levels (channel, position and the ur,
+    dl and dr bands) and [batch, 3, 1, 4] for the last one, finest first.
+    CDF, as given by calCDF, is used if already computed, otherwise the
+    tables are streamed with params as given by levelParams."""
+    batch = parts[0].shape[0]
+    escape = None if windows is None else nbins
+    bits = []
+    if CDF is not None:
+        for part, _CDF in zip(parts, CDF):
+            bits.append(symbolBits(_CDF, part, precision, escape))
+    else:
+        chunks = {}
+        for no, lo, _CDF in mera.streamCDF(f, batch, nbins, precision, length, windows, chunk, params=params):
+            chunks.setdefault(no, []).append(symbolBits(_CDF, parts[no][:, lo:lo + _CDF.shape[-1]], precision, escape))
+        bits = [np.concatenate(chunks[no], -1) for no in range(len(parts))]
+    return [term.reshape(batch, 3, -1, 3 if no < len(parts) - 1 else 4) for no, term in enumerate(bits)]
+
+
+def summary(bits):
+    """Mean bits per image of every level, of every level's channels and of
+    every level's bands, from levelBits."""
+    return {
+        'level': [term.sum((1, 2, 3)).mean() for term in bits],
+        'channel': [term.sum((2, 3)).mean(0) for term in bits],
+        'band': [term.sum((1, 2)).mean(0) for term in bits],
+    }
+
+
+def logProbability(f, z, logp):
+    """f.logProbability of the images f.inverse gave z and logp for, without
+    running the inverse again."""
+    if f.meanNNlist is not None and f.scaleNNlist is not None:
+        return f.prior.logProbability(z, None, f.meanList, f.scaleList) + logp
+    return f.prior.logProbability(z) + logp
@@ -0,0 +1,125 @@
+'''
+Archives of NWF compressed images, for datasets coded with one model.
+
+An archive is a little-endian header, the files (Container.toBytes) one after
+the other and an index of every file as a numpy structured array sorted by
+id. The header is:
+
+    magic       3s  b'NWA'
+    version     B
+    count       Q   number of files
+    index       Q   offset of the index
+
+Readers map the archive and find a file by binary search in the index,
+without reading any other file.
+'''
+import mmap
+import struct
+import numpy as np
+
+from .container import Container
+
+
+MAGIC = b'NWA'
+VERSION = 1
+
+_header = struct.Struct('<3sBQQ')
+
+INDEX = np.dtype([('id', '<u8'), ('offset', '<u8'), ('length', '<u4'), ('channel', '<u1'), ('height', '<u2'), ('width', '<u2')])
+
+
+class ArchiveWriter(object):
+    """Appends containers to a new archive, the index is written by close."""
+    def __init__(self, path):
+        self.file = open(path, 'wb')
+        self.file.write(_header.pack(MAGIC, VERSION, 0, 0))
+        self.offset = _header.size
+        self.index = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def add(self, id, container):
+        buf = container.toBytes()
+        self.file.write(buf)
+        self.index.append((id, self.offset, len(buf)) + tuple(container.shape))
+        self.offset += len(buf)
+
+    def close(self):
+        if self.file.closed:
+            return
+        index = np.sort(np.array(self.index, dtype=INDEX), order='id', kind='stable')
+        if (np.diff(index['id'].astype(np.int64)) == 0).any():
+            self.file.close()
+            raise Exception("Duplicated ids in NWA archive")
+        self.file.write(index.tobytes())
+        self.file.seek(0)
+        self.file.write(_header.pack(MAGIC, VERSION, index.shape[0], self.offset))
+        self.file.close()
+
+
+class Archive(object):
+    """Maps an archive for reading, archive[id] is the Container of id."""
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(self.mm) < _header.size:
+            raise Exception("Truncated NWA header")
+        magic, version, count, offset = _header.unpack_from(self.mm, 0)
+        if magic != MAGIC:
+            raise Exception("Not a NWA file")
+        if version != VERSION:
+            raise Exception("Unsupported NWA version " + str(version))
+        if len(self.mm) < offset + count * INDEX.itemsize:
+            raise Exception("Truncated NWA index")
+        self.index = np.frombuffer(self.mm[offset:offset + count * INDEX.itemsize], dtype=INDEX)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.mm.close()
+
+    def __len__(self):
+        return self.index.shape[0]
+
+    def __contains__(self, id):
+        return self._find(id) is not None
+
+    def __getitem__(self, id):
+        return self.read(id)
+
+    @property
+    def ids(self):
+        return self.index['id']
+
+    def _find(self, id):
+        i = int(np.searchsorted(self.index['id'], np.uint64(id)))
+        if i < len(self) and self.index['id'][i] == id:
+            return i
+        return None
+
+    def entry(self, id):
+        """Index entry of id: offset, length and shape of its file."""
+        i = self._find(id)
+        if i is None:
+            raise KeyError(id)
+        return self.index[i]
+
+    def read(self, id, levels=None):
+        """Container of id, or with levels only the bytes of its levels
+        coarsest levels (see Container.prefixSize)."""
+        entry = self.entry(id)
+        lo = int(entry['offset'])
+        hi = lo + int(entry['length'])
+        if levels is None:
+            return Container.fromBytes(self.mm[lo:hi])
+        with memoryview(self.mm) as view:
+            size = Container.prefixSize(view[lo:hi], levels)
+        return Container.fromBytes(self.mm[lo:lo + size], partial=True)
@@ -0,0 +1,167 @@
+'''
+Content addressed cache of compressed images, so that repeated images skip
+both the flow and the entropy coders.
+
+An image is keyed by the SHA-256 of its pixels, its shape, the fingerprint of
+the model and the coding parameters, and its Container is stored once as
+<folder>/<key[:2]>/<key>.nwf. The least recently used files are evicted to
+keep the folder under maxBytes, file modification times serve as the LRU
+clock, so the order survives restarts. Files are stamped with a strictly
+increasing clock, as files used in a row may get the same time otherwise.
+
+Tiles of tiled containers are sub-band tiles coded with priors depending on
+their neighbours, they can't be reused across images, only whole images are
+cached.
+'''
+import collections
+import hashlib
+import json
+import os
+import threading
+import time
+import numpy as np
+import torch
+
+from . import mera
+from .container import Container
+from .manifest import writeFile
+
+
+class ContainerCache(object):
+    """Containers by key on disk under folder, up to maxBytes of them.
+
+    hits and misses count get calls, refs the images compress found
+    repeated earlier in their batch, that don't call get.
+
+    get and put may run on several threads: lock guards the entries and the
+    counts, files are read and written out of it.
+    """
+    def __init__(self, folder, maxBytes=1 << 30):
+        os.makedirs(folder, exist_ok=True)
+        self.folder = folder
+        self.maxBytes = maxBytes
+        self.hits = 0
+        self.misses = 0
+        self.refs = 0
+        self.lock = threading.Lock()
+        self.writing = set()
+        entries = []
+        for sub in os.listdir(folder):
+            if not os.path.isdir(os.path.join(folder, sub)):
+                continue
+            for name in os.listdir(os.path.join(folder, sub)):
+                if name.endswith('.nwf'):
+                    stat = os.stat(os.path.join(folder, sub, name))
+                    entries.append((stat.st_mtime_ns, name[:-4], stat.st_size))
+        self.clock = max([term[0] for term in entries], default=0)
+        self.entries = collections.OrderedDict((key, size) for _, key, size in sorted(entries))
+        self.size = sum(self.entries.values())
+        self._evict()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def _path(self, key):
+        return os.path.join(self.folder, key[:2], key + '.nwf')
+
+    def _touch(self, key):
+        self.clock = max(time.time_ns(), self.clock + 1)
+        os.utime(self._path(key), ns=(self.clock, self.clock))
+
+    def key(self, x, fingerprint, **params):
+        """Key of an image x of shape [3, length, length] (RGB, 0-255) coded
+        with the model of fingerprint and params."""
+        pixels = np.ascontiguousarray(torch.round(x).cpu().numpy().astype(np.uint8))
+        h = hashlib.sha256()
+        h.update(bytes(fingerprint))
+        h.update(json.dumps(params, sort_keys=True).encode())
+        h.update(str(pixels.shape).encode())
+        h.update(pixels.tobytes())
+        return h.hexdigest()
+
+    def get(self, key):
+        """Container of key, None if not cached."""
+        with self.lock:
+            if key not in self.entries:
+                self.misses += 1
+                return None
+        try:
+            with open(self._path(key), 'rb') as f:
+                buf = f.read()
+        except OSError:
+            buf = None
+        with self.lock:
+            if buf is not None and key in self.entries:
+                try:
+                    self._touch(key)
+                    self.entries.move_to_end(key)
+                except OSError:
+                    buf = None
+            if buf is None:
+                # lost, or evicted before it could be read
+                self.size -= self.entries.pop(key, 0)
+                self.misses += 1
+                return None
+            self.hits += 1
+        return Container.fromBytes(buf)
+
+    def put(self, key, container):
+        buf = container.toBytes()
+        if len(buf) > self.maxBytes:
+            return
+        with self.lock:
+            # the same key is the same Container, a put of it going on is enough
+            if key in self.writing:
+                return
+            self.writing.add(key)
+        try:
+            writeFile(self._path(key), buf)
+        except BaseException:
+            with self.lock:
+                self.writing.discard(key)
+            raise
+        with self.lock:
+            self.writing.discard(key)
+            self._touch(key)
+            self.size += len(buf) - self.entries.pop(key, 0)
+            self.entries[key] = len(buf)
+            self._evict()
+
+    def _evict(self):
+        while self.size > self.maxBytes and self.entries:
+            key, size = self.entries.popitem(last=False)
+            self.size -= size
+            try:
+                os.remove(self._path(key))
+            except OSError:
+                pass
+
+
+def codingParams(HUE=True, nbins=4096, precision=24, k=None, tableLog=12, tile=0):
+    """The parameters of mera.compress keys depend on."""
+    return {'HUE': bool(HUE), 'nbins': nbins, 'precision': precision, 'k': k, 'tableLog': tableLog, 'tile': tile}
+
+
+def compress(cache, f, x, fingerprint, HUE=True, nbins=4096, precision=24, k=None, chunk=4096, tableLog=12, tile=0):
+    """mera.compress of images x through cache: only the images neither cached
+    nor repeated earlier in x go through the flow, as one batch. Returns the
+    Containers and the keys of the images, equal keys telling repeats."""
+    keys = [cache.key(term, fingerprint, **codingParams(HUE, nbins, precision, k, tableLog, tile)) for term in x]
+    containers = {}
+    miss = []
+    for i, key in enumerate(keys):
+        if key in containers:
+            with cache.lock:
+                cache.refs += 1
+            continue
+        containers[key] = cache.get(key)
+        if containers[key] is None:
+            miss.append(i)
+    if miss:
+        for i, container in zip(miss, mera.compress(f, x[miss], fingerprint, HUE, nbins, precision, k, chunk, tableLog, tile)):
+            containers[keys[i]] = container
+            cache.put(keys[i], container)
+    return [containers[key] for key in keys], keys
@@ -6,19 +6,162 @@ from . import rans
 def encoder(CDF, symbol, state, precision=24):
 
     def statfun_encode(s):
-        return CDF[s], CDF[s + 1] - CDF[s]
+        return int(CDF[s]), int(CDF[s + 1] - CDF[s])
 
     state = rans.append_symbol(statfun_encode, precision)(state, symbol)
     return state
 
-def decoder(CDF, state, precision=24):
+def buildTable(CDF, precision=24, bits=8, chunk=1 << 16):
+    """Bucket index over CDFs of shape [nbins, ...].
+
+    [0, 1 << precision) is cut into 1 << bits buckets, table[k] holds the
+    symbol at the lower edge of bucket k, so a cf in bucket k decodes to a
+    symbol in [table[k], table[k + 1]]. Built with one searchsorted over all
+    the distributions at once.
+    """
+    nbins = CDF.shape[0]
+    shape = CDF.shape[1:]
+    CDF = CDF.reshape(nbins, -1)
+    table = np.empty([(1 << bits) + 1, CDF.shape[1]], dtype=np.uint16 if nbins <= (1 << 16) else np.int32)
+    edges = np.arange((1 << bits) + 1, dtype=np.int64) << (precision - bits)
+    for i in range(0, CDF.shape[1], chunk):
+        # shift every distribution into its own interval so they can be searched as one sorted array
+        offset = np.arange(i, min(i + chunk, CDF.shape[1]), dtype=np.int64).reshape(-1, 1) - i
+        _CDF = (CDF[:, i:i + chunk].T.astype(np.int64) + (offset << precision)).reshape(-1)
+        s = np.searchsorted(_CDF, (edges.reshape(1, -1) + (offset << precision)).reshape(-1), side='right').reshape(-1, edges.shape[0]) - offset * nbins - 1
+        table[:, i:i + chunk] = np.clip(s, 0, nbins - 1).T
+    return table.reshape(table.shape[0], *shape)
+
+
+def lookup(CDF, table, cf, precision=24):
+    # CDF of shape [nbins, n], table of shape [nbuckets + 1, n] and cf of shape [n]
+    cols = np.arange(CDF.shape[1])
+    bucket = cf >> (precision - int(np.log2(table.shape[0] - 1)))
+    lo = table[bucket, cols].astype(np.int64)
+    hi = table[bucket + 1, cols].astype(np.int64)
+    # a bucket usually spans one or two symbols, bisect on the few that span more
+    while (hi > lo).any():
+        mid = (lo + hi + 1) // 2
+        right = CDF[mid, cols] <= cf
+        lo = np.where(right, mid, lo)
+        hi = np.where(right, hi, mid - 1)
+    return lo
+
+
+def decoder(CDF, state, precision=24, table=None):
+
+    if table is not None:
+        cf, pop = rans.pop(state, precision)
+        s = lookup(CDF.reshape(-1, 1), table.reshape(-1, 1), np.array([cf]), precision)[0]
+        start = int(CDF[s])
+        freq = int(CDF[s + 1]) - start
+        return pop(start, freq), s
 
     def statfun_decode(cdf):
         # Search such that CDF[s-1] <= cdf < CDF[s]
         s = np.searchsorted(CDF, cdf, side='right') - 1
-        start = CDF[s]
-        freq = CDF[s+1] - start
+        start = int(CDF[s])
+        freq = int(CDF[s+1]) - start
         return s, (start, freq)
 
     state, symbol = rans.pop_symbol(statfun_decode, precision)(state)
-    return state, symbol
\ No newline at end of file
+    return state, symbol
+
+
+def batchEncoder(CDF, symbols, state, precision=24, idx=None):
+    # CDF is of shape [nbins, len(idx)], one column per message
+    cols = np.arange(CDF.shape[1])
+    start = CDF[symbols, cols]
+    freq = CDF[symbols + 1, cols] - start
+    return state.append(start, freq, precision, idx)
+
+
+def batchDecoder(CDF, state, precision=24, idx=None, table=None):
+    cols = np.arange(CDF.shape[1])
+    cf, pop = state.pop(precision, idx)
+    if table is not None:
+        symbols = lookup(CDF, table, cf, precision)
+    else:
+        # same as searchsorted(CDF[:, i], cf[i], side='right') - 1 for every column
+        symbols = (CDF <= cf).sum(0) - 1
+    start = CDF[symbols, cols]
+    freq = CDF[symbols + 1, cols] - start
+    state = pop(start, freq)
+    return state, symbols
+
+
+def escapeEncoder(CDF, symbols, state, precision=24, nbins=4096, idx=None):
+    """batchEncoder for windowed CDFs of shape [2 * window + 3, len(idx)].
+
+    Symbols are in [0, nbins), the window covers nbins // 2 - window ... nbins // 2 + window
+    and its last symbol is the escape, after which a symbol is coded with
+    rawBits uniform bits. A symbol is escaped whenever that is cheaper, so
+    any value in [0, nbins) can be coded with any window, escaped values out
+    of it raise.
+    """
+    rows = np.arange(CDF.shape[1]) if idx is None else idx
+    cols = np.arange(CDF.shape[1])
+    window = (CDF.shape[0] - 3) // 2
+    escape = 2 * window + 1
+    rawBits = int(np.ceil(np.log2(nbins)))
+
+    s = np.asarray(symbols).astype(np.int64) - nbins // 2 + window
+    inside = (s >= 0) & (s < escape)
+    s = np.where(inside, s, escape)
+    freq = CDF[s + 1, cols].astype(np.int64) - CDF[s, cols]
+    escaped = ~inside | ((freq << rawBits) < CDF[escape + 1, cols].astype(np.int64) - CDF[escape, cols])
+    if escaped.any():
+        raw = np.asarray(symbols)[escaped]
+        if raw.min() < 0 or raw.max() >= nbins:
+            raise Exception("Escaped symbols out of [0, " + str(nbins) + ")")
+        # popped after the escape symbol, so pushed before it
+        state = state.append(raw, np.ones(escaped.sum()), rawBits, rows[escaped])
+    return batchEncoder(CDF, np.where(escaped, escape, s), state, precision, idx)
+
+
+def escapeDecoder(CDF, state, precision=24, nbins=4096, idx=None, table=None):
+    rows = np.arange(CDF.shape[1]) if idx is None else idx
+    window = (CDF.shape[0] - 3) // 2
+    rawBits = int(np.ceil(np.log2(nbins)))
+
+    state, s = batchDecoder(CDF, state, precision, idx, table)
+    symbols = s.astype(np.int64) - window + nbins // 2
+    escaped = s == 2 * window + 1
+    if escaped.any():
+        cf, pop = state.pop(rawBits, rows[escaped])
+        symbols[escaped] = cf.astype(np.int64)
+        state = pop(cf, np.ones(escaped.sum()))
+    return state, symbols
+
+
+
+def interleavedEncoder(CDF, symbols, nstates, precision=24):
+    """Codes each message of symbols ([batch, length], CDF of shape [nbins, batch,
+    length]) with nstates rANS states, symbol j going to state j % nstates.
+    All states of the batch are advanced together, returns one array per
+    message as packed by rans.interleave."""
+    batchSize, length = symbols.shape
+    rows = np.arange(batchSize * nstates).reshape(batchSize, nstates)
+    state = rans.BatchStack(batchSize * nstates)
+    for j in reversed(range(0, length, nstates)):
+        n = min(nstates, length - j)
+        state = batchEncoder(CDF[:, :, j:j + n].reshape(CDF.shape[0], -1), symbols[:, j:j + n].reshape(-1), state, precision, rows[:, :n].reshape(-1))
+    states = state.flatten()
+    return [rans.interleave(states[i * nstates:(i + 1) * nstates]) for i in range(batchSize)]
+
+
+def interleavedDecoder(CDF, states, precision=24, table=None):
+    """Inverse of interleavedEncoder, every message must use the same number of states."""
+    length = CDF.shape[-1]
+    states = [rans.deinterleave(arr) for arr in states]
+    nstates = len(states[0])
+    assert all(len(term) == nstates for term in states)
+    rows = np.arange(len(states) * nstates).reshape(len(states), nstates)
+    state = rans.BatchStack.unflatten([arr for term in states for arr in term])
+    symbols = np.empty([len(states), length], dtype=np.int64)
+    for j in range(0, length, nstates):
+        n = min(nstates, length - j)
+        _table = None if table is None else table[:, :, j:j + n].reshape(table.shape[0], -1)
+        state, _symbols = batchDecoder(CDF[:, :, j:j + n].reshape(CDF.shape[0], -1), state, precision, rows[:, :n].reshape(-1), _table)
+        symbols[:, j:j + n] = _symbols.reshape(-1, n)
+    return symbols
\ No newline at end of file
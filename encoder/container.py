@@ -0,0 +1,199 @@
+'''
+On-disk format of NWF compressed images.
+
+A file is a fixed little-endian header, the windows of windowed CDF tables
+as uint16 (finest level first), the level index and the payload: the
+flattened rANS words (as returned by rans.flatten) as uint32 and the tANS
+bitstream of the levels with static priors.
+
+Levels are decoded coarsest first and the payload is laid out in that order,
+one segment per level holding the words then the bytes its decoding needs
+past the previous segment (the rANS head goes with the first one). The index
+holds, for every segment, the ends of its words and of its bytes as two
+uint32, so any prefix of whole segments decodes the coarsest levels alone.
+Without an index (nlevels 0) the payload is a single segment.
+
+Tiled files (tile > 0) code every tile of tile x tile pixels of the sub-bands
+of a level into a rANS state of its own, one segment per tile: the coarsest
+level then the tiles of every finer level in row major order.
+
+A container can also hold count images of the same shape coded into a single
+message (see mera.compress with shared), level after level and in every level
+image after image: the n symbols a level has per image are the symbols
+i * n:(i + 1) * n of the level for image i. The header is:
+
+    magic       3s  b'NWF'
+    version     B
+    fingerprint 8s  first bytes of the sha256 of the model checkpoint
+    flags       B   bit 0 set for HUE (RGB) images, clear for YCC, bit 1 set
+                    for files of the lifting tier (flow.LiftingMERA)
+    channel     B
+    height      H
+    width       H
+    nbins       I
+    precision   B
+    nwindows    B   number of levels with windowed CDF tables, 0 for full nbins tables
+    nwords      I
+    tableLog    B   log2 of the tANS tables, 0 if every level is rANS coded
+    nbytes      I   length of the tANS bitstream
+    nlevels     I   number of segments in the level index
+    tile        H   side of the tiles of tiled files, 0 if not tiled
+    count       H   number of images
+'''
+import hashlib
+import struct
+import numpy as np
+
+
+MAGIC = b'NWF'
+VERSION = 6
+
+_header = struct.Struct('<3sB8sBBHHIBBIBIIHH')
+
+FLAG_HUE = 1
+FLAG_LIFTING = 2
+
+
+def fingerprint(path, size=8):
+    """Hash of a model checkpoint, identifying the model a file was coded with."""
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    return h.digest()[:size]
+
+
+class Container(object):
+    """A compressed image. ends, of shape [nlevels, 2], are the ends of every
+    level's words and bytes, coarsest level first. A container read from a
+    prefix of a file only holds the words and bits of its first levels
+    segments, nwords and nbytes keep the full lengths. The segments of tiled
+    containers are tiles, levels is then None. shape is the shape of every
+    one of the count images. lifting is set for files coded with the fixed
+    lifting steps of flow.LiftingMERA."""
+    def __init__(self, fingerprint, shape, HUE, nbins, precision, words, windows=None, tableLog=0, bits=None, ends=None, nwords=None, nbytes=None, tile=0, count=1, lifting=False):
+        assert len(fingerprint) == 8
+        assert len(shape) == 3
+        self.fingerprint = bytes(fingerprint)
+        self.shape = tuple(int(term) for term in shape)
+        self.HUE = bool(HUE)
+        self.nbins = int(nbins)
+        self.precision = int(precision)
+        self.windows = [int(term) for term in windows] if windows is not None and len(windows) else None
+        self.words = np.asarray(words, dtype=np.uint32)
+        self.tableLog = int(tableLog)
+        self.bits = np.zeros(0, dtype=np.uint8) if bits is None else np.asarray(bits, dtype=np.uint8)
+        self.nwords = self.words.shape[0] if nwords is None else int(nwords)
+        self.nbytes = self.bits.shape[0] if nbytes is None else int(nbytes)
+        self.tile = int(tile)
+        self.count = int(count)
+        self.lifting = bool(lifting)
+        if self.count < 1 or (self.tile and self.count > 1):
+            raise Exception("Invalid NWF image count")
+        self.ends = None if ends is None or len(ends) == 0 else np.asarray(ends, dtype=np.int64).reshape(-1, 2)
+        if self.ends is not None:
+            if (np.diff(self.ends, axis=0) < 0).any() or tuple(self.ends[-1]) != (self.nwords, self.nbytes):
+                raise Exception("Invalid NWF level index")
+            # segments held in full
+            self.segments = int(((self.ends[:, 0] <= self.words.shape[0]) & (self.ends[:, 1] <= self.bits.shape[0])).sum())
+        else:
+            self.segments = 1 if self.complete() else 0
+        if self.tile:
+            if not self.complete():
+                raise Exception("Tiled NWF files can't be read partially")
+            self.levels = None
+        else:
+            self.levels = self.segments if self.ends is not None else (None if self.complete() else 0)
+
+    def _segments(self):
+        ends = self.ends if self.ends is not None else np.array([[self.nwords, self.nbytes]])
+        return np.concatenate([np.zeros([1, 2], dtype=np.int64), ends], 0)
+
+    def segment(self, i):
+        """Words and bytes of the i-th segment."""
+        (wlo, blo), (whi, bhi) = self._segments()[i:i + 2]
+        return self.words[wlo:whi], self.bits[blo:bhi]
+
+    def complete(self):
+        return self.words.shape[0] == self.nwords and self.bits.shape[0] == self.nbytes
+
+    def __len__(self):
+        return _header.size + 2 * len(self.windows or []) + 8 * (0 if self.ends is None else self.ends.shape[0]) + 4 * self.words.shape[0] + self.bits.shape[0]
+
+    def toBytes(self):
+        flags = (FLAG_HUE if self.HUE else 0) | (FLAG_LIFTING if self.lifting else 0)
+        ends = np.zeros([0, 2]) if self.ends is None else self.ends
+        header = _header.pack(MAGIC, VERSION, self.fingerprint, flags, *self.shape, self.nbins, self.precision, len(self.windows or []), self.nwords, self.tableLog, self.nbytes, ends.shape[0], self.tile, self.count)
+        out = [header, np.asarray(self.windows or [], dtype='<u2').tobytes(), ends.astype('<u4').tobytes()]
+        segments = self._segments()
+        for (wlo, blo), (whi, bhi) in zip(segments[:-1], segments[1:]):
+            if whi > self.words.shape[0] or bhi > self.bits.shape[0]:
+                break
+            out += [self.words[wlo:whi].astype('<u4').tobytes(), self.bits[blo:bhi].tobytes()]
+        return b''.join(out)
+
+    @classmethod
+    def prefixSize(cls, buf, levels=None):
+        """Bytes of a file needed to decode its levels coarsest levels, all of
+        them if None, buf holding at least the header, windows and index."""
+        if len(buf) < _header.size:
+            raise Exception("Truncated NWF header")
+        magic, version, _, _, _, _, _, _, _, nwindows, nwords, _, nbytes, nlevels, _, _ = _header.unpack_from(buf, 0)
+        if magic != MAGIC:
+            raise Exception("Not a NWF file")
+        if version != VERSION:
+            raise Exception("Unsupported NWF version " + str(version))
+        size = _header.size + 2 * nwindows + 8 * nlevels
+        if levels == 0:
+            return size
+        if levels is None or nlevels == 0:
+            return size + 4 * nwords + nbytes
+        if len(buf) < size:
+            raise Exception("Truncated NWF level index")
+        if levels > nlevels:
+            raise Exception("NWF file has only " + str(nlevels) + " levels")
+        ends = np.frombuffer(buf, dtype='<u4', count=2 * nlevels, offset=_header.size + 2 * nwindows).reshape(-1, 2)
+        return size + 4 * int(ends[levels - 1, 0]) + int(ends[levels - 1, 1])
+
+    @classmethod
+    def fromBytes(cls, buf, partial=False):
+        """Parses a file, or with partial a prefix of it, keeping the whole
+        level segments it holds."""
+        headerSize = cls.prefixSize(buf, 0)
+        magic, version, fingerprint, flags, channel, height, width, nbins, precision, nwindows, nwords, tableLog, nbytes, nlevels, tile, count = _header.unpack_from(buf, 0)
+        if len(buf) < headerSize:
+            raise Exception("Truncated NWF level index")
+        if not partial and len(buf) < cls.prefixSize(buf):
+            raise Exception("Truncated NWF stream")
+        windows = np.frombuffer(buf, dtype='<u2', count=nwindows, offset=_header.size)
+        ends = np.frombuffer(buf, dtype='<u4', count=2 * nlevels, offset=_header.size + 2 * nwindows).astype(np.int64).reshape(-1, 2)
+        segments = np.concatenate([np.zeros([1, 2], dtype=np.int64), ends if nlevels else np.array([[nwords, nbytes]])], 0)
+        words = []
+        bits = []
+        offset = headerSize
+        for (wlo, blo), (whi, bhi) in zip(segments[:-1], segments[1:]):
+            if offset + 4 * (whi - wlo) + bhi - blo > len(buf):
+                break
+            words.append(np.frombuffer(buf, dtype='<u4', count=whi - wlo, offset=offset))
+            offset += 4 * (whi - wlo)
+            bits.append(np.frombuffer(buf, dtype=np.uint8, count=bhi - blo, offset=offset))
+            offset += bhi - blo
+        words = np.concatenate(words) if words else np.zeros(0, dtype=np.uint32)
+        bits = np.concatenate(bits) if bits else np.zeros(0, dtype=np.uint8)
+        return cls(fingerprint, (channel, height, width), flags & FLAG_HUE, nbins, precision, words, windows, tableLog, bits, ends, nwords, nbytes, tile, count, flags & FLAG_LIFTING)
+
+
+def save(path, container):
+    with open(path, 'wb') as f:
+        f.write(container.toBytes())
+
+
+def load(path, levels=None):
+    """Reads a file, or only the bytes its levels coarsest levels need."""
+    with open(path, 'rb') as f:
+        if levels is None:
+            return Container.fromBytes(f.read())
+        buf = f.read(_header.size)
+        buf += f.read(Container.prefixSize(buf, 0) - len(buf))
+        buf += f.read(Container.prefixSize(buf, levels) - len(buf))
+        return Container.fromBytes(buf, partial=True)
@@ -0,0 +1,113 @@
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from multiprocessing import shared_memory
+
+from . import rans, coder
+
+
+_attached = {}
+
+
+def _attach(name, shape, dtype):
+    # keep the segment of the current batch mapped between tasks of a worker
+    if name not in _attached:
+        for shm, _ in _attached.values():
+            shm.close()
+        _attached.clear()
+        shm = shared_memory.SharedMemory(name=name)
+        _attached[name] = (shm, np.ndarray(shape, dtype=dtype, buffer=shm.buf))
+    return _attached[name][1]
+
+
+def _encode(name, shape, dtype, lo, symbols, precision, nstates):
+    CDF = _attach(name, shape, dtype)[:, lo:lo + symbols.shape[0]]
+    if nstates > 1:
+        return coder.interleavedEncoder(CDF, symbols, nstates, precision)
+    state = rans.BatchStack(symbols.shape[0])
+    for j in reversed(range(symbols.shape[-1])):
+        state = coder.batchEncoder(CDF[:, :, j], symbols[:, j], state, precision)
+    return state.flatten()
+
+
+def _decode(name, shape, dtype, lo, states, precision, nstates, tableBits):
+    CDF = _attach(name, shape, dtype)[:, lo:lo + len(states)]
+    table = coder.buildTable(CDF, precision, tableBits) if tableBits > 0 else None
+    if nstates > 1:
+        return coder.interleavedDecoder(CDF, states, precision, table)
+    state = rans.BatchStack.unflatten(states)
+    symbols = []
+    for j in range(CDF.shape[-1]):
+        state, symbol = coder.batchDecoder(CDF[:, :, j], state, precision, table=None if table is None else table[:, :, j])
+        symbols.append(symbol)
+    return np.stack(symbols, 1)
+
+
+class CodingExecutor(object):
+    """Entropy codes a batch on a pool of processes.
+
+    The CDF tables of a batch ([nbins, batch, length]) are put in shared memory
+    once, every task then codes chunk images with their slice of it. Decoding
+    of a chunk is submitted as soon as its encoding is done, so the two
+    overlap across the batch.
+    """
+    def __init__(self, workers=None, precision=24, nstates=1, tableBits=8, chunk=1):
+        self.pool = ProcessPoolExecutor(workers)
+        self.precision = precision
+        self.nstates = nstates
+        self.tableBits = tableBits
+        self.chunk = chunk
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.shutdown()
+
+    def shutdown(self):
+        self.pool.shutdown()
+
+    def _share(self, CDF):
+        shm = shared_memory.SharedMemory(create=True, size=max(CDF.nbytes, 1))
+        np.ndarray(CDF.shape, dtype=CDF.dtype, buffer=shm.buf)[...] = CDF
+        return shm
+
+    def run(self, CDF, symbols, decode=True):
+        """Encodes symbols of shape [batch, length], and decodes them back if
+        decode. Returns the list of flattened states and the decoded symbols."""
+        shm = self._share(CDF)
+        args = (shm.name, CDF.shape, CDF.dtype)
+        states = [None] * symbols.shape[0]
+        rcnSymbols = np.empty(symbols.shape, dtype=np.int64) if decode else None
+        try:
+            pending = {}
+            for lo in range(0, symbols.shape[0], self.chunk):
+                pending[self.pool.submit(_encode, *args, lo, symbols[lo:lo + self.chunk], self.precision, self.nstates)] = ('encode', lo)
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    stage, lo = pending.pop(future)
+                    if stage == 'encode':
+                        _states = future.result()
+                        states[lo:lo + len(_states)] = _states
+                        if decode:
+                            pending[self.pool.submit(_decode, *args, lo, _states, self.precision, self.nstates, self.tableBits)] = ('decode', lo)
+                    else:
+                        _symbols = future.result()
+                        rcnSymbols[lo:lo + _symbols.shape[0]] = _symbols
+        finally:
+            shm.close()
+            shm.unlink()
+        return states, rcnSymbols
+
+    def encode(self, CDF, symbols):
+        return self.run(CDF, symbols, decode=False)[0]
+
+    def decode(self, CDF, states):
+        shm = self._share(CDF)
+        args = (shm.name, CDF.shape, CDF.dtype)
+        try:
+            futures = [self.pool.submit(_decode, *args, lo, states[lo:lo + self.chunk], self.precision, self.nstates, self.tableBits) for lo in range(0, len(states), self.chunk)]
+            return np.concatenate([future.result() for future in futures], 0)
+        finally:
+            shm.close()
+            shm.unlink()
@@ -0,0 +1,146 @@
+'''
+Bookkeeping of directory compression jobs (see compressDir.py).
+
+The manifest is a JSON lines file, a record per compressed image, appended
+and synced to disk only once its NWF file is in place. A job that crashed is
+resumed by skipping the images whose record and file are there, a last line
+cut short by the crash is ignored. Records of images repeating an image
+compressed before name it as ref, their file being a link to its file.
+'''
+import json
+import os
+import numpy as np
+from PIL import Image
+
+
+EXTENSIONS = ('.png', '.jpg', '.jpeg', '.bmp', '.tif', '.tiff', '.webp', '.ppm')
+
+
+def walk(root):
+    """Paths, relative to root and sorted, of the images under root."""
+    paths = []
+    for folder, dirs, files in os.walk(root):
+        dirs.sort()
+        for name in files:
+            if name.lower().endswith(EXTENSIONS):
+                paths.append(os.path.relpath(os.path.join(folder, name), root))
+    return sorted(paths)
+
+
+def outPath(path):
+    """Path of the NWF file of the image at path, keeping its extension so
+    that images differing only by it don't share a file."""
+    return path + '.nwf'
+
+
+def readImage(path):
+    """RGB pixels of the image at path as a uint8 array of shape [length,
+    length, 3], run in worker processes. Returns (array, None), or (None,
+    reason) for images that can't be coded."""
+    try:
+        img = np.array(Image.open(path).convert('RGB'))
+    except Exception as e:
+        return None, str(e)
+    if img.shape[0] != img.shape[1]:
+        return None, "Only square images are supported"
+    if img.shape[0] < 2 or img.shape[0] & (img.shape[0] - 1):
+        return None, "Only images of a power of 2 size are supported"
+    return img, None
+
+
+def writeFile(path, buf):
+    """Writes buf to path through a temporary file, so that path is either
+    missing or whole."""
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(buf)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+def linkFile(src, path):
+    """Makes path a hard link to src, or a copy where links aren't supported,
+    through a temporary file as writeFile."""
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    tmp = path + '.tmp'
+    if os.path.exists(tmp):
+        os.remove(tmp)
+    try:
+        os.link(src, tmp)
+    except OSError:
+        with open(src, 'rb') as f:
+            writeFile(path, f.read())
+        return
+    os.replace(tmp, path)
+
+
+class Manifest(object):
+    """Records of a job, records[path] being the last one of the image at
+    path, appended by add."""
+    def __init__(self, path):
+        self.path = path
+        self.records = {}
+        if os.path.exists(path):
+            with open(path, 'r') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue
+                    self.records[record['path']] = record
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.file = open(path, 'a')
+        # a crash mid-line leaves a line no json reads, records go on after it
+        if self.file.tell():
+            with open(path, 'rb') as f:
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b'\n':
+                    self.file.write('\n')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __len__(self):
+        return len(self.records)
+
+    def close(self):
+        self.file.close()
+
+    def done(self, path, folder):
+        """If the image at path was compressed into folder, with its file intact."""
+        record = self.records.get(path)
+        if record is None:
+            return False
+        out = os.path.join(folder, record['out'])
+        return os.path.exists(out) and os.path.getsize(out) == record['bytes']
+
+    def add(self, record):
+        self.file.write(json.dumps(record) + '\n')
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.records[record['path']] = record
+
+    def summary(self, paths=None):
+        """Totals of the records of paths, all by default: count, bytes of
+        the images and of their files, bits per dimension, the number of
+        repeats linked to the file of another image ('refs'), the bytes
+        stored without them and the fraction of the images' size saved."""
+        records = [self.records[path] for path in (self.records if paths is None else paths)]
+        size = sum(record['size'] for record in records)
+        nwf = sum(record['bytes'] for record in records)
+        stored = sum(record['bytes'] for record in records if 'ref' not in record)
+        dims = sum(record['dims'] for record in records)
+        return {
+            'count': len(records),
+            'size': size,
+            'bytes': nwf,
+            'bpd': 8 * nwf / dims if dims else 0.,
+            'refs': sum('ref' in record for record in records),
+            'stored': stored,
+            'saving': 1 - stored / size if size else 0.,
+        }
@@ -0,0 +1,938 @@
+'''
+Entropy coding of SimpleMERA latents.
+
+A latent z is divided level by level into integer symbols in [0, nbins): the
+(ur, dl, dr) details of each level shifted by their rounded prior mean, and the
+last 2x2 block of the coarsest level shifted by the rounded mixture mean of the
+last prior. Lists of per-level things are ordered finest level first, as
+SimpleMERA.inverse produces them.
+
+CDF tables span all nbins symbols, or with k given only the 2 * window + 1
+values around the rounded mean plus an escape symbol (see coder.escapeEncoder),
+window being k scales of the widest distribution of a level in the batch. As
+that depends on the batch, the windows are kept in the Container.
+
+The last level, and every level of models without meanNNlist, have priors that
+don't depend on the image. Their tables and rounded means are computed once
+and cached (see priorCache) until a parameter of the prior changes. With a
+tableLog, such levels are coded with tANS (see tans.py) into a bitstream of
+their own, and only the remaining levels with rANS.
+
+Levels are decoded coarsest first and the Container lays their words and
+bytes out in that order, so a prefix of a file decodes the coarsest levels
+alone, which preview completes to a full size image.
+
+Couplings and prior networks are convolutions, every pixel depends on a
+bounded neighbourhood of the coarser level (see levelHalo). Tiled containers
+code tiles of every level apart, so decompressRegion decodes a crop from the
+tiles around it only.
+
+The decoder must compute bit for bit the same CDFs as the encoder, but in
+float32 the prior and coupling networks give slightly different results for
+different batch sizes. Flows used for coding should therefore be converted to
+double precision (f.double()), loadFlow does so by default.
+'''
+import glob, json, math, os
+import weakref
+import numpy as np
+import torch
+
+import flow, utils
+from flow.hierarchy.mera import im2grp, grp2im, reform
+from utils import cdfDiscreteLogitstic, cdfMixDiscreteLogistic
+
+from . import rans, coder, tans
+from .container import Container
+
+
+_priorCache = weakref.WeakKeyDictionary()
+
+# tANS alphabets span this many scales around the mean, values out of it are escaped.
+# Every value of the alphabet takes at least one of the 1 << tableLog states,
+# so levels whose alphabet is more than 1/8 of them are rANS coded.
+tansScales = 8
+# levels with more distributions than this are rANS coded, their tANS tables would be too big
+tansMaxTables = 64
+
+
+def depthOf(f, length):
+    if f.compatible:
+        return int(math.log(length, 2))
+    return f.depth
+
+
+def lastPrior(f):
+    return f.prior.lastPrior if f.meanNNlist is not None else f.prior.priorList[-1]
+
+
+def staticPrior(f, no, length):
+    """The prior of level no if it doesn't depend on the image, else None."""
+    if no == depthOf(f, length) - 1:
+        return lastPrior(f)
+    if f.meanNNlist is None:
+        return f.prior.priorList[0 if f.compatible else no]
+    return None
+
+
+def priorCache(f, prior, key, fn):
+    """fn() computed once per prior and key. The cache is keyed on the storage
+    and version of the parameters of prior and f.decimal, so training steps,
+    load_state_dict or .double() invalidate it."""
+    version = tuple((p.data_ptr(), p._version, p.dtype) for p in list(prior.parameters()) + list(f.decimal.parameters()))
+    entry = _priorCache.get(prior)
+    if entry is None or entry[0] != version:
+        entry = (version, {})
+        _priorCache[prior] = entry
+    if key not in entry[1]:
+        with torch.no_grad():
+            entry[1][key] = fn()
+    return entry[1][key]
+
+
+def lastPriorParams(f):
+    prior = lastPrior(f)
+    mean = prior.mean if prior.clamp is None else torch.clamp(prior.mean, -prior.clamp, prior.clamp)
+    return mean, prior.logscale, prior.mixing
+
+
+def lastMean(f):
+    # rounded mean of the last prior, of shape [1, 3, 1, 4]
+    def fn():
+        mean, _, mixing = lastPriorParams(f)
+        return torch.round(f.decimal.forward_(mean.permute([1, 2, 3, 0])) * torch.softmax(mixing, dim=-1)).sum(-1).reshape(1, *mean.shape[1:])
+    return priorCache(f, lastPrior(f), 'mean', fn)
+
+
+def detailPriorParams(f, no, batch, length, ul=None):
+    """Mean and logscale of the details of level no, of shape [batch, 3, n, 3].
+
+    Models with meanNNlist compute them from ul, the coarse part of the level,
+    or take them from f.meanList of the last inverse if ul is None.
+    """
+    if f.meanNNlist is not None:
+        if ul is None:
+            return f.meanList[no], f.scaleList[no]
+        return reform(f.meanNNlist[no](f.decimal.inverse_(ul))).contiguous(), reform(f.scaleNNlist[no](f.decimal.inverse_(ul))).contiguous()
+    prior = f.prior.priorList[0 if f.compatible else no]
+    shape = [batch, 3, (length // 2 ** (no + 1)) ** 2, 3]
+    return prior.mean.expand(shape), prior.logscale.expand(shape)
+
+
+def detailMean(f, no, batch, length, params=None):
+    """Rounded mean of the details of level no, of shape [batch, 3, n, 3].
+    params are the detailPriorParams of the level if already computed."""
+    prior = staticPrior(f, no, length)
+    if prior is None:
+        mean, _ = detailPriorParams(f, no, batch, length) if params is None else params
+        return torch.round(f.decimal.forward_(mean))
+    shape = [batch, 3, (length // 2 ** (no + 1)) ** 2, 3]
+    return priorCache(f, prior, 'mean', lambda: torch.round(f.decimal.forward_(prior.mean))).expand(shape)
+
+
+def cdf2int(cdf, nbins, precision):
+    return (cdf * ((1 << precision) - nbins)).int().detach() + torch.arange(nbins).reshape(-1, *[1] * (len(cdf.shape) - 1)).to(cdf.device)
+
+
+def windowCDF(cdf, precision):
+    # cdf at the 2 * window + 2 edges of the window, the rest of the mass goes to the escape symbol
+    cdf = torch.cat([cdf - cdf[:1], torch.ones_like(cdf[:1])], 0)
+    return cdf2int(cdf, cdf.shape[0], precision)
+
+
+def detailWindow(f, logscale, k, nbins):
+    return max(1, min(math.ceil(k * torch.exp(logscale).max().item() * f.decimal.scaling.item()), nbins // 2 - 1))
+
+
+def lastWindow(f, k, nbins):
+    mean, logscale, _ = lastPriorParams(f)
+    spread = torch.abs(f.decimal.forward_(mean) - lastMean(f)) + k * torch.exp(logscale) * f.decimal.scaling
+    return max(1, min(math.ceil(spread.max().item()), nbins // 2 - 1))
+
+
+def detailCDF(f, mean, logscale, nbins, precision, window=None):
+    if window is None:
+        bins = torch.arange(-nbins // 2, nbins // 2)
+    else:
+        bins = torch.arange(-window, window + 2)
+    bins = bins.reshape(-1, *[1] * len(mean.shape)).to(mean) - 1 + torch.round(f.decimal.forward_(mean))
+    cdf = cdfDiscreteLogitstic(bins, mean, logscale, decimal=f.decimal)
+    cdf = cdf2int(cdf, nbins, precision) if window is None else windowCDF(cdf, precision)
+    return cdf.reshape(cdf.shape[0], mean.shape[0], -1).cpu().numpy().astype(np.uint32)
+
+
+def lastCDF(f, batch, nbins, precision, window=None):
+    def fn():
+        mean, logscale, mixing = lastPriorParams(f)
+        if window is None:
+            bins = torch.arange(-nbins // 2, nbins // 2)
+        else:
+            bins = torch.arange(-window, window + 2)
+        bins = bins.reshape(-1, 1, 1, 1, 1).to(mean) - 1 + lastMean(f)
+        cdf = cdfMixDiscreteLogistic(bins, mean, logscale, mixing, decimal=f.decimal)
+        cdf = cdf2int(cdf, nbins, precision) if window is None else windowCDF(cdf, precision)
+        return cdf.reshape(cdf.shape[0], 1, -1).cpu().numpy().astype(np.uint32)
+    CDF = priorCache(f, lastPrior(f), ('CDF', nbins, precision, window), fn)
+    return np.broadcast_to(CDF, (CDF.shape[0], batch, CDF.shape[2]))
+
+
+def compactSymbols(t):
+    """Integer tensor t as an int16 array, or an int32 one if a value doesn't
+    fit, the coders reading both."""
+    if t.numel() and (t.min() < -(1 << 15) or t.max() >= (1 << 15) - 1):
+        return t.int().cpu().numpy()
+    return t.short().cpu().numpy()
+
+
+def divide(f, z, nbins, compact=True):
+    """Symbols of every level of z, as arrays of shape [batch, n], int16 with
+    compact (see compactSymbols) or int32. The coders take symbols in [0,
+    nbins) only, levels with symbols out of it raise."""
+    depth = depthOf(f, z.shape[-1])
+    parts = []
+    ul = z
+    for no in range(depth):
+        if no == depth - 1:
+            z_ = ul.reshape(*ul.shape[:2], 1, 4) - lastMean(f) + nbins // 2
+        else:
+            _x = im2grp(ul)
+            z_ = _x[:, :, :, 1:].contiguous() - detailMean(f, no, z.shape[0], z.shape[-1]) + nbins // 2
+            ul = _x[:, :, :, 0].reshape(*_x.shape[:2], int(_x.shape[2] ** 0.5), int(_x.shape[2] ** 0.5)).contiguous()
+        z_ = z_.reshape(z_.shape[0], -1).detach()
+        if z_.numel() and (z_.min() < 0 or z_.max() >= nbins):
+            raise Exception("Symbols of level " + str(no) + " out of [0, " + str(nbins) + "), code with more nbins")
+        parts.append(compactSymbols(z_) if compact else z_.int().cpu().numpy())
+    return parts
+
+
+def join(f, parts, nbins, params=None):
+    """Inverse of divide, params as given by levelParams."""
+    depth = len(parts)
+    batch = parts[0].shape[0]
+    length = 2 ** depth
+    zparts = []
+    for no, part in enumerate(parts):
+        part = torch.as_tensor(part)
+        if no == depth - 1:
+            offset = lastMean(f) - nbins // 2
+        else:
+            offset = detailMean(f, no, batch, length, None if params is None else params[no]) - nbins // 2
+        zparts.append(part.to(offset.device).reshape(batch, *offset.shape[1:]) + offset)
+
+    retZ = grp2im(zparts[-1]).contiguous()
+    for term in reversed(zparts[:-1]):
+        tmp = term.reshape(*retZ.shape, 3)
+        retZ = retZ.reshape(*retZ.shape, 1)
+        tmp = torch.cat([retZ, tmp], -1).reshape(*retZ.shape[:2], -1, 4)
+        retZ = grp2im(tmp).contiguous()
+    return retZ
+
+
+def calCDF(f, batch, nbins, precision, length=None, k=None):
+    """Integer CDFs of every level's symbols, of shape [nbins, batch, n], or
+    [2 * window + 3, batch, n] with a window of k scales per level."""
+    if length is None:
+        length = 2 ** f.depth
+    depth = depthOf(f, length)
+    CDF = []
+    for no in range(depth - 1):
+        window = None if k is None else detailWindow(f, detailPriorParams(f, no, batch, length)[1], k, nbins)
+        CDF.append(np.concatenate([term for _, term in levelCDF(f, no, batch, length, nbins, precision, window)], -1))
+    CDF.append(lastCDF(f, batch, nbins, precision, None if k is None else lastWindow(f, k, nbins)))
+    return CDF
+
+
+def levelParams(f, batch, length=None):
+    """detailPriorParams of every detail level (None for static priors), finest
+    first, so that levels can be coded while f runs on other images."""
+    if length is None:
+        length = 2 ** f.depth
+    return [None if staticPrior(f, no, length) is not None else detailPriorParams(f, no, batch, length) for no in range(depthOf(f, length) - 1)]
+
+
+def calWindows(f, batch, nbins, length=None, k=None):
+    """Windows of every level calCDF would use, None if k is None."""
+    if k is None:
+        return None
+    if length is None:
+        length = 2 ** f.depth
+    depth = depthOf(f, length)
+    return [detailWindow(f, detailPriorParams(f, no, batch, length)[1], k, nbins) for no in range(depth - 1)] + [lastWindow(f, k, nbins)]
+
+
+def levelCDF(f, no, batch, length, nbins, precision, window=None, chunk=4096, reverse=False, params=None, cols=None):
+    """Yields (lo, CDF) with CDF the tables of symbols lo:lo + CDF.shape[-1]
+    of detail level no, in decoding order or in encoding order if reverse.
+    cols selects symbols of the level, all of them if None. params are the
+    detailPriorParams of the (selected) symbols if already computed."""
+    prior = staticPrior(f, no, length)
+    n = 9 * (length // 2 ** (no + 1)) ** 2
+    los = range(0, n if cols is None else len(cols), chunk)
+    if prior is None:
+        if params is None:
+            params = [term.reshape(batch, -1) if cols is None else term.reshape(batch, -1)[:, cols] for term in detailPriorParams(f, no, batch, length)]
+        mean = params[0].reshape(batch, -1)
+        logscale = params[1].reshape(batch, -1)
+        for lo in (reversed(los) if reverse else los):
+            yield lo, detailCDF(f, mean[:, lo:lo + chunk], logscale[:, lo:lo + chunk], nbins, precision, window)
+    else:
+        CDF = priorCache(f, prior, ('CDF', nbins, precision, window), lambda: detailCDF(f, prior.mean.reshape(1, -1), prior.logscale.reshape(1, -1), nbins, precision, window))
+        # the prior's distribution of every symbol of the level
+        priorCols = np.arange(prior.mean.numel()).reshape(prior.mean.shape)
+        priorCols = np.broadcast_to(priorCols, [3, n // 9, 3]).reshape(-1)
+        cols = priorCols if cols is None else priorCols[cols]
+        for lo in (reversed(los) if reverse else los):
+            _cols = cols[lo:lo + chunk]
+            yield lo, np.broadcast_to(CDF[:, :, _cols], (CDF.shape[0], batch, _cols.shape[0]))
+
+
+def streamCDF(f, batch, nbins, precision, length=None, windows=None, chunk=4096, levels=None, reverse=False, params=None):
+    """Yields (no, lo, CDF) as calCDF(...)[no][:, :, lo:lo + CDF.shape[-1]],
+    chunk symbols at a time, params being as given by levelParams.
+
+    levels lists the levels in decoding order, finest first by default, and
+    chunks come in decoding order, or in encoding order if reverse. CDFs are
+    only computed when asked for, so with encodeStream/decodeStream a single
+    chunk is alive at a time whatever the batch size and image size.
+    """
+    if length is None:
+        length = 2 ** f.depth
+    depth = depthOf(f, length)
+    levels = list(range(depth) if levels is None else levels)
+    for no in (reversed(levels) if reverse else levels):
+        window = None if windows is None else windows[no]
+        if no == depth - 1:
+            yield no, 0, lastCDF(f, batch, nbins, precision, window)
+            continue
+        _params = None if params is None or params[no] is None else [term.reshape(batch, -1) for term in params[no]]
+        for lo, CDF in levelCDF(f, no, batch, length, nbins, precision, window, chunk, reverse, _params):
+            yield no, lo, CDF
+            # not to hold the chunk while levelCDF computes the next one
+            del CDF
+
+
+def _ungroup(t):
+    # [batch, 3, n, k] to k images of [batch, 3, sqrt(n), sqrt(n)]
+    length = int(t.shape[2] ** 0.5)
+    return [t[:, :, :, i].reshape(*t.shape[:2], length, length).contiguous() for i in range(t.shape[-1])]
+
+
+def encodeLevel(CDF, symbols, state, precision, nbins=None):
+    """Pushes symbols of shape [batch, n] to a BatchStack so that decodeLevel
+    pops them in order. nbins is given for windowed CDFs."""
+    for j in reversed(range(symbols.shape[-1])):
+        if nbins is None:
+            state = coder.batchEncoder(CDF[:, :, j], symbols[:, j], state, precision)
+        else:
+            state = coder.escapeEncoder(CDF[:, :, j], symbols[:, j], state, precision, nbins)
+    return state
+
+
+def decodeLevel(CDF, state, precision, tableBits=8, nbins=None):
+    table = coder.buildTable(CDF, precision, tableBits) if tableBits > 0 else None
+    symbols = []
+    for j in range(CDF.shape[-1]):
+        _table = None if table is None else table[:, :, j]
+        if nbins is None:
+            state, symbol = coder.batchDecoder(CDF[:, :, j], state, precision, table=_table)
+        else:
+            state, symbol = coder.escapeDecoder(CDF[:, :, j], state, precision, nbins, table=_table)
+        symbols.append(symbol)
+    return state, np.stack(symbols, 1)
+
+
+def rawBits(nbins):
+    return int(np.ceil(np.log2(nbins)))
+
+
+def tansTable(f, no, length, nbins, tableLog):
+    """(Table, window, dists) of the tANS coder of level no, dists being the
+    distribution of every symbol of the level, or None for rANS coded levels."""
+    prior = staticPrior(f, no, length)
+    if not tableLog or prior is None:
+        return None
+    last = no == depthOf(f, length) - 1
+    ndists = prior.mean[0].numel() if last else prior.mean.numel()
+    if ndists > tansMaxTables:
+        return None
+
+    def fn():
+        L = 1 << tableLog
+        if last:
+            window = lastWindow(f, tansScales, nbins)
+        else:
+            window = detailWindow(f, prior.logscale, tansScales, nbins)
+        if 2 * window + 2 > L >> 3:
+            return None, window
+        if last:
+            CDF = lastCDF(f, 1, nbins, tableLog, window)
+        else:
+            CDF = detailCDF(f, prior.mean.reshape(1, -1), prior.logscale.reshape(1, -1), nbins, tableLog, window)
+        freq = np.diff(CDF[:, 0].astype(np.int64), axis=0).T
+        # the top of an integer CDF is 1 short of 1 << tableLog
+        freq[:, -1] += L - freq.sum(1)
+        return tans.Table(freq, tableLog), window
+
+    table, window = priorCache(f, prior, ('tANS', nbins, tableLog), fn)
+    if table is None:
+        return None
+    if last:
+        dists = np.arange(ndists)
+    else:
+        dists = np.broadcast_to(np.arange(ndists).reshape(prior.mean.shape), [3, (length // 2 ** (no + 1)) ** 2, 3]).reshape(-1)
+    return table, window, dists
+
+
+def tansEncode(f, no, symbols, length, nbins, tableLog, writer, shared=False):
+    # with shared, the symbols of the batch go image after image to a single message
+    table, window, dists = tansTable(f, no, length, nbins, tableLog)
+    if shared:
+        symbols = symbols.reshape(1, -1)
+        dists = np.tile(dists, symbols.shape[-1] // dists.shape[0])
+    s = symbols.astype(np.int64) - nbins // 2 + window
+    inside = (s >= 0) & (s <= 2 * window)
+    if not inside.all() and (symbols[~inside].min() < 0 or symbols[~inside].max() >= nbins):
+        raise Exception("Escaped symbols out of [0, " + str(nbins) + ")")
+    s = np.where(inside, s, 2 * window + 1)
+    tans.encode(table, dists, s, writer, raw=symbols, rawBits=rawBits(nbins))
+
+
+def tansDecode(f, no, length, nbins, tableLog, reader, shared=None):
+    # shared is the number of images of a single message
+    table, window, dists = tansTable(f, no, length, nbins, tableLog)
+    if shared:
+        dists = np.tile(dists, shared)
+    s, raw = tans.decode(table, dists, dists.shape[0], reader, rawBits=rawBits(nbins))
+    s = np.where(s == 2 * window + 1, raw, s - window + nbins // 2)
+    return s.reshape(shared, -1) if shared else s
+
+
+def encodeStream(stream, parts, state, precision, nbins=None):
+    """Encodes parts, as given by divide, with a streamCDF in encoding order."""
+    for no, lo, CDF in stream:
+        state = encodeLevel(CDF, parts[no][:, lo:lo + CDF.shape[-1]], state, precision, nbins)
+        # drop the chunk before the stream computes the next one
+        del CDF
+    return state
+
+
+def decodeStream(stream, state, precision, tableBits=8, nbins=None):
+    """Decodes with a streamCDF in decoding order, returns the state and the
+    symbols of every level, finest first, as given by divide."""
+    parts = {}
+    for no, lo, CDF in stream:
+        state, symbols = decodeLevel(CDF, state, precision, tableBits, nbins)
+        parts.setdefault(no, []).append(symbols)
+        del CDF
+    return state, [np.concatenate(parts[no], -1) for no in sorted(parts)]
+
+
+def sharedCDF(f, no, batch, length, nbins, precision, window=None, chunk=4096, reverse=False, params=None):
+    """Yields (i, lo, CDF) with CDF the tables of symbols lo:lo + CDF.shape[-1]
+    of image i at level no, image after image as a batch coded into a single
+    message goes. params are the detailPriorParams of the level for the
+    batch if already computed."""
+    images = reversed(range(batch)) if reverse else range(batch)
+    if no == depthOf(f, length) - 1:
+        for i in images:
+            yield i, 0, lastCDF(f, 1, nbins, precision, window)
+        return
+    if params is None and staticPrior(f, no, length) is None:
+        params = detailPriorParams(f, no, batch, length)
+    for i in images:
+        _params = None if params is None else [term[i:i + 1] for term in params]
+        for lo, CDF in levelCDF(f, no, 1, length, nbins, precision, window, chunk, reverse, _params):
+            yield i, lo, CDF
+            del CDF
+
+
+def encodeLevels(f, parts, length, nbins, precision, levels, windows=None, chunk=4096, tableLog=0, shared=False, params=None):
+    """Codes parts, as given by divide, for decoding in the order of levels.
+    Levels with a tansTable go to a tans.BitWriter, the rest to a
+    rans.BatchStack, returns both and the ends of every level, of shape
+    [batch, len(levels), 2]: the words of the flattened state (with its head)
+    and the bytes of the flattened bitstream decoding up to it reads. With
+    shared, the whole batch is coded into a single message, level after
+    level and in every level image after image. params, as given by
+    levelParams, are used instead of the f.meanList of the last inverse."""
+    batch = parts[0].shape[0]
+    messages = 1 if shared else batch
+    levels = list(levels)
+    tansLevels = [no for no in levels if tansTable(f, no, length, nbins, tableLog) is not None]
+    ends = np.zeros([messages, len(levels), 2], dtype=np.int64)
+    writer = tans.BitWriter(messages)
+    for i, no in enumerate(levels):
+        if no in tansLevels:
+            tansEncode(f, no, parts[no], length, nbins, tableLog, writer, shared)
+        ends[:, i, 1] = (writer.tell() + 7) >> 3
+    state = rans.BatchStack(messages)
+    for i in reversed(range(len(levels))):
+        # having decoded levels[:i + 1], the decoder is back to the state before levels[i] was pushed
+        ends[:, i, 0] = state.count
+        if levels[i] in tansLevels:
+            continue
+        if shared:
+            no = levels[i]
+            for _i, lo, CDF in sharedCDF(f, no, batch, length, nbins, precision, None if windows is None else windows[no], chunk, True, None if params is None or no == len(params) else params[no]):
+                state = encodeLevel(CDF, parts[no][_i:_i + 1, lo:lo + CDF.shape[-1]], state, precision, None if windows is None else nbins)
+        else:
+            stream = streamCDF(f, batch, nbins, precision, length, windows, chunk, [levels[i]], reverse=True, params=params)
+            state = encodeStream(stream, parts, state, precision, None if windows is None else nbins)
+    ends[:, :, 0] = 2 + state.count.reshape(-1, 1) - ends[:, :, 0]
+    return state, writer, ends
+
+
+def _decodeShared(stream, state, precision, tableBits, nbins, batch):
+    # symbols of a level of the batch from a sharedCDF stream
+    symbols = [[] for _ in range(batch)]
+    for i, lo, CDF in stream:
+        state, _symbols = decodeLevel(CDF, state, precision, tableBits, nbins)
+        symbols[i].append(_symbols)
+        del CDF
+    return state, np.concatenate([np.concatenate(term, -1) for term in symbols], 0)
+
+
+def decodeLevels(f, state, reader, length, nbins, precision, levels, windows=None, chunk=4096, tableBits=8, tableLog=0, shared=None, params=None):
+    """Inverse of encodeLevels when every CDF is known before decoding, i.e.
+    static priors, params or the f.meanList of the last inverse. shared is
+    the number of images of a single message coded with shared."""
+    parts = {}
+    for no in levels:
+        if tansTable(f, no, length, nbins, tableLog) is not None:
+            parts[no] = tansDecode(f, no, length, nbins, tableLog, reader, shared)
+        elif shared:
+            state, parts[no] = _decodeShared(sharedCDF(f, no, shared, length, nbins, precision, None if windows is None else windows[no], chunk, params=None if params is None or no == len(params) else params[no]), state, precision, tableBits, None if windows is None else nbins, shared)
+        else:
+            stream = streamCDF(f, len(state), nbins, precision, length, windows, chunk, [no], params=params)
+            state, _parts = decodeStream(stream, state, precision, tableBits, None if windows is None else nbins)
+            parts[no] = _parts[0]
+    return state, [parts[no] for no in sorted(parts)]
+
+
+def analyze(f, x, HUE=True, nbins=4096, k=None):
+    """Runs f.inverse on images x of shape [batch, 3, length, length] (RGB,
+    0-255), returns the parts, the windows and the levelParams encodeImages
+    codes them with, so that f can take other images meanwhile."""
+    with torch.no_grad():
+        samples = x.float() if HUE else utils.rgb2ycc(x.float(), True, True)
+        z, _ = f.inverse(samples.to(f.decimal.scaling))
+        parts = divide(f, z, nbins)
+        windows = calWindows(f, x.shape[0], nbins, x.shape[-1], k)
+        params = levelParams(f, x.shape[0], x.shape[-1])
+    return parts, windows, params
+
+
+def encodeImages(f, parts, shape, fingerprint, HUE=True, nbins=4096, precision=24, windows=None, chunk=4096, tableLog=12, shared=False, params=None):
+    """Codes the analyze output of images of shape [3, length, length] into
+    Containers, see compress."""
+    lifting = isinstance(f, flow.LiftingMERA)
+    with torch.no_grad():
+        state, writer, ends = encodeLevels(f, parts, shape[-1], nbins, precision, reversed(range(len(parts))), windows, chunk, tableLog, shared, params)
+    if shared:
+        return [Container(fingerprint, shape, HUE, nbins, precision, state.flatten()[0], windows, tableLog, writer.flatten()[0], ends[0], count=parts[0].shape[0], lifting=lifting)]
+    return [Container(fingerprint, shape, HUE, nbins, precision, words, windows, tableLog, bits, _ends, lifting=lifting) for words, bits, _ends in zip(state.flatten(), writer.flatten(), ends)]
+
+
+def compress(f, x, fingerprint, HUE=True, nbins=4096, precision=24, k=None, chunk=4096, tableLog=12, tile=0, shared=False):
+    """Compresses images x of shape [batch, 3, length, length] (RGB, 0-255),
+    returns one Container per image.
+
+    Levels are coded coarsest first, so decompress can compute each level's
+    distribution from the levels decoded before it, and their ends are
+    indexed in the container for decoding a prefix of them. With a tile,
+    tiles of tile x tile sub-band pixels are coded apart for
+    decompressRegion, all with rANS. With shared, the batch is coded into a
+    single Container, sparing the flush of a rANS state per image. Files
+    coded with a flow.LiftingMERA are flagged as of the lifting tier.
+    """
+    if tile and shared:
+        raise Exception("Tiled containers hold a single image")
+    parts, windows, params = analyze(f, x, HUE, nbins, k)
+    if tile:
+        with torch.no_grad():
+            words, ends = encodeTiles(f, parts, x.shape[-1], nbins, precision, windows, tile, chunk)
+        return [Container(fingerprint, x.shape[1:], HUE, nbins, precision, _words, windows, 0, None, _ends, tile=tile, lifting=isinstance(f, flow.LiftingMERA)) for _words, _ends in zip(words, ends)]
+    return encodeImages(f, parts, x.shape[1:], fingerprint, HUE, nbins, precision, windows, chunk, tableLog, shared, params)
+
+
+def _checkModel(f, container, fingerprint=None):
+    if fingerprint is not None and fingerprint != container.fingerprint:
+        raise Exception("Container was coded with a different model")
+    if container.lifting != isinstance(f, flow.LiftingMERA):
+        raise Exception("Container was coded with " + ("the lifting tier" if container.lifting else "a learned flow"))
+
+
+def _codingKey(container):
+    # containers decodable in lockstep share all of these
+    return (container.shape, container.HUE, container.nbins, container.precision, tuple(container.windows or []), container.tableLog, container.tile, container.count, container.lifting)
+
+
+def decompressLevels(f, containers, fingerprint=None, tableBits=8, chunk=4096, levels=None):
+    """Decodes a Container, or a list of Containers coded alike, coarsest level
+    first. Each level's distributions come from the ul reconstructed so far
+    (meanNNlist/scaleNNlist) and its couplings are undone as soon as it is
+    decoded, both run once per level for the whole batch. Yields (no, ul)
+    after each level, ul being of shape [batch, 3, length // 2 ** no,
+    length // 2 ** no] in the flow's colour space. chunk counts the symbols of
+    the whole batch, so the CDF tables alive don't grow with it.
+
+    Only the levels coarsest levels are decoded if given, containers read
+    from a prefix of their files need to hold them."""
+    if isinstance(containers, Container):
+        containers = [containers]
+    for container in containers:
+        _checkModel(f, container, fingerprint)
+        if container.tile:
+            raise Exception("Tiled containers are decoded with decompressRegion")
+        if _codingKey(container) != _codingKey(containers[0]):
+            raise Exception("Containers coded with different parameters can't be decoded together")
+    container = containers[0]
+    shared = container.count if container.count > 1 else None
+    if shared and len(containers) > 1:
+        raise Exception("Containers of several images are decoded alone")
+    batch = shared or len(containers)
+    nbins = container.nbins
+    precision = container.precision
+    windows = container.windows
+    length = container.shape[-1]
+    depth = depthOf(f, length)
+    chunk = max(1, chunk // batch)
+    levels = depth if levels is None else levels
+    for term in containers:
+        if term.levels is not None and term.levels < levels:
+            raise Exception("Container holds only " + str(term.levels) + " levels")
+    if levels == 0:
+        return
+
+    state = rans.BatchStack.unflatten([term.words for term in containers])
+    reader = tans.BitReader([term.bits for term in containers])
+    with torch.no_grad():
+        for no in reversed(range(depth - levels, depth)):
+            window = None if windows is None else windows[no]
+            params = None if staticPrior(f, no, length) is not None else detailPriorParams(f, no, batch, length, ul)
+            if no == depth - 1:
+                offset = lastMean(f) - nbins // 2
+            else:
+                offset = detailMean(f, no, batch, length, params) - nbins // 2
+
+            if tansTable(f, no, length, nbins, container.tableLog) is not None:
+                symbols = tansDecode(f, no, length, nbins, container.tableLog, reader, shared)
+            elif shared:
+                state, symbols = _decodeShared(sharedCDF(f, no, batch, length, nbins, precision, window, chunk, params=params), state, precision, tableBits, None if windows is None else nbins, batch)
+            else:
+                if no == depth - 1:
+                    stream = [(0, lastCDF(f, batch, nbins, precision, window))]
+                else:
+                    stream = levelCDF(f, no, batch, length, nbins, precision, window, chunk, params=params)
+                symbols = []
+                for lo, CDF in stream:
+                    state, _symbols = decodeLevel(CDF, state, precision, tableBits, None if windows is None else nbins)
+                    symbols.append(_symbols)
+                    del CDF
+                symbols = np.concatenate(symbols, -1)
+            part = torch.from_numpy(symbols).to(offset).reshape(batch, *offset.shape[1:]) + offset
+            if no == depth - 1:
+                ul, ur, dl, dr = _ungroup(part)
+            else:
+                ur, dl, dr = _ungroup(part)
+            ul = f.forwardLevel(no, ul, ur, dl, dr)
+            yield no, ul
+
+
+def decompress(f, container, fingerprint=None, tableBits=8, chunk=4096):
+    """Decodes a Container back to images of shape [count, 3, length, length]."""
+    if container.tile:
+        return decompressRegion(f, container, None, fingerprint, tableBits, chunk)
+    return decompressBatch(f, [container], fingerprint, tableBits, chunk)[0]
+
+
+def preview(f, containers, levels, fingerprint=None, tableBits=8, chunk=4096):
+    """Decodes the levels coarsest levels of containers and fills the details
+    of the finer ones with their prior's rounded mean, as
+    SimpleMERA.inference does without sampling, returns full size images of
+    shape [batch, 3, length, length]."""
+    if isinstance(containers, Container):
+        containers = [containers]
+    batch = max(len(containers), containers[0].count)
+    length = containers[0].shape[-1]
+    depth = depthOf(f, length)
+    ul = None
+    for _, ul in decompressLevels(f, containers, fingerprint, tableBits, chunk, levels):
+        pass
+    with torch.no_grad():
+        if ul is None:
+            ul, ur, dl, dr = _ungroup(lastMean(f).expand(batch, -1, -1, -1))
+            ul = f.forwardLevel(depth - 1, ul, ur, dl, dr)
+            levels = 1
+        for no in reversed(range(depth - levels)):
+            ur, dl, dr = _ungroup(detailMean(f, no, batch, length, detailPriorParams(f, no, batch, length, ul) if staticPrior(f, no, length) is None else None))
+            ul = f.forwardLevel(no, ul, ur, dl, dr)
+    return ul.float() if containers[0].HUE else utils.ycc2rgb(ul.float(), True, True)
+
+
+def decompressBatch(f, containers, fingerprint=None, tableBits=8, chunk=256, batch=64):
+    """Decodes a list of Containers, up to batch of them in lockstep, returns
+    their images, of shape [count, 3, length, length], in the same order.
+    Containers are grouped by the parameters
+    they were coded with, only alike ones are decoded together.
+
+    Full nbins CDF tables are memory bound to build, keeping chunk (symbols
+    over the batch) small is faster than larger chunks."""
+    groups = {}
+    for i, container in enumerate(containers):
+        groups.setdefault(_codingKey(container), []).append(i)
+    out = [None] * len(containers)
+    for idx in groups.values():
+        if containers[idx[0]].tile:
+            for i in idx:
+                out[i] = decompressRegion(f, containers[i], None, fingerprint, tableBits, chunk)
+            continue
+        if containers[idx[0]].count > 1:
+            for i in idx:
+                for _, ul in decompressLevels(f, containers[i], fingerprint, tableBits, chunk):
+                    pass
+                out[i] = ul.float() if containers[i].HUE else utils.ycc2rgb(ul.float(), True, True)
+            continue
+        for lo in range(0, len(idx), batch):
+            _idx = idx[lo:lo + batch]
+            for _, ul in decompressLevels(f, [containers[i] for i in _idx], fingerprint, tableBits, chunk):
+                pass
+            ul = ul.float() if containers[_idx[0]].HUE else utils.ycc2rgb(ul.float(), True, True)
+            for i, term in zip(_idx, ul):
+                out[i] = term.unsqueeze(0)
+    return out
+
+
+def receptiveField(net):
+    """Radius of the neighbourhood an output pixel of net depends on, for
+    sequences of stride 1, odd sized convolutions and pointwise layers."""
+    if isinstance(net, torch.nn.Conv2d):
+        if any(term != 1 for term in net.stride) or any(term % 2 == 0 for term in net.kernel_size):
+            raise Exception("Can't bound the receptive field of " + str(net))
+        return max((k - 1) // 2 * d for k, d in zip(net.kernel_size, net.dilation))
+    if isinstance(net, torch.nn.Sequential):
+        return sum(receptiveField(term) for term in net)
+    if len(list(net.parameters())) == 0:
+        return 0
+    raise Exception("Can't bound the receptive field of " + str(net))
+
+
+def levelHalo(f, no, length):
+    """Halos, in sub-band pixels of level no, of its couplings (every step
+    reading the bands of the step before) and of the prior networks giving
+    its details' distributions from ul."""
+    if isinstance(f, flow.LiftingMERA):
+        coupling = f.halo
+    else:
+        coupling = sum(receptiveField(f.layerList[no * 4 * f.repeat + i]) for i in range(4 * f.repeat))
+    if staticPrior(f, no, length) is not None:
+        return coupling, 0
+    return coupling, max(receptiveField(f.meanNNlist[no]), receptiveField(f.scaleNNlist[no]))
+
+
+def tiles(size, tile):
+    """Rectangles (top, bottom, left, right) of the tiles of size x size sub-bands, row major."""
+    if not tile:
+        return [(0, size, 0, size)]
+    return [(y, min(y + tile, size), x, min(x + tile, size)) for y in range(0, size, tile) for x in range(0, size, tile)]
+
+
+def _crop(t, rect, origin=(0, 0)):
+    # rect of images t, of shape [..., h, w], whose pixel (0, 0) is at origin
+    return t[..., rect[0] - origin[0]:rect[1] - origin[0], rect[2] - origin[1]:rect[3] - origin[1]]
+
+
+def _tileCols(rect, size):
+    # symbols of a tile among the [3, size * size, 3] ones of its level
+    return _crop(np.arange(9 * size * size).reshape(3, size, size, 3).transpose([0, 3, 1, 2]), rect).transpose([0, 2, 3, 1]).reshape(-1)
+
+
+def _tileParams(params, batch, rect, size, origin=(0, 0)):
+    # detailPriorParams of a tile, params being those of size x size sub-bands starting at origin
+    return [_crop(term.reshape(batch, 3, size[0], size[1], 3).permute([0, 1, 4, 2, 3]), rect, origin).permute([0, 1, 3, 4, 2]).reshape(batch, -1) for term in params]
+
+
+def _expand(rect, halo, size):
+    return (max(rect[0] - halo, 0), min(rect[1] + halo, size), max(rect[2] - halo, 0), min(rect[3] + halo, size))
+
+
+def regionPlan(f, length, box, tile):
+    """What decoding the crop box = (top, bottom, left, right) of a tiled
+    image takes, for every detail level no (finest first): the sub-band
+    rectangle its couplings are undone on, the rectangle of ul needed
+    (the coarser image the level's prior networks run on) and the indices
+    of the tiles to decode."""
+    depth = depthOf(f, length)
+    plan = []
+    need = box
+    for no in range(depth - 1):
+        size = length // 2 ** (no + 1)
+        coupling, prior = levelHalo(f, no, length)
+        # sub-band pixels the crop of the finer image depends on
+        band = _expand((need[0] // 2, -(-need[1] // 2), need[2] // 2, -(-need[3] // 2)), coupling, size)
+        idx = [i for i, rect in enumerate(tiles(size, tile)) if rect[0] < band[1] and band[0] < rect[1] and rect[2] < band[3] and band[2] < rect[3]]
+        rects = [tiles(size, tile)[i] for i in idx]
+        cover = (min(r[0] for r in rects), max(r[1] for r in rects), min(r[2] for r in rects), max(r[3] for r in rects))
+        need = _expand(cover, prior, size)
+        plan.append((band, need, idx))
+    return plan
+
+
+def encodeTiles(f, parts, length, nbins, precision, windows=None, tile=32, chunk=4096):
+    """Codes parts, as given by divide, coarsest level first, every tile of
+    every level into a rANS state of its own. Returns the flattened states
+    of every image and the ends of its tiles in them, as Container segments."""
+    batch = parts[0].shape[0]
+    depth = len(parts)
+    escape = None if windows is None else nbins
+    segments = []
+    for no in reversed(range(depth)):
+        window = None if windows is None else windows[no]
+        if no == depth - 1:
+            segments.append(encodeLevel(lastCDF(f, batch, nbins, precision, window), parts[no], rans.BatchStack(batch), precision, escape).flatten())
+            continue
+        size = length // 2 ** (no + 1)
+        params = None if staticPrior(f, no, length) is not None else detailPriorParams(f, no, batch, length)
+        for rect in tiles(size, tile):
+            cols = _tileCols(rect, size)
+            _params = None if params is None else _tileParams(params, batch, rect, (size, size))
+            state = rans.BatchStack(batch)
+            for lo, CDF in levelCDF(f, no, batch, length, nbins, precision, window, chunk, True, _params, cols):
+                state = encodeLevel(CDF, parts[no][:, cols[lo:lo + CDF.shape[-1]]], state, precision, escape)
+            segments.append(state.flatten())
+    words = [np.concatenate([term[i] for term in segments]) for i in range(batch)]
+    ends = [np.stack([np.cumsum([term[i].shape[0] for term in segments]), np.zeros(len(segments), dtype=np.int64)], -1) for i in range(batch)]
+    return words, ends
+
+
+def _firstTiles(length, depth, tile):
+    # first segment of every detail level of a tiled container
+    first = {}
+    count = 1
+    for no in reversed(range(depth - 1)):
+        first[no] = count
+        count += len(tiles(length // 2 ** (no + 1), tile))
+    return first
+
+
+def _decodeLast(f, container, tableBits=8):
+    # ul of the finest but one level of a tiled container, from its first segment
+    depth = depthOf(f, container.shape[-1])
+    window = None if container.windows is None else container.windows[depth - 1]
+    state = rans.BatchStack.unflatten([container.segment(0)[0]])
+    _, symbols = decodeLevel(lastCDF(f, 1, container.nbins, container.precision, window), state, container.precision, tableBits, None if container.windows is None else container.nbins)
+    ul, ur, dl, dr = _ungroup(torch.from_numpy(symbols).to(lastMean(f)).reshape(1, 3, 1, 4) + lastMean(f) - container.nbins // 2)
+    return f.forwardLevel(depth - 1, ul, ur, dl, dr)
+
+
+def _decodeTile(f, container, no, segment, rect, params, need, tableBits=8, chunk=4096):
+    # details of the tile rect of level no, of shape [1, 3, 3, h, w], params being the detailPriorParams of ul cropped to need
+    nbins = container.nbins
+    length = container.shape[-1]
+    size = length // 2 ** (no + 1)
+    window = None if container.windows is None else container.windows[no]
+    if params is None:
+        _params = None
+        offset = _tileParams([detailMean(f, no, 1, length)], 1, rect, (size, size))[0]
+    else:
+        _params = _tileParams(params, 1, rect, (need[1] - need[0], need[3] - need[2]), need[::2])
+        offset = torch.round(f.decimal.forward_(_params[0]))
+    state = rans.BatchStack.unflatten([container.segment(segment)[0]])
+    symbols = []
+    for lo, CDF in levelCDF(f, no, 1, length, nbins, container.precision, window, chunk, params=_params, cols=_tileCols(rect, size)):
+        state, _symbols = decodeLevel(CDF, state, container.precision, tableBits, None if container.windows is None else nbins)
+        symbols.append(_symbols)
+    symbols = torch.from_numpy(np.concatenate(symbols, -1)).to(offset) + offset - nbins // 2
+    return symbols.reshape(1, 3, rect[1] - rect[0], rect[3] - rect[2], 3).permute([0, 1, 4, 2, 3])
+
+
+def decompressRegion(f, container, box=None, fingerprint=None, tableBits=8, chunk=4096):
+    """Decodes the crop box = (top, bottom, left, right) of a tiled Container,
+    the whole image if None, as an image of shape [1, 3, bottom - top,
+    right - left]. Only the tiles within the receptive field of the crop
+    (see regionPlan) are decoded and have their couplings undone."""
+    _checkModel(f, container, fingerprint)
+    if not container.tile:
+        raise Exception("Container is not tiled")
+    length = container.shape[-1]
+    depth = depthOf(f, length)
+    box = (0, length, 0, length) if box is None else tuple(int(term) for term in box)
+    if not (0 <= box[0] < box[1] <= length and 0 <= box[2] < box[3] <= length):
+        raise Exception("Crop out of the image")
+    plan = regionPlan(f, length, box, container.tile)
+    first = _firstTiles(length, depth, container.tile)
+
+    with torch.no_grad():
+        ul = _decodeLast(f, container, tableBits)
+        origin = (0, 0)
+
+        for no in reversed(range(depth - 1)):
+            size = length // 2 ** (no + 1)
+            band, need, idx = plan[no]
+            ul = _crop(ul, need, origin)
+            params = None if staticPrior(f, no, length) is not None else detailPriorParams(f, no, 1, length, ul)
+
+            rects = [tiles(size, container.tile)[i] for i in idx]
+            cover = (min(r[0] for r in rects), max(r[1] for r in rects), min(r[2] for r in rects), max(r[3] for r in rects))
+            details = ul.new_zeros([1, 3, 3, cover[1] - cover[0], cover[3] - cover[2]])
+            for i, rect in zip(idx, rects):
+                _crop(details, rect, cover[::2])[...] = _decodeTile(f, container, no, first[no] + i, rect, params, need, tableBits, chunk)
+
+            ur, dl, dr = [_crop(details[:, :, i], band, cover[::2]) for i in range(3)]
+            ul = f.forwardLevel(no, _crop(ul, band, need[::2]), ur, dl, dr)
+            origin = (2 * band[0], 2 * band[2])
+
+        x = _crop(ul, box, origin)
+    return x.float() if container.HUE else utils.ycc2rgb(x.float(), True, True)
+
+
+def loadFlow(folder, length=None, device=torch.device("cpu"), best=True, valbest=False, double=True):
+    """Loads a SimpleMERA saving of main.py, or a LiftingMERA one of main.py
+    -lifting, rebuilt for images of size length the way encode.py does.
+    Returns the flow, the checkpoint path and the folder's parameter.json."""
+    with open(os.path.join(folder, "parameter.json"), 'r') as f:
+        config = json.load(f)
+
+    if best and not valbest:
+        name = max(glob.iglob(os.path.join(folder, 'best_TrainLoss_model.saving')), key=os.path.getctime)
+    elif valbest:
+        name = max(glob.iglob(os.path.join(folder, 'best_TestLoss_model.saving')), key=os.path.getctime)
+    else:
+        name = max(glob.iglob(os.path.join(folder, 'savings', '*.saving')), key=os.path.getctime)
+
+    f = torch.load(name, map_location=device)
+    if not isinstance(f, flow.SimpleMERA):
+        raise Exception("model not define")
+
+    if isinstance(f, flow.LiftingMERA) and length is not None and int(math.log(length, 2)) != f.depth:
+        # the lifting steps are fixed and the detail priors shared between levels
+        prior = f.prior
+        if prior.priorList[0].mean.shape[2] != 1:
+            raise Exception("lifting model with a prior per pixel can't be rebuilt for another size")
+        f = flow.LiftingMERA(length, config['nMixing'], f.decimal, f.rounding).to(device)
+        f.prior.priorList = torch.nn.ModuleList([prior.priorList[0] for _ in range(f.depth - 1)] + [prior.priorList[-1]])
+    elif length is not None and not f.compatible and int(math.log(length, 2)) != f.depth:
+        if config.get('heavy', False):
+            raise Exception("heavy model can't be rebuilt for another size")
+        repeat = config['repeat']
+        layerList = [f.layerList[no] for no in range(4 * repeat)]
+        if f.meanNNlist is not None:
+            meanNNlist = [f.meanNNlist[0]]
+            scaleNNlist = [f.scaleNNlist[0]]
+        else:
+            meanNNlist = None
+            scaleNNlist = None
+
+        prior = f.prior
+        depth = int(math.log(length, 2))
+        if meanNNlist is None:
+            prior.priorList = torch.nn.ModuleList([prior.priorList[0] for _ in range(depth - 1)] + [prior.priorList[-1]])
+
+        f = flow.SimpleMERA(length, layerList, meanNNlist, scaleNNlist, repeat, None, config['nMixing'], decimal=flow.ScalingNshifting(256, -128), rounding=utils.roundingWidentityGradient).to(device)
+        if meanNNlist is not None:
+            f.prior.lastPrior = prior.lastPrior
+        else:
+            f.prior.priorList = prior.priorList
+
+    if double:
+        f = f.double()
+    return f, name, config
@@ -0,0 +1,122 @@
+'''
+Pipelines of stages, each run by a thread of its own and connected by bounded
+queues, so that stages using different resources (torch's intra-op threads,
+NumPy and Python) overlap across items.
+'''
+import queue
+import threading
+import time
+
+
+_end = object()
+
+
+class Pipeline(object):
+    """Runs items through stages, a list of (name, fn) with fn taking the
+    output of the stage before. Queues between stages hold at most maxsize
+    items, a stage ahead blocks until the next one takes its output, so no
+    more than about maxsize items per stage are alive. With maxsize 0 the
+    stages run one after the other in the calling thread.
+
+    times holds the seconds spent in every stage (and in drawing items), wall
+    the seconds of the last run.
+    """
+    def __init__(self, stages, maxsize=2):
+        self.stages = list(stages)
+        self.maxsize = maxsize
+        self.times = dict([('load', 0.)] + [(name, 0.) for name, _ in self.stages])
+        self.wall = 0.
+
+    def _timed(self, name, fn, item):
+        start = time.time()
+        item = fn(item)
+        self.times[name] += time.time() - start
+        return item
+
+    def _draw(self, items):
+        while True:
+            start = time.time()
+            try:
+                item = next(items)
+            except StopIteration:
+                return
+            self.times['load'] += time.time() - start
+            yield item
+
+    def run(self, items):
+        """Yields the outputs of the last stage, in the order of items."""
+        start = time.time()
+        try:
+            if self.maxsize <= 0:
+                for item in self._draw(iter(items)):
+                    for name, fn in self.stages:
+                        item = self._timed(name, fn, item)
+                    yield item
+            else:
+                yield from self._threaded(iter(items))
+        finally:
+            self.wall = time.time() - start
+
+    def _threaded(self, items):
+        stop = threading.Event()
+        error = []
+        queues = [queue.Queue(self.maxsize) for _ in range(len(self.stages) + 1)]
+
+        def put(q, item):
+            while not stop.is_set():
+                try:
+                    q.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def get(q):
+            while not stop.is_set():
+                try:
+                    return q.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+            return _end
+
+        def feed():
+            try:
+                for item in self._draw(items):
+                    if not put(queues[0], item):
+                        return
+            except BaseException as e:
+                error.append(e)
+                stop.set()
+                return
+            put(queues[0], _end)
+
+        def work(i, name, fn):
+            try:
+                while True:
+                    item = get(queues[i])
+                    if item is _end:
+                        break
+                    if not put(queues[i + 1], self._timed(name, fn, item)):
+                        return
+            except BaseException as e:
+                error.append(e)
+                stop.set()
+                return
+            put(queues[i + 1], _end)
+
+        threads = [threading.Thread(target=feed, daemon=True)]
+        threads += [threading.Thread(target=work, args=(i, name, fn), daemon=True) for i, (name, fn) in enumerate(self.stages)]
+        for thread in threads:
+            thread.start()
+        try:
+            while True:
+                item = get(queues[-1])
+                if item is _end:
+                    break
+                yield item
+        finally:
+            stop.set()
+            for thread in threads:
+                thread.join()
+        if error:
+            raise error[0]
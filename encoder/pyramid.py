@@ -0,0 +1,171 @@
+'''
+Stores of the wavelet pyramids SimpleMERA.inverse gives for a dataset, so
+that tools read the levels they need instead of running the flow again.
+
+A store is a folder holding index.json and a .npy file per level (int16 by default),
+read as memmaps: level<no>.npy, of shape [count, 3, n, 3], the (ur, dl, dr)
+details of level no (finest first, n = (length / 2 ** (no + 1)) ** 2 pixels
+in im2grp order) and ul.npy, of shape [count, 3, 1, 1], the last ul.
+index.json holds the length, count, depth and dtype of the arrays, the
+fingerprint of the model and whether images were RGB (HUE) or YCC.
+'''
+import json
+import os
+import numpy as np
+import torch
+
+import utils
+from flow.hierarchy.mera import im2grp, grp2im, reform
+
+from . import mera
+
+
+INDEX = 'index.json'
+
+
+def _levelPath(folder, no):
+    return os.path.join(folder, 'ul.npy' if no is None else 'level' + str(no) + '.npy')
+
+
+class PyramidWriter(object):
+    """Creates a store of count images of size length, filled by add, of
+    depth levels, log2(length) by default."""
+    def __init__(self, folder, count, length, fingerprint=b'', HUE=True, dtype=np.int16, depth=None):
+        os.makedirs(folder, exist_ok=True)
+        self.folder = folder
+        self.depth = int(np.log2(length)) if depth is None else depth
+        self.dtype = np.dtype(dtype)
+        self.index = {'length': length, 'count': count, 'depth': self.depth, 'dtype': self.dtype.name, 'fingerprint': bytes(fingerprint).hex(), 'HUE': bool(HUE), 'filled': 0}
+        self.levels = [np.lib.format.open_memmap(_levelPath(folder, no), mode='w+', dtype=self.dtype, shape=(count, 3, (length // 2 ** (no + 1)) ** 2, 3)) for no in range(self.depth)]
+        size = length // 2 ** self.depth
+        self.ul = np.lib.format.open_memmap(_levelPath(folder, None), mode='w+', dtype=self.dtype, shape=(count, 3, size, size))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _store(self, array, t):
+        info = np.iinfo(self.dtype)
+        if t.numel() and (t.min() < info.min or t.max() > info.max):
+            raise Exception("Pyramid values out of the " + self.dtype.name + " range")
+        array[self.index['filled']:self.index['filled'] + t.shape[0]] = t.cpu().numpy().astype(self.dtype)
+
+    def add(self, z):
+        """Appends the pyramids of z, of shape [batch, 3, length, length], as
+        given by f.inverse."""
+        if self.index['filled'] + z.shape[0] > self.index['count']:
+            raise Exception("Pyramid store is full")
+        ul = torch.round(z)
+        if z.shape[-1] != self.index['length']:
+            raise Exception("Expected images of size " + str(self.index['length']))
+        for no in range(self.depth):
+            _x = im2grp(ul)
+            self._store(self.levels[no], _x[:, :, :, 1:])
+            ul = _x[:, :, :, 0].reshape(*_x.shape[:2], int(_x.shape[2] ** 0.5), int(_x.shape[2] ** 0.5))
+        self._store(self.ul, ul)
+        self.index['filled'] += z.shape[0]
+
+    def close(self):
+        for array in self.levels + [self.ul]:
+            array.flush()
+        with open(os.path.join(self.folder, INDEX), 'w') as f:
+            json.dump(self.index, f)
+
+
+def build(f, loader, folder, fingerprint=b'', HUE=True, count=None, dtype=np.int16):
+    """Runs f.inverse once over the batches of images (RGB, 0-255) of loader
+    and stores the pyramids, of count images, all of them by default. The
+    store has the size of the images and the levels f divides them in."""
+    if count is None:
+        count = len(loader.dataset)
+    length = loader.dataset[0][0].shape[-1]
+    with PyramidWriter(folder, count, length, fingerprint, HUE, dtype, mera.depthOf(f, length)) as writer:
+        with torch.no_grad():
+            for samples, _ in loader:
+                samples = samples[:count - writer.index['filled']].to(next(f.parameters()))
+                if not HUE:
+                    samples = utils.rgb2ycc(samples, True, True)
+                z, _ = f.inverse(samples)
+                writer.add(z)
+                if writer.index['filled'] >= count:
+                    break
+    return Pyramid(folder)
+
+
+class Pyramid(object):
+    """Reads a store, mapping the arrays of the levels asked for only."""
+    def __init__(self, folder):
+        self.folder = folder
+        with open(os.path.join(folder, INDEX), 'r') as f:
+            self.index = json.load(f)
+        self.length = self.index['length']
+        self.depth = self.index['depth']
+        self.fingerprint = bytes.fromhex(self.index['fingerprint'])
+        self.HUE = self.index['HUE']
+        self._arrays = {}
+
+    def __len__(self):
+        return self.index['filled']
+
+    def _array(self, no):
+        if no not in self._arrays:
+            self._arrays[no] = np.load(_levelPath(self.folder, no), mmap_mode='r')
+        return self._arrays[no]
+
+    def details(self, no, idx=slice(None)):
+        """(ur, dl, dr) details of level no of images idx, of shape [k, 3, n, 3]."""
+        if not 0 <= no < self.depth:
+            raise Exception("No level " + str(no) + " in pyramid of depth " + str(self.depth))
+        return self._array(no)[:len(self)][idx]
+
+    def bands(self, no, idx=slice(None)):
+        """ur, dl and dr of level no of images idx, as [k, 3, size, size] images."""
+        details = self.details(no, idx)
+        size = self.length // 2 ** (no + 1)
+        return [details[:, :, :, i].reshape(*details.shape[:2], size, size) for i in range(3)]
+
+    def ul(self, no=None, idx=slice(None)):
+        """Part of z of images idx that level no is split from, of shape
+        [k, 3, size, size] with size = length / 2 ** no, the last ul if None.
+        Only the coarser levels are read. This is the latent of the coarser
+        levels, images gives the image the flow splits."""
+        ul = torch.from_numpy(np.array(self._array(None)[:len(self)][idx], dtype=np.float64))
+        for _no in reversed(range(self.depth if no is None else no, self.depth)):
+            details = torch.from_numpy(np.array(self.details(_no, idx), dtype=np.float64))
+            ul = grp2im(torch.cat([ul.reshape(*ul.shape[:2], -1, 1), details], -1)).contiguous()
+        return ul
+
+    def z(self, idx=slice(None)):
+        """Whole z of images idx, as f.inverse gave it."""
+        return self.ul(0, idx)
+
+    def images(self, f, idx=slice(None), stop=0):
+        """Yields (no, ul) for no from depth - 1 down to stop, ul being the
+        image of images idx that level no is split from, as f.forwardLevel
+        rebuilds it from the coarser levels (see mera.decompressLevels). The
+        prior of level no - 1 depends on it, and ul of level 0 is the image
+        f.inverse was given (in YCC if not HUE)."""
+        ref = next(f.parameters())
+        ul = torch.from_numpy(np.array(self._array(None)[:len(self)][idx])).to(ref)
+        with torch.no_grad():
+            for no in reversed(range(stop, self.depth)):
+                ur, dl, dr = mera._ungroup(torch.from_numpy(np.array(self.details(no, idx))).to(ref))
+                ul = f.forwardLevel(no, ul, ur, dl, dr)
+                yield no, ul
+
+    def inverse(self, f, idx=slice(None)):
+        """z and logp of images idx as f.inverse gives them, leaving the
+        priors' parameters in f.meanList and f.scaleList alike. Only the
+        coarser levels, that the priors depend on, go through f."""
+        f.meanList = []
+        f.scaleList = []
+        if f.meanNNlist is not None and f.scaleNNlist is not None:
+            images = dict(self.images(f, idx, 1))
+            with torch.no_grad():
+                for no in range(self.depth - 1):
+                    f.meanList.append(reform(f.meanNNlist[no](f.decimal.inverse_(images[no + 1]))).contiguous())
+                    f.scaleList.append(reform(f.scaleNNlist[no](f.decimal.inverse_(images[no + 1]))).contiguous())
+        z = self.z(idx).to(next(f.parameters()))
+        return z, z.new_zeros(z.shape[0])
@@ -12,7 +12,8 @@ We use the pythonic names 'append' and 'pop' for encoding and decoding
 respectively. The compressed state 'x' is an immutable stack, implemented using
 a cons list.
 
-x: the current stack-like state of the encoder/decoder.
+x: the current stack-like state of the encoder/decoder. Either the cons list
+or a Stack, which keeps the same words in a preallocated uint32 buffer.
 
 precision: the natural numbers are divided into ranges of size 2^precision.
 
@@ -33,6 +34,8 @@ def append(x, start, freq, precision):
     """Encodes a symbol with range [start, start + freq).  All frequencies are
     assumed to sum to "1 << precision", and the resulting bits get written to
     x."""
+    if isinstance(x, Stack):
+        return x.append(start, freq, precision)
     if x[0] >= ((rans_l >> precision) << 32) * freq:
         x = (x[0] >> 32, (x[0] & tail_bits, x[1]))
     return ((x[0] // freq) << precision) + (x[0] % freq) + start, x[1]
@@ -40,6 +43,8 @@ def append(x, start, freq, precision):
 def pop(x_, precision):
     """Advances in the bit stream by "popping" a single symbol with range start
     "start" and frequency "freq"."""
+    if isinstance(x_, Stack):
+        return x_.pop(precision)
     cf = x_[0] & ((1 << precision) - 1)
     def pop(start, freq):
         x = freq * (x_[0] >> precision) + cf - start, x_[1]
@@ -61,7 +66,9 @@ def pop_symbol(statfun, precision):
 
 def flatten(x):
     """Flatten a rans state x into a 1d numpy array."""
-    out, x = [np.uint32(x[0] >> 32), np.uint32(x[0])], x[1]
+    if isinstance(x, Stack):
+        return x.flatten()
+    out, x = [np.uint32(x[0] >> 32), np.uint32(x[0] & tail_bits)], x[1]
     while x:
         x_head, x = x
         out.append(np.uint32(x_head))
@@ -70,4 +77,161 @@ def flatten(x):
 def unflatten(arr):
     """Unflatten a 1d numpy array into a rans state."""
     return (int(arr[0]) << 32 | int(arr[1]),
-            reduce(lambda tl, hd: (int(hd), tl), reversed(arr[2:]), ()))
\ No newline at end of file
+            reduce(lambda tl, hd: (int(hd), tl), reversed(arr[2:]), ()))
+
+
+class Stack(object):
+    """rANS state of a single message backed by a growable uint32 buffer.
+
+    Words are written downwards from the end of buf, so buf[ptr:] is always the
+    tail of flatten's layout (newest word first) and flatten/unflatten are
+    slices instead of copies. A buffer shared with an array given to unflatten
+    or returned by flatten is copied before it is written to.
+    """
+    def __init__(self, capacity=1024):
+        self.x = rans_l
+        self.buf = np.zeros(capacity + 2, dtype=np.uint32)
+        self.ptr = self.buf.shape[0]
+        self.owned = True
+
+    def __len__(self):
+        return self.buf.shape[0] - self.ptr + 2
+
+    def _reserve(self, n):
+        # make room for n more words and the two head words in front of them
+        if self.ptr - n < 2 or not self.owned:
+            size = self.buf.shape[0] - self.ptr
+            capacity = max(size + n, 2 * size) + 2 if self.ptr - n < 2 else self.buf.shape[0]
+            buf = np.zeros(capacity, dtype=np.uint32)
+            buf[capacity - size:] = self.buf[self.ptr:]
+            self.buf = buf
+            self.ptr = capacity - size
+            self.owned = True
+
+    def append(self, start, freq, precision):
+        if self.x >= ((rans_l >> precision) << 32) * freq:
+            self._reserve(1)
+            self.ptr -= 1
+            self.buf[self.ptr] = self.x & tail_bits
+            self.x >>= 32
+        self.x = ((self.x // freq) << precision) + (self.x % freq) + start
+        return self
+
+    def pop(self, precision):
+        cf = self.x & ((1 << precision) - 1)
+
+        def pop(start, freq):
+            self.x = freq * (self.x >> precision) + cf - start
+            if self.x < rans_l:
+                self.x = (self.x << 32) | int(self.buf[self.ptr])
+                self.ptr += 1
+            return self
+        return cf, pop
+
+    def flatten(self):
+        self._reserve(0)
+        self.buf[self.ptr - 2] = self.x >> 32
+        self.buf[self.ptr - 1] = self.x & tail_bits
+        self.owned = False
+        return self.buf[self.ptr - 2:]
+
+    @classmethod
+    def unflatten(cls, arr):
+        stack = cls(0)
+        stack.x = int(arr[0]) << 32 | int(arr[1])
+        stack.buf = np.asarray(arr, dtype=np.uint32)
+        stack.ptr = 2
+        stack.owned = False
+        return stack
+
+
+class BatchStack(object):
+    """rANS states of a batch of messages, advanced in lockstep.
+
+    x holds the 64-bit head of every message, the 32-bit words a message has
+    pushed are kept in its row of buf with the newest one at buf[i, count[i] - 1].
+    idx, when given, restricts an operation to those messages; start & freq are
+    then of the same length as idx.
+    """
+    def __init__(self, batchSize, capacity=1024):
+        self.x = np.full(batchSize, rans_l, dtype=np.uint64)
+        self.buf = np.zeros((batchSize, capacity), dtype=np.uint32)
+        self.count = np.zeros(batchSize, dtype=np.int64)
+
+    def __len__(self):
+        return self.x.shape[0]
+
+    def _reserve(self, n):
+        if n > self.buf.shape[1]:
+            buf = np.zeros((self.buf.shape[0], max(n, 2 * self.buf.shape[1])), dtype=np.uint32)
+            buf[:, :self.buf.shape[1]] = self.buf
+            self.buf = buf
+
+    def append(self, start, freq, precision, idx=None):
+        if idx is None:
+            idx = np.arange(len(self))
+        start = np.asarray(start).astype(np.uint64)
+        freq = np.asarray(freq).astype(np.uint64)
+        x = self.x[idx]
+        flush = x >= np.uint64((rans_l >> precision) << 32) * freq
+        if flush.any():
+            rows = idx[flush]
+            self._reserve(self.count[rows].max() + 1)
+            self.buf[rows, self.count[rows]] = (x[flush] & np.uint64(tail_bits)).astype(np.uint32)
+            self.count[rows] += 1
+            x[flush] >>= np.uint64(32)
+        self.x[idx] = ((x // freq) << np.uint64(precision)) + (x % freq) + start
+        return self
+
+    def pop(self, precision, idx=None):
+        if idx is None:
+            idx = np.arange(len(self))
+        x = self.x[idx]
+        cf = x & np.uint64((1 << precision) - 1)
+
+        def pop(start, freq):
+            start = np.asarray(start).astype(np.uint64)
+            freq = np.asarray(freq).astype(np.uint64)
+            x_ = freq * (x >> np.uint64(precision)) + cf - start
+            refill = x_ < np.uint64(rans_l)
+            if refill.any():
+                rows = idx[refill]
+                self.count[rows] -= 1
+                x_[refill] = (x_[refill] << np.uint64(32)) | self.buf[rows, self.count[rows]].astype(np.uint64)
+            self.x[idx] = x_
+            return self
+        return cf.astype(np.int64), pop
+
+    def flatten(self):
+        """Flatten every message into a 1d numpy array, laid out as flatten(x)."""
+        out = []
+        for i in range(len(self)):
+            head = np.array([self.x[i] >> np.uint64(32), self.x[i] & np.uint64(tail_bits)], dtype=np.uint32)
+            out.append(np.concatenate([head, self.buf[i, :self.count[i]][::-1]]))
+        return out
+
+    @classmethod
+    def unflatten(cls, arrs):
+        """Build a batch from 1d numpy arrays as returned by flatten."""
+        count = np.array([arr.shape[0] - 2 for arr in arrs], dtype=np.int64)
+        stack = cls(len(arrs), max(count.max(), 1))
+        for i, arr in enumerate(arrs):
+            stack.x[i] = np.uint64(arr[0]) << np.uint64(32) | np.uint64(arr[1])
+            stack.buf[i, :count[i]] = arr[2:][::-1]
+        stack.count = count
+        return stack
+
+
+
+def interleave(arrs):
+    """Pack the flattened states of one message coded by several interleaved
+    states into a single 1d numpy array: [n, len_0, ..., len_n-1, arrs...]."""
+    lengths = np.array([len(arrs)] + [arr.shape[0] for arr in arrs], dtype=np.uint32)
+    return np.concatenate([lengths] + list(arrs))
+
+
+def deinterleave(arr):
+    """Split an array packed by interleave back into the flattened states."""
+    n = int(arr[0])
+    ends = 1 + n + np.cumsum(arr[1:n + 1].astype(np.int64))
+    return [arr[end - int(length):end] for end, length in zip(ends, arr[1:n + 1])]
\ No newline at end of file
@@ -0,0 +1,142 @@
+'''
+Decoding of tiled containers overlapping entropy decoding with the flow: the
+couplings of a level are undone tile by tile on a thread pool, a tile's as
+soon as the tiles within its coupling halo are popped, while the rest of the
+level is still being popped.
+'''
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+
+import utils
+from . import mera
+
+
+def _half(rect):
+    # sub-band pixels under rect of the finer image
+    return (rect[0] // 2, -(-rect[1] // 2), rect[2] // 2, -(-rect[3] // 2))
+
+
+def _overlap(a, b):
+    return a[0] < b[1] and b[0] < a[1] and a[2] < b[3] and b[2] < a[3]
+
+
+class DecodeScheduler(object):
+    """Decodes tiled Containers as mera.decompressRegion, with workers
+    threads undoing couplings.
+
+    Tiles are popped one after the other in the calling thread. The prior
+    networks of a level still wait for the whole coarser level, as do the
+    tiles of the level.
+
+    After decode, times holds the seconds spent popping tiles ('pop'),
+    running the prior networks ('prior') and undoing couplings ('coupling'),
+    wall the seconds decode took and critical the length of its critical
+    path, i.e. what decode would take with a worker per tile. The sum of
+    times less wall is the latency hidden by the workers.
+    """
+    def __init__(self, f, workers=4):
+        self.f = f
+        self.pool = ThreadPoolExecutor(workers)
+        self.times = {'pop': 0., 'prior': 0., 'coupling': 0.}
+        self.wall = 0.
+        self.critical = 0.
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.pool.shutdown()
+
+    def _couple(self, no, ul, details, need, cover, part, inp, out, core):
+        # undoes the couplings of level no on inp, keeping the pixels of part
+        start = time.time()
+        with torch.no_grad():
+            ur, dl, dr = [mera._crop(details[:, :, i], inp, cover[::2]) for i in range(3)]
+            x = self.f.forwardLevel(no, mera._crop(ul, inp, need[::2]), ur, dl, dr)
+            x = mera._crop(x, [2 * term for term in part], (2 * inp[0], 2 * inp[2]))
+            mera._crop(out, [2 * term for term in part], (2 * core[0], 2 * core[2]))[...] = x
+        return time.time() - start
+
+    def decode(self, container, box=None, fingerprint=None, tableBits=8, chunk=4096):
+        """Crop box = (top, bottom, left, right) of a tiled Container, the
+        whole image if None, as an image of shape [1, 3, bottom - top, right -
+        left]."""
+        f = self.f
+        mera._checkModel(f, container, fingerprint)
+        if not container.tile:
+            raise Exception("Container is not tiled")
+        length = container.shape[-1]
+        depth = mera.depthOf(f, length)
+        box = (0, length, 0, length) if box is None else tuple(int(term) for term in box)
+        if not (0 <= box[0] < box[1] <= length and 0 <= box[2] < box[3] <= length):
+            raise Exception("Crop out of the image")
+        plan = mera.regionPlan(f, length, box, container.tile)
+        first = mera._firstTiles(length, depth, container.tile)
+        times = {'pop': 0., 'prior': 0., 'coupling': 0.}
+
+        begin = time.time()
+        with torch.no_grad():
+            ul = mera._decodeLast(f, container, tableBits)
+            # the critical path so far
+            clock = time.time() - begin
+            times['pop'] += clock
+            origin = (0, 0)
+
+            for no in reversed(range(depth - 1)):
+                size = length // 2 ** (no + 1)
+                band, need, idx = plan[no]
+                # the pixels of the band the finer level needs, band being them and their coupling halo
+                core = _half(box if no == 0 else plan[no - 1][1])
+                halo = mera.levelHalo(f, no, length)[0]
+                ul = mera._crop(ul, need, origin)
+
+                start = time.time()
+                params = None if mera.staticPrior(f, no, length) is not None else mera.detailPriorParams(f, no, 1, length, ul)
+                duration = time.time() - start
+                times['prior'] += duration
+                clock += duration
+
+                rects = [mera.tiles(size, container.tile)[i] for i in idx]
+                cover = (min(r[0] for r in rects), max(r[1] for r in rects), min(r[2] for r in rects), max(r[3] for r in rects))
+                details = ul.new_zeros([1, 3, 3, cover[1] - cover[0], cover[3] - cover[2]])
+                out = ul.new_zeros([1, 3, 2 * (core[1] - core[0]), 2 * (core[3] - core[2])])
+
+                # the part of every tile within core and the last tile its couplings read
+                tasks = {}
+                for rect in rects:
+                    part = (max(rect[0], core[0]), min(rect[1], core[1]), max(rect[2], core[2]), min(rect[3], core[3]))
+                    if part[0] >= part[1] or part[2] >= part[3]:
+                        continue
+                    inp = mera._expand(part, halo, size)
+                    last = max(j for j, _rect in enumerate(rects) if _overlap(_rect, inp))
+                    tasks.setdefault(last, []).append((part, inp))
+
+                futures = []
+                for j, (i, rect) in enumerate(zip(idx, rects)):
+                    start = time.time()
+                    mera._crop(details, rect, cover[::2])[...] = mera._decodeTile(f, container, no, first[no] + i, rect, params, need, tableBits, chunk)
+                    duration = time.time() - start
+                    times['pop'] += duration
+                    clock += duration
+                    for part, inp in tasks.get(j, []):
+                        futures.append((clock, self.pool.submit(self._couple, no, ul, details, need, cover, part, inp, out, core)))
+
+                for ready, future in futures:
+                    duration = future.result()
+                    times['coupling'] += duration
+                    clock = max(clock, ready + duration)
+
+                ul = out
+                origin = (2 * core[0], 2 * core[2])
+
+            x = mera._crop(ul, box, origin)
+
+        self.times = times
+        self.wall = time.time() - begin
+        self.critical = clock
+        return x.float() if container.HUE else utils.ycc2rgb(x.float(), True, True)
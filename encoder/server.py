@@ -0,0 +1,271 @@
+'''
+Compression as a local service: the flow is loaded once and requests are
+batched. Compress requests of images of the same size, and decompress
+requests of files coded alike, queue up until maxBatch of them are waiting
+or the oldest has waited deadline seconds, then go through the flow as one
+batch.
+
+The flow runs on a thread of its own, batch after batch. The rANS coding of
+compressed batches runs on a pool of workers threads, so the next batch goes
+through the flow meanwhile. Decoding interleaves the flow with entropy
+decoding level by level (see mera.decompressLevels) and runs on the flow's
+thread as a whole.
+
+With a cache.ContainerCache, images compressed before are answered from it
+and repeats of an image being compressed wait for its Container, neither
+going through the flow. The cache reads and writes its files on the pool.
+
+serve speaks a minimal HTTP/1.0 over TCP or a Unix socket:
+
+    POST /compress      an image file in, the NWF file out
+    POST /decompress    an NWF file in, the PNG image out
+    GET /metrics        queue depth, batch sizes and latency percentiles as JSON
+'''
+import asyncio
+import collections
+import io
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import torch
+from PIL import Image
+
+from . import mera
+from .cache import codingParams
+from .container import Container
+
+
+STATUS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed'}
+
+
+def readImage(data):
+    """Image file bytes as a tensor of shape [1, 3, length, length] (RGB, 0-255)."""
+    img = np.array(Image.open(io.BytesIO(data)).convert('RGB'))
+    if img.shape[0] != img.shape[1]:
+        raise Exception("Only square images are supported")
+    return torch.from_numpy(img).permute([2, 0, 1]).unsqueeze(0).float()
+
+
+def writeImage(x):
+    """PNG file bytes of an image of shape [1, 3, length, length]."""
+    img = torch.clamp(torch.round(x[0]), 0, 255).permute([1, 2, 0]).cpu().numpy().astype(np.uint8)
+    out = io.BytesIO()
+    Image.fromarray(img).save(out, format='PNG')
+    return out.getvalue()
+
+
+class BatchingServer(object):
+    """Batches compress and decompress requests on a flow, load(length)
+    giving the flow for images of size length, called once per size.
+
+    metrics() reports the requests waiting in the queues ('queue') and in
+    the flow or the coders ('inflight'), the number of batches run, the
+    histogram of their sizes and, over the last history requests of each
+    kind, latency percentiles in milliseconds, of the batched requests.
+    """
+    def __init__(self, load, fingerprint, HUE=True, maxBatch=16, deadline=0.02, workers=4, nbins=4096, precision=24, k=None, chunk=4096, tableLog=12, tableBits=8, history=1000, cache=None):
+        self.load = load
+        self.fingerprint = fingerprint
+        self.HUE = HUE
+        self.maxBatch = maxBatch
+        self.deadline = deadline
+        self.nbins = nbins
+        self.precision = precision
+        self.k = k
+        self.chunk = chunk
+        self.tableLog = tableLog
+        self.tableBits = tableBits
+        self.cache = cache
+        self.coding = {}
+        self.flows = {}
+        self.model = ThreadPoolExecutor(1)
+        self.pool = ThreadPoolExecutor(workers)
+        self.queues = {}
+        self.timers = {}
+        self.tasks = set()
+        self.depth = 0
+        self.inflight = 0
+        self.batches = collections.Counter()
+        self.latency = {'compress': collections.deque(maxlen=history), 'decompress': collections.deque(maxlen=history)}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.model.shutdown()
+        self.pool.shutdown()
+
+    def _flow(self, length):
+        # only called on the flow's thread
+        if length not in self.flows:
+            self.flows[length] = self.load(length)
+        return self.flows[length]
+
+    async def compress(self, x):
+        """Container of an image of shape [1, 3, length, length] (RGB, 0-255)."""
+        if x.dim() != 4 or x.shape[0] != 1 or x.shape[1] != 3 or x.shape[2] != x.shape[3]:
+            raise Exception("Expected an image of shape [1, 3, length, length]")
+        if self.cache is None:
+            return await self._submit(('compress', x.shape[-1]), x)
+        key = self.cache.key(x[0], self.fingerprint, **codingParams(self.HUE, self.nbins, self.precision, self.k, self.tableLog))
+        task = self.coding.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self._cached(key, x))
+            self.coding[key] = task
+            task.add_done_callback(lambda task: self.coding.pop(key))
+        else:
+            with self.cache.lock:
+                self.cache.refs += 1
+        return await asyncio.shield(task)
+
+    async def _cached(self, key, x):
+        # the cache's files are read and written (fsynced) on the pool, not to block the event loop
+        loop = asyncio.get_running_loop()
+        container = await loop.run_in_executor(self.pool, self.cache.get, key)
+        if container is None:
+            container = await self._submit(('compress', x.shape[-1]), x)
+            await loop.run_in_executor(self.pool, self.cache.put, key, container)
+        return container
+
+    async def decompress(self, container):
+        """Image of shape [1, 3, length, length] of a single image Container."""
+        if container.fingerprint != self.fingerprint:
+            raise Exception("Container was coded with a different model")
+        if container.count > 1:
+            raise Exception("Containers of several images are decoded alone")
+        return await self._submit(('decompress',) + mera._codingKey(container), container)
+
+    async def _submit(self, key, item):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        queue = self.queues.setdefault(key, [])
+        queue.append((item, future, time.time()))
+        self.depth += 1
+        if len(queue) >= self.maxBatch:
+            self._flush(key)
+        elif len(queue) == 1:
+            self.timers[key] = loop.call_later(self.deadline, self._flush, key)
+        return await future
+
+    def _flush(self, key):
+        requests = self.queues.pop(key, [])
+        timer = self.timers.pop(key, None)
+        if timer is not None:
+            timer.cancel()
+        if not requests:
+            return
+        self.depth -= len(requests)
+        self.inflight += len(requests)
+        task = asyncio.get_running_loop().create_task(self._run(key, requests))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    @torch.no_grad()
+    def _analyze(self, x):
+        f = self._flow(x.shape[-1])
+        return f, mera.analyze(f, x, self.HUE, self.nbins, self.k)
+
+    @torch.no_grad()
+    def _encode(self, f, shape, parts, windows, params):
+        return mera.encodeImages(f, parts, shape, self.fingerprint, self.HUE, self.nbins, self.precision, windows, self.chunk, self.tableLog, params=params)
+
+    @torch.no_grad()
+    def _decode(self, containers):
+        f = self._flow(containers[0].shape[-1])
+        return mera.decompressBatch(f, containers, self.fingerprint, self.tableBits, self.chunk, len(containers))
+
+    async def _run(self, key, requests):
+        loop = asyncio.get_running_loop()
+        items = [item for item, _, _ in requests]
+        try:
+            if key[0] == 'compress':
+                f, (parts, windows, params) = await loop.run_in_executor(self.model, self._analyze, torch.cat(items, 0))
+                results = await loop.run_in_executor(self.pool, self._encode, f, items[0].shape[1:], parts, windows, params)
+            else:
+                results = await loop.run_in_executor(self.model, self._decode, items)
+        except Exception as e:
+            for _, future, _ in requests:
+                if not future.done():
+                    future.set_exception(e)
+        else:
+            for (_, future, _), result in zip(requests, results):
+                if not future.done():
+                    future.set_result(result)
+        finally:
+            now = time.time()
+            self.inflight -= len(requests)
+            self.batches[len(requests)] += 1
+            self.latency[key[0]].extend(now - arrival for _, _, arrival in requests)
+
+    def metrics(self):
+        latency = {}
+        for kind, times in self.latency.items():
+            times = np.array(times) * 1000
+            latency[kind] = {'count': len(times)}
+            if len(times):
+                latency[kind].update({'p' + str(q): float(np.percentile(times, q)) for q in [50, 90, 99]})
+        count = sum(self.batches.values())
+        metrics = {
+            'queue': self.depth,
+            'inflight': self.inflight,
+            'batches': count,
+            'meanBatch': sum(size * n for size, n in self.batches.items()) / count if count else 0.,
+            'batchSizes': {str(size): n for size, n in sorted(self.batches.items())},
+            'latency': latency,
+        }
+        if self.cache is not None:
+            with self.cache.lock:
+                metrics['cache'] = {'hits': self.cache.hits, 'misses': self.cache.misses, 'refs': self.cache.refs, 'images': len(self.cache), 'bytes': self.cache.size}
+        return metrics
+
+    async def _respond(self, method, path, body):
+        loop = asyncio.get_running_loop()
+        if path == '/metrics':
+            return 200, 'application/json', json.dumps(self.metrics()).encode()
+        if path not in ['/compress', '/decompress']:
+            return 404, 'text/plain', b'Not found'
+        if method != 'POST':
+            return 405, 'text/plain', b'Use POST'
+        if path == '/compress':
+            x = await loop.run_in_executor(self.pool, readImage, body)
+            return 200, 'application/octet-stream', (await self.compress(x)).toBytes()
+        x = await self.decompress(Container.fromBytes(body))
+        return 200, 'image/png', await loop.run_in_executor(self.pool, writeImage, x)
+
+    async def handle(self, reader, writer):
+        """Serves a request of a connection, as asyncio.start_server callback."""
+        try:
+            method, path, _ = (await reader.readline()).decode('latin-1').split(' ', 2)
+            length = 0
+            while True:
+                line = (await reader.readline()).decode('latin-1').strip()
+                if not line:
+                    break
+                name, _, value = line.partition(':')
+                if name.strip().lower() == 'content-length':
+                    length = int(value)
+            body = await reader.readexactly(length)
+            try:
+                status, contentType, out = await self._respond(method, path.split('?')[0], body)
+            except Exception as e:
+                status, contentType, out = 400, 'text/plain', str(e).encode()
+            writer.write(('HTTP/1.0 ' + str(status) + ' ' + STATUS[status] + '\r\nContent-Type: ' + contentType + '\r\nContent-Length: ' + str(len(out)) + '\r\n\r\n').encode('latin-1') + out)
+            await writer.drain()
+        except (ValueError, ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, host='127.0.0.1', port=8000, path=None):
+        """Serves on host:port, or on the Unix socket path if given, until cancelled."""
+        if path is not None:
+            server = await asyncio.start_unix_server(self.handle, path)
+        else:
+            server = await asyncio.start_server(self.handle, host, port)
+        async with server:
+            await server.serve_forever()
@@ -0,0 +1,187 @@
+'''
+Table-based ANS (tANS, as in FSE) for symbols whose distributions are known
+before decoding and shared by many symbols.
+
+A Table holds, for each of D distributions over the same alphabet quantized to
+1 << tableLog, the spread of symbols over the 1 << tableLog states. Decoding a
+symbol is a lookup of (symbol, nbBits, newBase) by state and a read of nbBits
+bits. The symbols of a message are dealt round robin to lanes, which share the
+message's bitstream and are advanced together over the batch.
+'''
+import numpy as np
+
+
+def bitLength(x):
+    # bit length of positive integers below 2 ** 53
+    return np.frexp(np.asarray(x, dtype=np.float64))[1].astype(np.int64)
+
+
+def nlanes(n, lanes):
+    # every lane costs tableLog bits for its final state, short segments get fewer
+    return max(1, min(lanes, n // 256))
+
+
+class Table(object):
+    """Coding tables of distributions freq, of shape [D, nsymbols], every row
+    summing to 1 << tableLog."""
+    def __init__(self, freq, tableLog):
+        freq = np.asarray(freq, dtype=np.int64)
+        L = 1 << tableLog
+        if (freq.sum(1) != L).any() or (freq < 0).any():
+            raise Exception("tANS frequencies must sum to 1 << tableLog")
+        self.tableLog = tableLog
+        self.freq = freq
+        self.cum = np.concatenate([np.zeros([freq.shape[0], 1], dtype=np.int64), np.cumsum(freq, 1)[:, :-1]], 1)
+
+        # the i-th slot, in symbol order, goes to state i * step, a permutation as step is odd
+        step = (L >> 1) + (L >> 3) + 3
+        position = (np.arange(L, dtype=np.int64) * step) & (L - 1)
+        self.sym = np.empty([freq.shape[0], L], dtype=np.int64)
+        self.stateTable = np.empty([freq.shape[0], L], dtype=np.int64)
+        rank = np.empty([freq.shape[0], L], dtype=np.int64)
+        for d in range(freq.shape[0]):
+            self.sym[d, position] = np.repeat(np.arange(freq.shape[1]), freq[d])
+            # states of every symbol in increasing order, the k-th of symbol s is reached from y = freq[s] + k
+            self.stateTable[d] = np.argsort(self.sym[d], kind='stable')
+            rank[d, self.stateTable[d]] = np.arange(L)
+        y = self.freq[np.arange(freq.shape[0]).reshape(-1, 1), self.sym] + rank - self.cum[np.arange(freq.shape[0]).reshape(-1, 1), self.sym]
+        self.nbBits = tableLog + 1 - bitLength(y)
+        self.newBase = (y << self.nbBits) - L
+
+
+class BitWriter(object):
+    """Bitstreams of a batch of messages, written MSB first."""
+    def __init__(self, batchSize):
+        self.values = [[] for _ in range(batchSize)]
+        self.nbits = [[] for _ in range(batchSize)]
+
+    def write(self, values, nbits):
+        # values and nbits of shape [batch, m], nbits at most 32
+        for i in range(len(self.values)):
+            self.values[i].append(np.asarray(values[i], dtype=np.uint64).reshape(-1))
+            self.nbits[i].append(np.asarray(nbits[i], dtype=np.int64).reshape(-1))
+
+    def tell(self):
+        """Bits written so far to every message."""
+        return np.array([sum(int(term.sum()) for term in nbits) for nbits in self.nbits], dtype=np.int64)
+
+    def flatten(self):
+        """Returns the packed bitstream of every message as uint8 arrays."""
+        out = []
+        for values, nbits in zip(self.values, self.nbits):
+            values = np.concatenate(values) if values else np.zeros(0, dtype=np.uint64)
+            nbits = np.concatenate(nbits) if nbits else np.zeros(0, dtype=np.int64)
+            keep = nbits > 0
+            values, nbits = values[keep], nbits[keep]
+            end = np.cumsum(nbits)
+            total = int(end[-1]) if end.shape[0] else 0
+            words = np.zeros((total >> 6) + 2, dtype=np.uint64)
+            word = (end - nbits) >> 6
+            end = end - (word << 6)
+            fit = end <= 64
+            np.bitwise_or.at(words, word[fit], values[fit] << (64 - end[fit]).astype(np.uint64))
+            spill = ~fit
+            np.bitwise_or.at(words, word[spill], values[spill] >> (end[spill] - 64).astype(np.uint64))
+            np.bitwise_or.at(words, word[spill] + 1, values[spill] << (128 - end[spill]).astype(np.uint64))
+            out.append(np.frombuffer(words.astype('>u8').tobytes(), dtype=np.uint8)[:(total + 7) >> 3].copy())
+        return out
+
+
+class BitReader(object):
+    """Reads the bitstreams of BitWriter.flatten, a batch of messages at a time."""
+    def __init__(self, streams):
+        words = []
+        base = []
+        offset = 0
+        for stream in streams:
+            stream = np.asarray(stream, dtype=np.uint8)
+            # room for reading a word past the end
+            padded = np.zeros(((stream.shape[0] + 7) >> 3 << 3) + 16, dtype=np.uint8)
+            padded[:stream.shape[0]] = stream
+            words.append(np.frombuffer(padded.tobytes(), dtype='>u8').astype(np.uint64))
+            base.append(offset << 6)
+            offset += words[-1].shape[0]
+        self.words = np.concatenate(words) if words else np.zeros(2, dtype=np.uint64)
+        self.base = np.asarray(base, dtype=np.int64)
+        self.pos = np.zeros(len(streams), dtype=np.int64)
+
+    def __len__(self):
+        return self.pos.shape[0]
+
+    def read(self, nbits):
+        """Reads values of nbits ([batch, m], at most 32) in row order."""
+        nbits = np.asarray(nbits, dtype=np.int64)
+        pos = self.base.reshape(-1, 1) + self.pos.reshape(-1, 1) + np.cumsum(nbits, 1) - nbits
+        word = pos >> 6
+        offset = (pos & 63).astype(np.uint64)
+        # the 64 bits starting at pos, shifts split in two to stay below 64
+        window = (self.words[word] << offset) | ((self.words[word + 1] >> np.uint64(1)) >> (np.uint64(63) - offset))
+        self.pos += nbits.sum(1)
+        return ((window >> np.uint64(1)) >> (63 - nbits).astype(np.uint64)).astype(np.int64)
+
+
+def encode(table, dists, symbols, writer, lanes=32, raw=None, rawBits=0):
+    """Writes symbols ([batch, n]) to writer, symbol j coded with distribution
+    dists[j]. With rawBits, raw[:, j] follows in rawBits bits whenever symbol j
+    is the last symbol of the alphabet (an escape)."""
+    batchSize, n = symbols.shape
+    K = nlanes(n, lanes)
+    S = -(-n // K)
+    L = 1 << table.tableLog
+    escape = table.freq.shape[1] - 1
+
+    # symbol j goes to lane j % K at step j // K
+    pad = S * K - n
+    sym = np.pad(np.asarray(symbols, dtype=np.int64), [(0, 0), (0, pad)]).reshape(batchSize, S, K)
+    dist = np.pad(np.asarray(dists, dtype=np.int64), (0, pad)).reshape(S, K)
+    active = (np.arange(S * K) < n).reshape(S, K)
+    if rawBits:
+        raw = np.pad(np.asarray(raw, dtype=np.int64), [(0, 0), (0, pad)]).reshape(batchSize, S, K)
+
+    values = np.zeros([batchSize, S, K, 2], dtype=np.int64)
+    nbits = np.zeros([batchSize, S, K, 2], dtype=np.int64)
+    x = np.full([batchSize, K], L, dtype=np.int64)
+    for j in reversed(range(S)):
+        d = dist[j]
+        s = sym[:, j]
+        freq = table.freq[d, s]
+        nb = table.tableLog + 1 - bitLength(freq)
+        nb = np.where(active[j], nb - ((x >> nb) < freq), 0)
+        values[:, j, :, 0] = x & ((1 << nb) - 1)
+        nbits[:, j, :, 0] = nb
+        y = np.where(active[j], x >> nb, freq)
+        x = np.where(active[j], L + table.stateTable[d, table.cum[d, s] + y - freq], x)
+        if rawBits:
+            escaped = active[j] & (s == escape)
+            values[:, j, :, 1] = np.where(escaped, raw[:, j], 0)
+            nbits[:, j, :, 1] = escaped * rawBits
+
+    # decoding starts from the final states
+    writer.write(x - L, np.full(x.shape, table.tableLog))
+    writer.write(values.reshape(batchSize, -1), nbits.reshape(batchSize, -1))
+
+
+def decode(table, dists, n, reader, lanes=32, rawBits=0):
+    """Inverse of encode, returns symbols and raw of shape [batch, n] (raw is
+    only meaningful at escapes)."""
+    batchSize = len(reader)
+    K = nlanes(n, lanes)
+    S = -(-n // K)
+    escape = table.freq.shape[1] - 1
+
+    dist = np.pad(np.asarray(dists, dtype=np.int64), (0, S * K - n)).reshape(S, K)
+    active = (np.arange(S * K) < n).reshape(S, K)
+
+    symbols = np.zeros([batchSize, S, K], dtype=np.int64)
+    raw = np.zeros([batchSize, S, K], dtype=np.int64)
+    x = reader.read(np.full([batchSize, K], table.tableLog))
+    for j in range(S):
+        d = dist[j]
+        s = table.sym[d, x]
+        nb = np.where(active[j], table.nbBits[d, x], 0)
+        escaped = active[j] & (s == escape) if rawBits else np.zeros(s.shape, dtype=bool)
+        bits = reader.read(np.stack([nb, escaped * rawBits], -1).reshape(batchSize, -1)).reshape(batchSize, K, 2)
+        x = np.where(active[j], table.newBase[d, x] + bits[:, :, 0], x)
+        symbols[:, j] = s
+        raw[:, j] = bits[:, :, 1]
+    return symbols.reshape(batchSize, -1)[:, :n], raw.reshape(batchSize, -1)[:, :n]
@@ -3,4 +3,4 @@ from .transformations import ScalingNshifting
 from .rnvp import RNVP
 from .discreteRNVP import DiscreteRNVP
 from .discreteNICE import DiscreteNICE
-from .hierarchy import OneToTwoMERA, SimpleMERA
\ No newline at end of file
+from .hierarchy import OneToTwoMERA, SimpleMERA, LiftingMERA
\ No newline at end of file
@@ -1 +1 @@
-from .mera import OneToTwoMERA, SimpleMERA
\ No newline at end of file
+from .mera import OneToTwoMERA, SimpleMERA, LiftingMERA
\ No newline at end of file
@@ -225,28 +225,7 @@ class SimpleMERA(Flow):
         DL = []
         DR = []
         for no in range(depth):
-            _x = im2grp(ul)
-            ul = _x[:, :, :, 0].reshape(*_x.shape[:2], int(_x.shape[2] ** 0.5), int(_x.shape[2] ** 0.5)).contiguous()
-            ur = _x[:, :, :, 1].reshape(*_x.shape[:2], int(_x.shape[2] ** 0.5), int(_x.shape[2] ** 0.5)).contiguous()
-            dl = _x[:, :, :, 2].reshape(*_x.shape[:2], int(_x.shape[2] ** 0.5), int(_x.shape[2] ** 0.5)).contiguous()
-            dr = _x[:, :, :, 3].reshape(*_x.shape[:2], int(_x.shape[2] ** 0.5), int(_x.shape[2] ** 0.5)).contiguous()
-            for i in range(4 * self.repeat):
-                if i % 4 == 0:
-                    tmp = torch.cat([ur, dl, dr], 1)
-                    tmp = self.rounding(self.layerList[no * 4 * self.repeat + i](self.decimal.inverse_(tmp)) * self.decimal.scaling)
-                    ul = ul + tmp
-                elif i % 4 == 1:
-                    tmp = torch.cat([ul, dl, dr], 1)
-                    tmp = self.rounding(self.layerList[no * 4 * self.repeat + i](self.decimal.inverse_(tmp)) * self.decimal.scaling)
-                    ur = ur + tmp
-                elif i % 4 == 2:
-                    tmp = torch.cat([ul, ur, dr], 1)
-                    tmp = self.rounding(self.layerList[no * 4 * self.repeat + i](self.decimal.inverse_(tmp)) * self.decimal.scaling)
-                    dl = dl + tmp
-                else:
-                    tmp = torch.cat([ul, ur, dl], 1)
-                    tmp = self.rounding(self.layerList[no * 4 * self.repeat + i](self.decimal.inverse_(tmp)) * self.decimal.scaling)
-                    dr = dr + tmp
+            ul, ur, dl, dr = self.inverseLevel(no, ul)
 
             if self.meanNNlist is not None and self.scaleNNlist is not None and no != depth - 1:
                 self.meanList.append(reform(self.meanNNlist[no](self.decimal.inverse_(ul))).contiguous())
@@ -288,36 +267,59 @@ class SimpleMERA(Flow):
             DR.append(dr)
 
         for no in reversed(range(depth)):
-            ur = UR[no]
-            dl = DL[no]
-            dr = DR[no]
-            for i in reversed(range(4 * self.repeat)):
-                if i % 4 == 0:
-                    tmp = torch.cat([ur, dl, dr], 1)
-                    tmp = self.rounding(self.layerList[no * 4 * self.repeat + i](self.decimal.inverse_(tmp)) * self.decimal.scaling)
-                    ul = ul - tmp
-                elif i % 4 == 1:
-                    tmp = torch.cat([ul, dl, dr], 1)
-                    tmp = self.rounding(self.layerList[no * 4 * self.repeat + i](self.decimal.inverse_(tmp)) * self.decimal.scaling)
-                    ur = ur - tmp
-                elif i % 4 == 2:
-                    tmp = torch.cat([ul, ur, dr], 1)
-                    tmp = self.rounding(self.layerList[no * 4 * self.repeat + i](self.decimal.inverse_(tmp)) * self.decimal.scaling)
-                    dl = dl - tmp
-                else:
-                    tmp = torch.cat([ul, ur, dl], 1)
-                    tmp = self.rounding(self.layerList[no * 4 * self.repeat + i](self.decimal.inverse_(tmp)) * self.decimal.scaling)
-                    dr = dr - tmp
+            ul = self.forwardLevel(no, ul, UR[no], DL[no], DR[no])
 
-            ur = ur.reshape(*ul.shape, 1)
-            dl = dl.reshape(*ul.shape, 1)
-            dr = dr.reshape(*ul.shape, 1)
-            ul = ul.reshape(*ul.shape, 1)
+        return ul, ul.new_zeros(ul.shape[0])
 
-            _x = torch.cat([ul, ur, dl, dr], -1).reshape(*ul.shape[:2], -1, 4)
-            ul = grp2im(_x).contiguous()
+    def inverseLevel(self, no, ul):
+        # split ul into the four sub-bands of level no and apply the level's couplings
+        _x = im2grp(ul)
+        ul = _x[:, :, :, 0].reshape(*_x.shape[:2], int(_x.shape[2] ** 0.5), int(_x.shape[2] ** 0.5)).contiguous()
+        ur = _x[:, :, :, 1].reshape(*_x.shape[:2], int(_x.shape[2] ** 0.5), int(_x.shape[2] ** 0.5)).contiguous()
+        dl = _x[:, :, :, 2].reshape(*_x.shape[:2], int(_x.shape[2] ** 0.5), int(_x.shape[2] ** 0.5)).contiguous()
+        dr = _x[:, :, :, 3].reshape(*_x.shape[:2], int(_x.shape[2] ** 0.5), int(_x.shape[2] ** 0.5)).contiguous()
+        for i in range(4 * self.repeat):
+            if i % 4 == 0:
+                tmp = torch.cat([ur, dl, dr], 1)
+                tmp = self.rounding(self.layerList[no * 4 * self.repeat + i](self.decimal.inverse_(tmp)) * self.decimal.scaling)
+                ul = ul + tmp
+            elif i % 4 == 1:
+                tmp = torch.cat([ul, dl, dr], 1)
+                tmp = self.rounding(self.layerList[no * 4 * self.repeat + i](self.decimal.inverse_(tmp)) * self.decimal.scaling)
+                ur = ur + tmp
+            elif i % 4 == 2:
+                tmp = torch.cat([ul, ur, dr], 1)
+                tmp = self.rounding(self.layerList[no * 4 * self.repeat + i](self.decimal.inverse_(tmp)) * self.decimal.scaling)
+                dl = dl + tmp
+            else:
+                tmp = torch.cat([ul, ur, dl], 1)
+                tmp = self.rounding(self.layerList[no * 4 * self.repeat + i](self.decimal.inverse_(tmp)) * self.decimal.scaling)
+                dr = dr + tmp
+        return ul, ur, dl, dr
+
+    def forwardLevel(self, no, ul, ur, dl, dr):
+        # undo the couplings of level no and merge the sub-bands into the finer ul
+        for i in reversed(range(4 * self.repeat)):
+            if i % 4 == 0:
+                tmp = torch.cat([ur, dl, dr], 1)
+                tmp = self.rounding(self.layerList[no * 4 * self.repeat + i](self.decimal.inverse_(tmp)) * self.decimal.scaling)
+                ul = ul - tmp
+            elif i % 4 == 1:
+                tmp = torch.cat([ul, dl, dr], 1)
+                tmp = self.rounding(self.layerList[no * 4 * self.repeat + i](self.decimal.inverse_(tmp)) * self.decimal.scaling)
+                ur = ur - tmp
+            elif i % 4 == 2:
+                tmp = torch.cat([ul, ur, dr], 1)
+                tmp = self.rounding(self.layerList[no * 4 * self.repeat + i](self.decimal.inverse_(tmp)) * self.decimal.scaling)
+                dl = dl - tmp
+            else:
+                tmp = torch.cat([ul, ur, dl], 1)
+                tmp = self.rounding(self.layerList[no * 4 * self.repeat + i](self.decimal.inverse_(tmp)) * self.decimal.scaling)
+                dr = dr - tmp
 
-        return ul, ul.new_zeros(ul.shape[0])
+        # as grp2im, for rectangular crops too
+        _x = torch.stack([ul, ur, dl, dr], -1).reshape(*ul.shape, 2, 2)
+        return _x.permute([0, 1, 2, 4, 3, 5]).reshape(*ul.shape[:2], ul.shape[2] * 2, ul.shape[3] * 2).contiguous()
 
     def inference(self, z, endDepth, startDepth=None, sample=False, logbase=-2, round=False):
         if round:
@@ -461,3 +463,55 @@ class SimpleMERA(Flow):
 
         return self.inference(z, self.depth, startDepth=1, sample=sample, logbase=logbase)
 
+
+
+class LiftingMERA(SimpleMERA):
+    """SimpleMERA whose levels are fixed integer lifting steps (LeGall 5/3 by
+    default, see utils.wavelet) instead of learned couplings, followed by the
+    same SimpleHierarchyPrior. Every level predicts the odd sub-bands from
+    the even ones and updates the even ones, first along rows then along
+    columns, with shifted adds only."""
+    def __init__(self, length, nMixing=5, decimal=None, rounding=None, depth=None, predict=utils.leGallInitMethod1, update=utils.leGallInitMethod2, clamp=None, sameDetail=True, name="LiftingMERA"):
+        super(LiftingMERA, self).__init__(length, [], None, None, 0, depth, nMixing, decimal, rounding, clamp=clamp, sameDetail=sameDetail, name=name)
+        # taps of the buildWaveletLayers kernels, read with the same replicated edges
+        self.predict = [float(term) for term in predict(1).reshape(-1)]
+        self.update = [float(term) for term in update(1).reshape(-1)]
+        # sub-band pixels a level's forwardLevel reads around each one
+        self.halo = 8
+
+    def lift(self, t, taps, dim, right):
+        n = t.shape[dim]
+        out = torch.zeros_like(t)
+        for k, w in enumerate(taps):
+            if w != 0:
+                idx = torch.clamp(torch.arange(n, device=t.device) + k - (0 if right else 2), 0, n - 1)
+                out = out + w * t.index_select(dim, idx)
+        return torch.floor(out + 0.5)
+
+    def inverseLevel(self, no, ul):
+        _x = im2grp(ul)
+        ul, ur, dl, dr = [_x[:, :, :, i].reshape(*_x.shape[:2], int(_x.shape[2] ** 0.5), int(_x.shape[2] ** 0.5)).contiguous() for i in range(4)]
+        # rows
+        ur = ur - self.lift(ul, self.predict, -1, True)
+        ul = ul + self.lift(ur, self.update, -1, False)
+        dr = dr - self.lift(dl, self.predict, -1, True)
+        dl = dl + self.lift(dr, self.update, -1, False)
+        # columns
+        dl = dl - self.lift(ul, self.predict, -2, True)
+        ul = ul + self.lift(dl, self.update, -2, False)
+        dr = dr - self.lift(ur, self.predict, -2, True)
+        ur = ur + self.lift(dr, self.update, -2, False)
+        return ul, ur, dl, dr
+
+    def forwardLevel(self, no, ul, ur, dl, dr):
+        ur = ur - self.lift(dr, self.update, -2, False)
+        dr = dr + self.lift(ur, self.predict, -2, True)
+        ul = ul - self.lift(dl, self.update, -2, False)
+        dl = dl + self.lift(ul, self.predict, -2, True)
+        dl = dl - self.lift(dr, self.update, -1, False)
+        dr = dr + self.lift(dl, self.predict, -1, True)
+        ul = ul - self.lift(ur, self.update, -1, False)
+        ur = ur + self.lift(ul, self.predict, -1, True)
+
+        _x = torch.stack([ul, ur, dl, dr], -1).reshape(*ul.shape, 2, 2)
+        return _x.permute([0, 1, 2, 4, 3, 5]).reshape(*ul.shape[:2], ul.shape[2] * 2, ul.shape[3] * 2).contiguous()
@@ -23,6 +23,7 @@ group.add_argument("-diffDetail", action="store_false", help="if use same detail
 group.add_argument("-HUE", action="store_false", help="use YCbCr color scheme")
 group.add_argument("-clamp", type=float, default=-1, help="clamp of last prior's mean")
 group.add_argument("-heavy", action="store_true", help="if use different trans on different depth")
+group.add_argument("-lifting", action="store_true", help="use fixed LeGall 5/3 integer lifting instead of learned couplings, only training the simple prior, for the fast codec tier")
 
 group = parser.add_argument_group('Learning  parameters')
 group.add_argument("-epoch", type=int, default=400, help="num of epoches to train")
@@ -43,6 +44,8 @@ device = torch.device("cpu" if args.cuda < 0 else "cuda:" + str(args.cuda))
 # Creating save folder
 if args.folder is None:
     rootFolder = './opt/default_easyMera_' + args.target + "_YCC_" + str(args.HUE) + "_simplePrior_" + str(args.simplePrior) + "_repeat_" + str(args.repeat) + "_hchnl_" + str(args.hchnl) + "_nhidden_" + str(args.nhidden) + "_nMixing_" + str(args.nMixing) + "_sameDetail_" + str(args.diffDetail) + "_clamp_" + str(args.clamp) + "_heavy_" + str(args.heavy) + "/"
+    if args.lifting:
+        rootFolder = rootFolder[:-1] + "_lifting/"
     print("No specified saving path, using", rootFolder)
 else:
     rootFolder = args.folder
@@ -69,14 +72,16 @@ if not args.load:
     lr = args.lr
     heavy = args.heavy
     HUE = args.HUE
+    lifting = args.lifting
     with open(rootFolder + "/parameter.json", "w") as f:
-        config = {'target': target, 'repeat': repeat, 'hchnl': hchnl, 'nhidden': nhidden, 'nMixing': nMixing, 'epoch': epoch, 'batch': batch, 'savePeriod': savePeriod, 'lr': lr, 'simplePrior': simplePrior, 'diffDetail': diffDetail, 'clamp': clamp, 'heavy': heavy, 'HUE': HUE}
+        config = {'target': target, 'repeat': repeat, 'hchnl': hchnl, 'nhidden': nhidden, 'nMixing': nMixing, 'epoch': epoch, 'batch': batch, 'savePeriod': savePeriod, 'lr': lr, 'simplePrior': simplePrior, 'diffDetail': diffDetail, 'clamp': clamp, 'heavy': heavy, 'HUE': HUE, 'lifting': lifting}
         json.dump(config, f)
 else:
     # load saved parameters, and decoding them to mem
     with open(rootFolder + "/parameter.json", 'r') as f:
         config = json.load(f)
         locals().update(config)
+        lifting = config.get('lifting', False)
 
 if HUE:
     lambd = lambda x: (x * 255).byte().to(torch.float32).to(device)
@@ -207,7 +212,10 @@ else:
     scaleNNlist = None
 
 # Building MERA model
-f = flow.SimpleMERA(blockLength, layerList, meanNNlist, scaleNNlist, repeat, None, nMixing, decimal=decimal, rounding=utils.roundingWidentityGradient, clamp=clamp, sameDetail=diffDetail).to(device)
+if lifting:
+    f = flow.LiftingMERA(blockLength, nMixing, decimal=decimal, rounding=utils.roundingWidentityGradient, clamp=clamp, sameDetail=diffDetail).to(device)
+else:
+    f = flow.SimpleMERA(blockLength, layerList, meanNNlist, scaleNNlist, repeat, None, nMixing, decimal=decimal, rounding=utils.roundingWidentityGradient, clamp=clamp, sameDetail=diffDetail).to(device)
 
 # Define plot function
 def plotfn(f, train, test, LOSS, VALLOSS):
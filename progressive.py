@@ -7,7 +7,7 @@ import flow, utils, source
 import torch, torchvision
 from torch import nn
 
-from encoder import rans, coder
+from encoder import rans, coder, container, pyramid
 from utils import cdfDiscreteLogitstic, cdfMixDiscreteLogistic
 from matplotlib import pyplot as plt
 import matplotlib
@@ -26,6 +26,8 @@ parser.add_argument("-exdepth", type=int, default=2, help="num iterations to ups
 parser.add_argument("-num", type=int, default=10, help="num of image used")
 parser.add_argument("-fix", action='store_true', help="color shift to original image's scheme")
 parser.add_argument('-target', type=str, default='original', choices=['original', 'CIFAR', 'ImageNet32', 'ImageNet64', 'MNIST'], metavar='DATASET', help='Dataset choice.')
+parser.add_argument("-pyramid", default=None, help="Pyramid store (see pyramid.py) of the target to read the images' levels from instead of running the flow")
+parser.add_argument("-index", type=int, default=0, help="index of the first image in the pyramid store")
 
 args = parser.parse_args()
 
@@ -135,6 +137,15 @@ else:
 depth = int(math.log(blockLength, 2))
 exdepth = args.exdepth
 
+if args.pyramid is not None:
+    store = pyramid.Pyramid(args.pyramid)
+    if store.fingerprint != container.fingerprint(name):
+        raise Exception("Pyramid store was built with a different model")
+    if store.length != blockLength or store.HUE != HUE:
+        raise Exception("Pyramid store doesn't hold images of the target")
+    if args.index < 0 or args.index + batch > len(store):
+        raise Exception("No images " + str(args.index) + " to " + str(args.index + batch) + " in pyramid store of " + str(len(store)))
+
 # load the model
 print("load saving at " + name)
 loadedF = torch.load(name, map_location=device)
@@ -238,10 +249,21 @@ def sampleMoreDetails(samples):
 
 
 def plotLoading(loader):
-    samples, _ = next(iter(loader))
-    z, _ = f.inverse(samples)
+    if args.pyramid is None:
+        samples, _ = next(iter(loader))
+        z, _ = f.inverse(samples)
 
-    zParts = divide(z)
+        zParts = divide(z)
+        meanList, scaleList = f.meanList, f.scaleList
+    else:
+        # the details and the coarser images of each level instead of f.inverse
+        idx = list(range(args.index, args.index + batch))
+        images = dict(store.images(f, idx))
+        samples = images[0]
+        zParts = [torch.from_numpy(np.array(store.details(no, idx))).to(samples) for no in range(depth)] + [store.ul(None, idx).to(samples)]
+        if 'simplePrior_False' in name:
+            meanList = [reform(f.meanNNlist[no](f.decimal.inverse_(images[no + 1]))).contiguous() for no in range(depth - 1)]
+            scaleList = [reform(f.scaleNNlist[no](f.decimal.inverse_(images[no + 1]))).contiguous() for no in range(depth - 1)]
 
     augmenZ = []
     for no in range(int(math.log(blockLength, 2))):
@@ -249,7 +271,7 @@ def plotLoading(loader):
         for i in range(no):
             #tmpZ.append(f.prior.priorList[i].sample(batch))
             if 'simplePrior_False' in name:
-                sampledDetails = utils.sampleDiscreteLogistic([*f.meanList[i].shape], f.meanList[i], f.scaleList[i] + args.baseScale, decimal=f.decimal)
+                sampledDetails = utils.sampleDiscreteLogistic([*meanList[i].shape], meanList[i], scaleList[i] + args.baseScale, decimal=f.decimal)
             else:
                 sampledDetails = utils.sampleDiscreteLogistic(lenList[i], loadedF.prior.priorList[i].mean, loadedF.prior.priorList[i].logscale + args.baseScale, decimal=f.decimal)
             #sampledDetails = torch.zeros_like(sampledDetails)
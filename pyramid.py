@@ -0,0 +1,46 @@
+import argparse
+
+import torch, torchvision
+
+import utils
+from encoder import container, mera, pyramid
+
+
+parser = argparse.ArgumentParser(description="")
+
+parser.add_argument("-folder", default=None, help="Path to load the trained model")
+parser.add_argument("-cuda", type=int, default=-1, help="Which device to use with -1 standing for CPU, number bigger than -1 is N.O. of GPU.")
+parser.add_argument("-best", action='store_false', help="if load the best model")
+parser.add_argument("-valbest", action='store_true', help="if load the best val. model")
+parser.add_argument('-target', type=str, default='CIFAR', choices=['CIFAR', 'ImageNet32', 'ImageNet64'], metavar='DATASET', help='Dataset choice.')
+parser.add_argument("-train", action='store_true', help="store the train set instead of the test set")
+parser.add_argument("-batch", type=int, default=64, help="batch size")
+parser.add_argument("-count", type=int, default=-1, help="num of images to store, -1 for the whole set")
+parser.add_argument("-out", default=None, help="Folder of the pyramid store")
+
+args = parser.parse_args()
+
+device = torch.device("cpu" if args.cuda < 0 else "cuda:" + str(args.cuda))
+
+if args.folder is None:
+    raise Exception("No loading")
+if args.out is None:
+    raise Exception("No output folder")
+
+transform = torchvision.transforms.Compose([torchvision.transforms.ToTensor(), torchvision.transforms.Lambda(lambda x: (x * 255).byte().to(torch.float32))])
+if args.target == "CIFAR":
+    length = 32
+    dataset = torchvision.datasets.CIFAR10(root='./data/cifar', train=args.train, download=True, transform=transform)
+elif args.target == "ImageNet32":
+    length = 32
+    dataset = utils.ImageNet(root='./data/ImageNet32', train=args.train, download=True, transform=transform)
+else:
+    length = 64
+    dataset = utils.ImageNet(root='./data/ImageNet64', train=args.train, download=True, transform=transform, d64=True)
+loader = torch.utils.data.DataLoader(dataset, batch_size=args.batch, shuffle=False)
+
+f, name, config = mera.loadFlow(args.folder, length, device, args.best, args.valbest, double=False)
+
+store = pyramid.build(f, loader, args.out, container.fingerprint(name), config.get('HUE', True), None if args.count < 0 else args.count)
+
+print("Stored the pyramids of", len(store), "images of", args.target, "to", args.out, "in", store.depth, "levels")
@@ -0,0 +1,46 @@
+import argparse
+import asyncio
+
+import torch
+
+from encoder import container, mera, server, cache
+
+
+parser = argparse.ArgumentParser(description="")
+
+parser.add_argument("-folder", default=None, help="Path to load the trained model")
+parser.add_argument("-cuda", type=int, default=-1, help="Which device to use with -1 standing for CPU, number bigger than -1 is N.O. of GPU.")
+parser.add_argument("-best", action='store_false', help="if load the best model")
+parser.add_argument("-valbest", action='store_true', help="if load the best val. model")
+parser.add_argument("-host", default='127.0.0.1', help="address to listen on")
+parser.add_argument("-port", type=int, default=8000, help="port to listen on")
+parser.add_argument("-socket", default=None, help="path of a Unix socket to listen on instead of -host and -port")
+parser.add_argument("-maxBatch", type=int, default=16, help="max num of requests run through the flow together")
+parser.add_argument("-deadline", type=float, default=20, help="milliseconds a request waits for others of its size before its batch runs")
+parser.add_argument("-workers", type=int, default=4, help="num of threads entropy coding compressed batches")
+parser.add_argument("-nbins", type=int, default=4096, help="bin number of ran alg.")
+parser.add_argument("-precision", type=int, default=24, help="precision of CDF")
+parser.add_argument("-window", type=float, default=0, help="code CDF tables over this many scales around the mean with an escape symbol, 0 for full nbins tables")
+parser.add_argument("-cdfChunk", type=int, default=4096, help="num of symbols per CDF chunk streamed into the coder")
+parser.add_argument("-tableLog", type=int, default=12, help="log2 of tANS tables to code levels with static priors with, 0 to code every level with rANS")
+parser.add_argument("-tableBits", type=int, default=8, help="log2 of buckets in decoding lookup tables, 0 to search the CDFs")
+parser.add_argument("-cache", default=None, help="Folder of a cache of compressed images by content, repeated images skip the flow")
+parser.add_argument("-cacheSize", type=int, default=1024, help="MB the cache keeps, least recently used images evicted first")
+
+args = parser.parse_args()
+
+device = torch.device("cpu" if args.cuda < 0 else "cuda:" + str(args.cuda))
+
+if args.folder is None:
+    raise Exception("No loading")
+
+_, name, config = mera.loadFlow(args.folder, None, device, args.best, args.valbest)
+
+s = server.BatchingServer(lambda length: mera.loadFlow(args.folder, length, device, args.best, args.valbest)[0], container.fingerprint(name), config.get('HUE', True), args.maxBatch, args.deadline / 1000, args.workers, args.nbins, args.precision, args.window if args.window > 0 else None, args.cdfChunk, args.tableLog, args.tableBits, cache=None if args.cache is None else cache.ContainerCache(args.cache, args.cacheSize << 20))
+
+print("Serving", name, "on", args.socket if args.socket is not None else args.host + ":" + str(args.port))
+with s:
+    try:
+        asyncio.run(s.serve(args.host, args.port, args.socket))
+    except KeyboardInterrupt:
+        pass
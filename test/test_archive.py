@@ -0,0 +1,60 @@
+import os
+import sys
+sys.path.append(os.getcwd())
+
+import tempfile
+import numpy as np
+from numpy.testing import assert_array_equal
+
+from encoder import archive, container
+
+
+def buildContainer(n, length=16, levels=4):
+    words = np.random.randint(0, 1 << 32, n, dtype=np.uint64).astype(np.uint32)
+    ends = [[2 + (n - 2) * (i + 1) // levels, 0] for i in range(levels)]
+    return container.Container(b'12345678', (3, length, length), True, 4096, 24, words, None, 0, None, ends)
+
+
+def test_archive():
+    with tempfile.TemporaryDirectory() as folder:
+        path = os.path.join(folder, 'test.nwa')
+        ids = np.random.permutation(1000)[:50] * 7
+        containers = {}
+        with archive.ArchiveWriter(path) as writer:
+            for id in ids:
+                containers[id] = buildContainer(np.random.randint(10, 100), 16 * np.random.randint(1, 3))
+                writer.add(id, containers[id])
+
+        with archive.Archive(path) as a:
+            assert len(a) == 50
+            assert_array_equal(a.ids, np.sort(ids))
+            for id in np.random.permutation(ids):
+                c = a[id]
+                assert c.toBytes() == containers[id].toBytes()
+                entry = a.entry(id)
+                assert entry['length'] == len(c)
+                assert (entry['channel'], entry['height'], entry['width']) == c.shape
+            assert 1 not in a and ids[0] in a
+
+            # prefix of the coarsest levels only
+            c = a.read(ids[0], 2)
+            assert c.levels == 2
+            assert_array_equal(c.words, containers[ids[0]].words[:c.ends[1, 0]])
+
+            try:
+                a[1]
+                assert False
+            except KeyError:
+                pass
+
+        try:
+            with archive.ArchiveWriter(path) as writer:
+                writer.add(3, buildContainer(10))
+                writer.add(3, buildContainer(10))
+            assert False
+        except Exception as e:
+            assert "Duplicated" in str(e)
+
+
+if __name__ == "__main__":
+    test_archive()
@@ -0,0 +1,655 @@
+import os
+import sys
+import copy
+import json
+import asyncio
+import weakref
+import tempfile
+import threading
+sys.path.append(os.getcwd())
+
+import torch
+import numpy as np
+from numpy.testing import assert_allclose, assert_array_equal
+
+import utils
+import flow
+from flow.hierarchy.mera import im2grp
+from encoder import container, mera, rans, tans, scheduler, accounting, pyramid, server, cache
+
+
+def buildMERA(length, meanNN=True, repeat=1, compatible=False):
+    decimal = flow.ScalingNshifting(256, -128)
+
+    layerList = []
+    for i in range(4 * repeat):
+        f = torch.nn.Sequential(torch.nn.Conv2d(9, 9, 3, padding=1), torch.nn.ReLU(inplace=True), torch.nn.Conv2d(9, 9, 1, padding=0), torch.nn.ReLU(inplace=True), torch.nn.Conv2d(9, 3, 3, padding=1))
+        layerList.append(f)
+
+    if meanNN:
+        meanNNlist = [torch.nn.Sequential(torch.nn.Conv2d(3, 9, 3, padding=1), torch.nn.ReLU(inplace=True), torch.nn.Conv2d(9, 9, 1, padding=0))]
+        scaleNNlist = [torch.nn.Sequential(torch.nn.Conv2d(3, 9, 3, padding=1), torch.nn.ReLU(inplace=True), torch.nn.Conv2d(9, 9, 1, padding=0))]
+    else:
+        meanNNlist = None
+        scaleNNlist = None
+
+    if compatible:
+        depth = int(np.log2(length))
+        layerList = layerList * depth
+        if meanNN:
+            meanNNlist = meanNNlist * depth
+            scaleNNlist = scaleNNlist * depth
+
+    f = flow.SimpleMERA(length, layerList, meanNNlist, scaleNNlist, repeat, None, 5, decimal, utils.roundingWidentityGradient, compatible=compatible)
+    with torch.no_grad():
+        for p in f.prior.parameters():
+            p.add_(0.1 * torch.randn(p.shape))
+    return f.double()
+
+
+def test_container():
+    words = np.random.randint(0, 1 << 32, 100, dtype=np.uint64).astype(np.uint32)
+    c = container.Container(b'12345678', (3, 16, 16), False, 4096, 24, words, [3, 5, 7], 12, np.arange(13, dtype=np.uint8))
+    cc = container.Container.fromBytes(c.toBytes())
+
+    assert len(c.toBytes()) == len(c)
+    assert cc.fingerprint == c.fingerprint
+    assert cc.shape == c.shape
+    assert cc.HUE == c.HUE
+    assert cc.nbins == c.nbins
+    assert cc.precision == c.precision
+    assert cc.windows == c.windows
+    assert cc.tableLog == c.tableLog
+    assert_array_equal(cc.bits, c.bits)
+    assert_array_equal(cc.words, c.words)
+
+    try:
+        container.Container.fromBytes(c.toBytes()[:-1])
+        assert False
+    except Exception as e:
+        assert "Truncated" in str(e)
+
+    # level segments, coarsest first
+    ends = [[10, 0], [40, 5], [40, 13], [100, 13]]
+    c = container.Container(b'12345678', (3, 16, 16), False, 4096, 24, words, [3, 5, 7], 12, np.arange(13, dtype=np.uint8), ends)
+    buf = c.toBytes()
+    assert len(buf) == len(c)
+    assert_array_equal(container.Container.fromBytes(buf).ends, ends)
+    for levels in range(5):
+        size = container.Container.prefixSize(buf, levels)
+        cc = container.Container.fromBytes(buf[:size], partial=True)
+        assert cc.levels == levels
+        assert_array_equal(cc.words, words[:ends[levels - 1][0] if levels else 0])
+        assert_array_equal(cc.bits, c.bits[:ends[levels - 1][1] if levels else 0])
+        assert cc.toBytes() == buf[:size]
+    assert container.Container.prefixSize(buf) == len(buf)
+
+
+def test_compressDecompress():
+    for meanNN in [True, False]:
+        f = buildMERA(16, meanNN)
+        x = torch.randint(0, 255, (4, 3, 16, 16)).float()
+
+        containers = mera.compress(f, x, b'12345678')
+
+        for i, c in enumerate(containers):
+            c = container.Container.fromBytes(c.toBytes())
+            rcnX = mera.decompress(f, c, b'12345678')
+            assert_allclose(rcnX.numpy(), x[i:i + 1].numpy())
+
+        # windowed tables, narrow enough that some symbols are escaped
+        for k in [0.3, 8]:
+            for i, c in enumerate(mera.compress(f, x, b'12345678', k=k)):
+                c = container.Container.fromBytes(c.toBytes())
+                assert len(c.windows) == 4
+                rcnX = mera.decompress(f, c, b'12345678')
+                assert_allclose(rcnX.numpy(), x[i:i + 1].numpy())
+
+        # rANS only
+        for i, c in enumerate(mera.compress(f, x, b'12345678', tableLog=0)):
+            assert c.bits.shape[0] == 0
+            assert_allclose(mera.decompress(f, c).numpy(), x[i:i + 1].numpy())
+
+        try:
+            mera.decompress(f, containers[0], b'87654321')
+            assert False
+        except Exception as e:
+            assert "different model" in str(e)
+
+
+def test_decompressLevels():
+    f = buildMERA(16)
+    # the receiver's model has never seen the image
+    g = copy.deepcopy(f)
+    x = torch.randint(0, 255, (2, 3, 16, 16)).float()
+    containers = mera.compress(f, x, b'12345678')
+    assert len(f.meanList) > 0 and not hasattr(g, 'meanList')
+
+    for i, c in enumerate(containers):
+        levels = list(mera.decompressLevels(g, c))
+        assert [no for no, _ in levels] == [3, 2, 1, 0]
+        assert [ul.shape[-1] for _, ul in levels] == [2, 4, 8, 16]
+        assert not hasattr(g, 'meanList')
+        assert_allclose(levels[-1][1].float().numpy(), x[i:i + 1].numpy())
+
+
+def test_decompressBatch():
+    f = buildMERA(16)
+    x = torch.randint(0, 255, (5, 3, 16, 16)).float()
+    # containers of two batches, coded with different windows
+    containers = mera.compress(f, x[:3], b'12345678', k=8) + mera.compress(f, x[3:], b'12345678', k=0.3)
+    containers = [containers[i] for i in [3, 0, 4, 1, 2]]
+
+    rcnX = mera.decompressBatch(f, containers, b'12345678', batch=2)
+    assert_allclose(torch.cat(rcnX, 0).numpy(), x[[3, 0, 4, 1, 2]].numpy())
+
+    for i in range(5):
+        assert_allclose(mera.decompress(f, containers[i]).numpy(), rcnX[i].numpy())
+
+    try:
+        list(mera.decompressLevels(f, containers))
+        assert False
+    except Exception as e:
+        assert "different parameters" in str(e)
+
+
+def test_progressive():
+    with tempfile.TemporaryDirectory() as tmp:
+        for meanNN in [True, False]:
+            f = buildMERA(16, meanNN)
+            x = torch.randint(0, 255, (2, 3, 16, 16)).float()
+            containers = mera.compress(f, x, b'12345678', k=8)
+            rcnX = mera.decompressBatch(f, containers)
+            for i, c in enumerate(containers):
+                path = os.path.join(tmp, str(i) + '.nwf')
+                container.save(path, c)
+                assert c.levels == 4
+                lengths = []
+                for levels in range(5):
+                    cc = container.load(path, levels)
+                    lengths.append(len(cc))
+                    assert cc.levels == levels
+                    rcn = list(mera.decompressLevels(f, cc, levels=levels))
+                    assert len(rcn) == levels
+                    for no, ul in rcn:
+                        assert ul.shape[-1] == 16 // 2 ** no
+                    img = mera.preview(f, cc, levels)
+                    assert img.shape == (1, 3, 16, 16)
+                assert lengths == sorted(lengths) and lengths[-1] == len(c)
+                # all levels decoded, nothing is filled in
+                assert_allclose(img.numpy(), rcnX[i].numpy())
+                assert_allclose(mera.decompress(f, cc).numpy(), x[i:i + 1].numpy())
+
+                try:
+                    mera.decompress(f, container.load(path, 2))
+                    assert False
+                except Exception as e:
+                    assert "holds only" in str(e)
+
+
+def test_tiles():
+    assert mera.receptiveField(torch.nn.Sequential(torch.nn.Conv2d(9, 9, 3, padding=1), torch.nn.ReLU(), torch.nn.Conv2d(9, 9, 1), torch.nn.Conv2d(9, 3, 5, padding=4, dilation=2))) == 5
+
+    for meanNN in [True, False]:
+        f = buildMERA(64, meanNN)
+        x = torch.randint(0, 255, (2, 3, 64, 64)).float()
+        containers = mera.compress(f, x, b'12345678', k=4, tile=8)
+        c = container.Container.fromBytes(containers[0].toBytes())
+        assert c.tile == 8 and c.ends.shape[0] == 1 + 1 + 1 + 1 + 4 + 16 and c.bits.shape[0] == 0
+
+        assert_allclose(mera.decompressBatch(f, containers)[1].numpy(), x[1:].numpy())
+        for box in [(0, 4, 0, 4), (30, 34, 50, 61)]:
+            rcnX = mera.decompressRegion(f, c, box)
+            assert_allclose(rcnX.numpy(), x[:1, :, box[0]:box[1], box[2]:box[3]].numpy())
+        # the finest level's tiles far from the crop are skipped
+        assert len(mera.regionPlan(f, 64, (0, 4, 0, 4), 8)[0][2]) < 16
+
+    try:
+        list(mera.decompressLevels(f, c))
+        assert False
+    except Exception as e:
+        assert "decompressRegion" in str(e)
+
+
+def test_scheduler():
+    for meanNN in [True, False]:
+        f = buildMERA(64, meanNN)
+        x = torch.randint(0, 255, (1, 3, 64, 64)).float()
+        c = mera.compress(f, x, b'12345678', k=4, tile=8)[0]
+
+        with scheduler.DecodeScheduler(f, 4) as s:
+            for box in [None, (0, 4, 0, 4), (17, 63, 1, 40)]:
+                rcnX = s.decode(c, box)
+                assert_allclose(rcnX.numpy(), mera.decompressRegion(f, c, box).numpy())
+                assert_allclose(rcnX.numpy(), x[:, :, box[0]:box[1], box[2]:box[3]].numpy() if box is not None else x.numpy())
+                # the couplings ran off the popping thread, the critical path no longer than the serial time
+                assert s.times['coupling'] > 0
+                assert 0 < s.critical <= sum(s.times.values()) + 1e-3
+
+
+def test_shared():
+    for meanNN in [True, False]:
+        f = buildMERA(16, meanNN)
+        x = torch.randint(0, 255, (5, 3, 16, 16)).float()
+        for k, tableLog in [(None, 12), (0.3, 0), (8, 12)]:
+            containers = mera.compress(f, x, b'12345678', k=k, tableLog=tableLog, shared=True)
+            assert len(containers) == 1
+            c = container.Container.fromBytes(containers[0].toBytes())
+            assert c.count == 5
+            assert len(c) < sum(len(term) for term in mera.compress(f, x, b'12345678', k=k, tableLog=tableLog))
+            assert_allclose(mera.decompress(f, c).numpy(), x.numpy())
+
+            # the coarsest levels of the batch from a prefix
+            cc = container.Container.fromBytes(c.toBytes()[:container.Container.prefixSize(c.toBytes(), 2)], partial=True)
+            rcn = list(mera.decompressLevels(f, cc, levels=2))
+            assert rcn[-1][1].shape == (5, 3, 4, 4)
+            assert mera.preview(f, cc, 2).shape == (5, 3, 16, 16)
+
+        rcnX = mera.decompressBatch(f, [c] + mera.compress(f, x[:2], b'12345678', k=8))
+        assert_allclose(rcnX[0].numpy(), x.numpy())
+        assert_allclose(torch.cat(rcnX[1:], 0).numpy(), x[:2].numpy())
+
+
+def test_divideJoin():
+    f = buildMERA(16)
+    x = torch.randint(0, 255, (4, 3, 16, 16)).double()
+    with torch.no_grad():
+        z, _ = f.inverse(x)
+        parts = mera.divide(f, z, 4096)
+        assert all(part.dtype == np.int16 for part in parts)
+        assert_allclose(mera.join(f, parts, 4096).numpy(), z.numpy())
+        for part, _part in zip(parts, mera.divide(f, z, 4096, compact=False)):
+            assert _part.dtype == np.int32
+            assert_array_equal(part, _part)
+
+        # symbols out of the int16 range, with more than 1 << 15 bins, fall back to int32
+        z[0, 0, 0, 1] = 4e4
+        parts = mera.divide(f, z, 1 << 17)
+        assert all(part.dtype == np.int32 for part in parts) and parts[0].max() > 1e5
+        assert_allclose(mera.join(f, parts, 1 << 17).numpy(), z.numpy())
+
+        # symbols out of [0, nbins) can't be coded
+        for value in [5000, -5000]:
+            z[0, 0, 0, 1] = value
+            try:
+                mera.divide(f, z, 4096)
+                assert False
+            except Exception as e:
+                assert "level 0 out of [0, 4096)" in str(e)
+
+    # nor compressed, an image of values far out of 0-255 escaping the bins
+    x[0, 0, 0, 1] = 1e5
+    for tile in [0, 4]:
+        try:
+            mera.compress(f, x, b'12345678', k=4, tile=tile)
+            assert False
+        except Exception as e:
+            assert "out of [0, 4096)" in str(e)
+
+
+def test_levelParams():
+    f = buildMERA(16)
+    x = torch.randint(0, 255, (4, 3, 16, 16)).double()
+    with torch.no_grad():
+        z, _ = f.inverse(x)
+        parts = mera.divide(f, z, 4096)
+        params = mera.levelParams(f, 4, 16)
+
+        # the model going on to other images doesn't change the coding of x
+        f.inverse(torch.randint(0, 255, (4, 3, 16, 16)).double())
+        state, writer, _ = mera.encodeLevels(f, parts, 16, 4096, 24, range(len(parts)), chunk=100, params=params)
+        _, rcnParts = mera.decodeLevels(f, rans.BatchStack.unflatten(state.flatten()), None, 16, 4096, 24, range(len(parts)), chunk=100, params=params)
+        for part, rcnPart in zip(parts, rcnParts):
+            assert_array_equal(rcnPart, part)
+        assert_allclose(mera.join(f, rcnParts, 4096, params).numpy(), z.numpy())
+
+
+def test_accounting():
+    f = buildMERA(16)
+    x = torch.randint(0, 255, (4, 3, 16, 16)).double()
+    with torch.no_grad():
+        z, logp = f.inverse(x)
+        assert_allclose(accounting.logProbability(f, z, logp).numpy(), f.logProbability(x).numpy())
+        parts = mera.divide(f, z, 4096)
+        params = mera.levelParams(f, 4, 16)
+
+        for k in [None, 2]:
+            CDF = mera.calCDF(f, 4, 4096, 24, 16, k)
+            windows = mera.calWindows(f, 4, 4096, 16, k)
+            bits = accounting.levelBits(f, parts, 16, 4096, 24, windows, 100, params)
+            assert [term.shape for term in bits] == [(4, 3, 64, 3), (4, 3, 16, 3), (4, 3, 4, 3), (4, 3, 1, 4)]
+            if k is None:
+                for part, _CDF, term in zip(parts, CDF, bits):
+                    _bits = [[24 - np.log2(int(_CDF[s + 1, i, j]) - int(_CDF[s, i, j])) for j, s in enumerate(row)] for i, row in enumerate(part)]
+                    assert_allclose(term.reshape(4, -1), _bits)
+                assert_allclose(np.concatenate([term.reshape(4, -1) for term in accounting.levelBits(f, parts, 16, 4096, 24, CDF=CDF)], -1), np.concatenate([term.reshape(4, -1) for term in bits], -1))
+
+            # the coded message is the ideal cost and the rANS flush
+            state, _, _ = mera.encodeLevels(f, parts, 16, 4096, 24, range(len(parts)), windows, 100, params=params)
+            words = np.array([term.shape[0] for term in state.flatten()])
+            total = sum(term.sum((1, 2, 3)) for term in bits)
+            assert (32 * words >= total).all() and (32 * words <= total + 128).all()
+
+            cost = accounting.summary(bits)
+            assert_allclose(sum(cost['level']), total.mean())
+            assert_allclose([term.sum() for term in cost['channel']], cost['level'])
+            assert_allclose([term.sum() for term in cost['band']], cost['level'])
+
+
+def test_pyramid():
+    f = buildMERA(16)
+    x = torch.randint(0, 255, (10, 3, 16, 16)).double()
+    loader = torch.utils.data.DataLoader(torch.utils.data.TensorDataset(x, torch.zeros(10)), batch_size=4)
+    with tempfile.TemporaryDirectory() as folder:
+        store = pyramid.build(f, loader, folder, b'12345678', count=9)
+
+        with torch.no_grad():
+            z, _ = f.inverse(x[:9])
+        store = pyramid.Pyramid(folder)
+        assert len(store) == 9 and store.depth == 4 and store.fingerprint == b'12345678'
+        assert store.details(0).dtype == np.int16
+        assert_allclose(store.z().numpy(), z.numpy())
+        assert_allclose(store.z([2, 5]).numpy(), z[[2, 5]].numpy())
+
+        # a level's bands and coarse image, as divide splits them
+        ul = z
+        for no in range(4):
+            _x = im2grp(ul)
+            ul = _x[:, :, :, 0].reshape(9, 3, 8 // 2 ** no, 8 // 2 ** no)
+            assert_allclose(store.details(no), _x[:, :, :, 1:].numpy())
+            assert_allclose(store.bands(no)[1], _x[:, :, :, 2].reshape(9, 3, 8 // 2 ** no, 8 // 2 ** no).numpy())
+            assert_allclose(store.ul(no + 1).numpy(), ul.numpy())
+        assert_allclose(store.ul().numpy(), ul.numpy())
+
+        # the images the levels split, as decoding rebuilds them
+        images = dict(store.images(f, [1, 3]))
+        assert sorted(images) == [0, 1, 2, 3]
+        assert_allclose(images[0].numpy(), x[[1, 3]].numpy())
+        for no, ul in mera.decompressLevels(f, mera.compress(f, x[[1, 3]], b'12345678')):
+            assert_allclose(images[no].numpy(), ul.numpy())
+        assert [no for no, _ in store.images(f, [0], 2)] == [3, 2]
+
+        # z and the priors' parameters as f.inverse leaves them
+        with torch.no_grad():
+            z, logp = f.inverse(x[2:6])
+        meanList, scaleList = f.meanList, f.scaleList
+        _z, _logp = store.inverse(f, slice(2, 6))
+        assert_allclose(_z.numpy(), z.numpy())
+        assert_allclose(_logp.numpy(), logp.numpy())
+        assert len(f.meanList) == 3 and len(f.scaleList) == 3
+        for a, b in zip(meanList + scaleList, f.meanList + f.scaleList):
+            assert_allclose(b.numpy(), a.numpy())
+
+        # a flow of larger images on smaller ones
+        f = buildMERA(32, compatible=True)
+        store = pyramid.build(f, loader, os.path.join(folder, 'compatible'))
+        assert store.length == 16 and store.depth == 4 and len(store) == 10
+        with torch.no_grad():
+            z, _ = f.inverse(x)
+        assert_allclose(store.z().numpy(), z.numpy())
+        assert_allclose(dict(store.images(f))[0].numpy(), x.numpy())
+
+        try:
+            pyramid.PyramidWriter(os.path.join(folder, 'full'), 1, 16).add(torch.full((1, 3, 16, 16), 1e5))
+            assert False
+        except Exception as e:
+            assert "range" in str(e)
+
+
+def buildLifting(length):
+    f = flow.LiftingMERA(length, 5, flow.ScalingNshifting(256, -128), utils.roundingWidentityGradient)
+    with torch.no_grad():
+        for p in f.prior.parameters():
+            p.add_(0.1 * torch.randn(p.shape))
+    return f.double()
+
+
+def test_lifting():
+    f = buildLifting(32)
+    x = torch.randint(0, 255, (4, 3, 32, 32)).double()
+    with torch.no_grad():
+        z, _ = f.inverse(x)
+        assert_array_equal(z.numpy(), np.round(z.numpy()))
+        assert_allclose(f.forward(z)[0].numpy(), x.numpy())
+
+    containers = mera.compress(f, x, b'12345678', k=4)
+    c = container.Container.fromBytes(containers[0].toBytes())
+    assert c.lifting and not container.Container.fromBytes(mera.compress(buildMERA(32, False), x[:1], b'12345678')[0].toBytes()).lifting
+    assert_allclose(torch.cat(mera.decompressBatch(f, containers), 0).numpy(), x.numpy())
+    try:
+        mera.decompress(buildMERA(32, False), c)
+        assert False
+    except Exception as e:
+        assert "lifting" in str(e)
+
+    c = mera.compress(f, x[:1], b'12345678', tile=4)[0]
+    for box in [None, (3, 9, 20, 31)]:
+        rcnX = mera.decompressRegion(f, c, box)
+        assert_allclose(rcnX.numpy(), x[:1].numpy() if box is None else x[:1, :, box[0]:box[1], box[2]:box[3]].numpy())
+
+
+def test_server():
+    flows = {16: buildMERA(16), 32: buildMERA(32)}
+    loaded = []
+
+    def load(length):
+        loaded.append(length)
+        return flows[length]
+
+    xs = [torch.randint(0, 255, (1, 3, 16 * (1 + i % 2), 16 * (1 + i % 2))).float() for i in range(7)]
+
+    async def run(s):
+        cs = await asyncio.gather(*[s.compress(x) for x in xs])
+        # the requests of each size arriving together, in batches of maxBatch
+        assert s.metrics()['batches'] == 3
+        rcns = await asyncio.gather(*[s.decompress(container.Container.fromBytes(c.toBytes())) for c in cs])
+        try:
+            await s.decompress(mera.compress(flows[16], xs[0], b'87654321')[0])
+            assert False
+        except Exception as e:
+            assert "different model" in str(e)
+
+        # the same over HTTP
+        _server = await asyncio.start_server(s.handle, '127.0.0.1', 0)
+        port = _server.sockets[0].getsockname()[1]
+
+        async def request(method, path, body=b''):
+            reader, writer = await asyncio.open_connection('127.0.0.1', port)
+            writer.write((method + ' ' + path + ' HTTP/1.0\r\nContent-Length: ' + str(len(body)) + '\r\n\r\n').encode() + body)
+            status = (await reader.readline()).split()[1]
+            while (await reader.readline()).strip():
+                pass
+            out = await reader.read()
+            writer.close()
+            return int(status), out
+
+        status, data = await request('POST', '/compress', server.writeImage(xs[1]))
+        assert status == 200
+        status, png = await request('POST', '/decompress', data)
+        assert status == 200
+        assert_allclose(server.readImage(png).numpy(), xs[1].numpy())
+        assert (await request('POST', '/decompress', data[:-1]))[0] == 400
+        status, metrics = await request('GET', '/metrics')
+        _server.close()
+        return cs, rcns, json.loads(metrics)
+
+    with server.BatchingServer(load, b'12345678', maxBatch=3, deadline=0.05, workers=2, k=4) as s:
+        cs, rcns, metrics = asyncio.run(run(s))
+    for x, c, rcn in zip(xs, cs, rcns):
+        assert_allclose(rcn.numpy(), x.numpy())
+        assert_allclose(mera.decompress(flows[x.shape[-1]], c).numpy(), x.numpy())
+    assert sorted(set(loaded)) == sorted(loaded) == [16, 32]
+    # 4 + 3 images coded and decoded in batches of 3 + 1 and 3, and the 2 HTTP requests alone
+    assert metrics['batchSizes'] == {'1': 4, '3': 4}
+    assert metrics['queue'] == 0 and metrics['latency']['compress']['count'] == 8
+    assert metrics['latency']['decompress']['p50'] <= metrics['latency']['decompress']['p99']
+
+
+def test_cache():
+    f = buildMERA(16)
+    with tempfile.TemporaryDirectory() as folder:
+        x = torch.randint(0, 255, (4, 3, 16, 16)).float()
+        x[2] = x[0]
+
+        c = cache.ContainerCache(folder)
+        cs, keys = cache.compress(c, f, x, b'12345678', k=4)
+        assert keys[2] == keys[0] and len(set(keys)) == 3
+        assert c.misses == 3 and c.refs == 1 and len(c) == 3
+        for _x, _c in zip(x, cs):
+            assert_allclose(mera.decompress(f, _c).numpy(), _x.unsqueeze(0).numpy())
+        # other parameters, other keys
+        assert cache.compress(c, f, x[:1], b'12345678')[1][0] != keys[0]
+
+        # cached images skip the flow, and the cache is found again on disk
+        inverse = f.inverse
+        f.inverse = None
+        c = cache.ContainerCache(folder)
+        assert len(c) == 4
+        _cs, _keys = cache.compress(c, f, x[[1, 0, 2]], b'12345678', k=4)
+        assert _keys == [keys[1], keys[0], keys[2]] and c.hits == 2 and c.refs == 1
+        assert _cs[0].toBytes() == cs[1].toBytes()
+        f.inverse = inverse
+
+        # least recently used images evicted first
+        size = c.size // len(c)
+        c = cache.ContainerCache(folder, int(2.5 * size))
+        assert len(c) == 2 and keys[1] in c and keys[0] in c
+        cache.compress(c, f, x[3:], b'12345678', k=4)
+        assert len(c) == 2 and keys[3] in c and keys[0] in c and c.size <= 2.5 * size
+        assert not os.path.exists(c._path(keys[1]))
+
+        async def run(s):
+            cs = await asyncio.gather(*[s.compress(term.unsqueeze(0)) for term in x[[0, 1, 0]]])
+            assert s.cache.refs == 1
+            return cs, await s.compress(x[:1])
+
+        with server.BatchingServer(lambda length: f, b'12345678', k=4, cache=cache.ContainerCache(os.path.join(folder, 'server'))) as s:
+            # the cache's files are read and written off the event loop's thread
+            threads = []
+            for name in ['get', 'put']:
+                def call(*args, fn=getattr(s.cache, name)):
+                    threads.append(threading.current_thread())
+                    return fn(*args)
+                setattr(s.cache, name, call)
+            cs, c = asyncio.run(run(s))
+            assert s.cache.hits == 1 and s.metrics()['batchSizes'] == {'2': 1}
+            assert len(threads) == 5 and threading.main_thread() not in threads
+        assert cs[0].toBytes() == cs[2].toBytes() == c.toBytes()
+
+        # gets and puts from several threads keep the entries and the files in step
+        c = cache.ContainerCache(os.path.join(folder, 'threads'), int(2.5 * size))
+        def work(i):
+            for j in range(20):
+                key = keys[(i + j) % 4]
+                if c.get(key) is None:
+                    c.put(key, cs[(i + j) % 3])
+        workers = [threading.Thread(target=work, args=(i,)) for i in range(4)]
+        for term in workers:
+            term.start()
+        for term in workers:
+            term.join()
+        assert c.hits + c.misses == 80 and c.size == sum(c.entries.values()) <= 2.5 * size
+        assert sorted(c.entries) == sorted(cache.ContainerCache(c.folder).entries)
+
+
+def test_tansLevels():
+    f = buildMERA(16, meanNN=False)
+    with torch.no_grad():
+        for prior in f.prior.priorList:
+            prior.logscale.fill_(-4)
+    x = torch.randint(0, 255, (4, 3, 16, 16)).float()
+
+    # every level has a narrow static prior, so all go to tANS, some values escaped
+    containers = mera.compress(f, x, b'12345678', tableLog=12)
+    for i, c in enumerate(containers):
+        c = container.Container.fromBytes(c.toBytes())
+        assert c.tableLog == 12
+        assert c.words.shape[0] == 2
+        assert_allclose(mera.decompress(f, c).numpy(), x[i:i + 1].numpy())
+
+    with torch.no_grad():
+        parts = mera.divide(f, f.inverse(x.double())[0], 4096)
+    parts[-1][0, 0] = 5000
+    try:
+        mera.tansEncode(f, len(parts) - 1, parts[-1], 16, 4096, 12, tans.BitWriter(4))
+        assert False
+    except Exception as e:
+        assert "out of [0, 4096)" in str(e)
+
+
+def test_streamCDF():
+    f = buildMERA(16)
+    x = torch.randint(0, 255, (4, 3, 16, 16)).double()
+    with torch.no_grad():
+        z, _ = f.inverse(x)
+        parts = mera.divide(f, z, 4096)
+
+        for k in [None, 2]:
+            CDF = mera.calCDF(f, 4, 4096, 24, 16, k)
+            windows = mera.calWindows(f, 4, 4096, 16, k)
+            chunks = {}
+            for no, lo, _CDF in mera.streamCDF(f, 4, 4096, 24, 16, windows, 100):
+                assert _CDF.shape[-1] <= 100
+                chunks.setdefault(no, []).append(_CDF)
+            for no in range(len(CDF)):
+                assert_array_equal(np.concatenate(chunks[no], -1), CDF[no])
+
+            nbins = None if k is None else 4096
+            state = mera.encodeStream(mera.streamCDF(f, 4, 4096, 24, 16, windows, 100, reverse=True), parts, rans.BatchStack(4), 24, nbins)
+            _, rcnParts = mera.decodeStream(mera.streamCDF(f, 4, 4096, 24, 16, windows, 100), rans.BatchStack.unflatten(state.flatten()), 24, 8, nbins)
+            for part, rcnPart in zip(parts, rcnParts):
+                assert_array_equal(rcnPart, part)
+
+        # a chunk dropped by the consumer is freed before the next one is computed
+        detailCDF = mera.detailCDF
+        alive = []
+        mera.detailCDF = lambda *args: alive.append(ref() is not None) or detailCDF(*args)
+        try:
+            stream = mera.streamCDF(f, 4, 4096, 24, 16, None, 100, [0], params=mera.levelParams(f, 4, 16))
+            ref = lambda: None
+            _, _, _CDF = next(stream)
+            ref = weakref.ref(_CDF)
+            del _CDF
+            next(stream)
+        finally:
+            mera.detailCDF = detailCDF
+        assert alive == [False, False]
+
+
+def test_priorCache():
+    f = buildMERA(16, meanNN=False)
+    prior = f.prior.priorList[0]
+
+    calls = []
+    fn = lambda: calls.append(1) or len(calls)
+    assert mera.priorCache(f, prior, 'test', fn) == 1
+    assert mera.priorCache(f, prior, 'test', fn) == 1
+    with torch.no_grad():
+        prior.mean.add_(0.1)
+    assert mera.priorCache(f, prior, 'test', fn) == 2
+
+    # cached tables are the same as the ones computed from the expanded parameters
+    CDF = mera.calCDF(f, 2, 4096, 24, 16, 2)
+    assert CDF[0].dtype == np.uint32
+    mean, logscale = mera.detailPriorParams(f, 0, 2, 16)
+    assert_array_equal(CDF[0], mera.detailCDF(f, mean, logscale, 4096, 24, (CDF[0].shape[0] - 3) // 2))
+
+if __name__ == "__main__":
+    test_container()
+    test_compressDecompress()
+    test_decompressLevels()
+    test_decompressBatch()
+    test_progressive()
+    test_tiles()
+    test_scheduler()
+    test_shared()
+    test_divideJoin()
+    test_levelParams()
+    test_accounting()
+    test_pyramid()
+    test_lifting()
+    test_server()
+    test_cache()
+    test_streamCDF()
+    test_priorCache()
+    test_tansLevels()
@@ -0,0 +1,80 @@
+import os
+import sys
+sys.path.append(os.getcwd())
+
+import tempfile
+import numpy as np
+from numpy.testing import assert_array_equal
+from PIL import Image
+
+from encoder import manifest
+
+
+def test_walk():
+    with tempfile.TemporaryDirectory() as root:
+        os.makedirs(os.path.join(root, 'b', 'c'))
+        imgs = {'a.png': (16, 16), 'b/c/d.PNG': (32, 32), 'b/e.bmp': (16, 8), 'b/f.png': (12, 12)}
+        for path, shape in imgs.items():
+            Image.fromarray(np.random.randint(0, 255, shape + (3,), dtype=np.uint8)).save(os.path.join(root, path), format='PNG' if path.lower().endswith('png') else 'BMP')
+        with open(os.path.join(root, 'b', 'notes.txt'), 'w') as f:
+            f.write('not an image')
+
+        assert manifest.walk(root) == sorted(['a.png', os.path.join('b', 'c', 'd.PNG'), os.path.join('b', 'e.bmp'), os.path.join('b', 'f.png')])
+        assert manifest.outPath(os.path.join('b', 'c', 'd.PNG')) == os.path.join('b', 'c', 'd.PNG.nwf')
+
+        # images sharing a stem get files of their own
+        Image.fromarray(np.random.randint(0, 255, (16, 16, 3), dtype=np.uint8)).save(os.path.join(root, 'a.jpg'), format='JPEG')
+        paths = manifest.walk(root)
+        assert 'a.jpg' in paths and 'a.png' in paths
+        assert len(set(manifest.outPath(path) for path in paths)) == len(paths)
+        os.remove(os.path.join(root, 'a.jpg'))
+
+        img, reason = manifest.readImage(os.path.join(root, 'b', 'c', 'd.PNG'))
+        assert reason is None and img.shape == (32, 32, 3) and img.dtype == np.uint8
+        assert_array_equal(img, np.array(Image.open(os.path.join(root, 'b', 'c', 'd.PNG'))))
+        assert "square" in manifest.readImage(os.path.join(root, 'b', 'e.bmp'))[1]
+        assert "power of 2" in manifest.readImage(os.path.join(root, 'b', 'f.png'))[1]
+        assert manifest.readImage(os.path.join(root, 'b', 'notes.txt'))[0] is None
+
+
+def test_resume():
+    with tempfile.TemporaryDirectory() as folder:
+        path = os.path.join(folder, 'job', 'manifest.jsonl')
+        with manifest.Manifest(path) as job:
+            for i in range(3):
+                manifest.writeFile(os.path.join(folder, str(i) + '.nwf'), b'x' * (10 + i))
+                job.add({'path': str(i) + '.png', 'out': str(i) + '.nwf', 'size': 100, 'bytes': 10 + i, 'dims': 12})
+            assert all(job.done(str(i) + '.png', folder) for i in range(3))
+
+        # a crash while writing the last record, and a file lost
+        with open(path, 'rb') as f:
+            data = f.read()
+        with open(path, 'wb') as f:
+            f.write(data[:-10])
+        os.remove(os.path.join(folder, '0.nwf'))
+
+        with manifest.Manifest(path) as job:
+            assert len(job) == 2
+            assert [job.done(str(i) + '.png', folder) for i in range(3)] == [False, True, False]
+            job.add({'path': '2.png', 'out': '2.nwf', 'size': 100, 'bytes': 12, 'dims': 12})
+
+        with manifest.Manifest(path) as job:
+            assert len(job) == 3 and job.done('2.png', folder)
+            summary = job.summary(['1.png', '2.png'])
+            assert summary['count'] == 2 and summary['bytes'] == 23
+            assert np.isclose(summary['bpd'], 8 * 23 / 24)
+            assert np.isclose(summary['saving'], 1 - 23 / 200)
+            # a repeat of 1.png linked to its file
+            manifest.linkFile(os.path.join(folder, '1.nwf'), os.path.join(folder, 'sub', '3.nwf'))
+            job.add({'path': 'sub/3.png', 'out': 'sub/3.nwf', 'size': 100, 'bytes': 11, 'dims': 12, 'ref': '1.png'})
+            assert job.done('sub/3.png', folder)
+            assert os.path.samefile(os.path.join(folder, '1.nwf'), os.path.join(folder, 'sub', '3.nwf'))
+            summary = job.summary(['1.png', '2.png', 'sub/3.png'])
+            assert summary['refs'] == 1 and summary['bytes'] == 34 and summary['stored'] == 23
+            assert np.isclose(summary['saving'], 1 - 23 / 300)
+        assert not os.path.exists(os.path.join(folder, '2.nwf.tmp'))
+
+
+if __name__ == "__main__":
+    test_walk()
+    test_resume()
@@ -0,0 +1,78 @@
+import os
+import sys
+sys.path.append(os.getcwd())
+
+import time
+import threading
+
+from encoder import pipeline
+
+
+def test_pipeline():
+    for maxsize in [0, 1, 3]:
+        stages = pipeline.Pipeline([('add', lambda x: x + 1), ('double', lambda x: 2 * x)], maxsize)
+        assert list(stages.run(range(20))) == [2 * (x + 1) for x in range(20)]
+        assert set(stages.times) == {'load', 'add', 'double'}
+
+
+def test_overlap():
+    # two stages sleeping 0.05s on 8 items overlap to about 9 * 0.05s
+    stages = pipeline.Pipeline([('a', lambda x: time.sleep(0.05) or x), ('b', lambda x: time.sleep(0.05) or x)], 2)
+    assert list(stages.run(range(8))) == list(range(8))
+    assert stages.wall < 0.75
+    assert stages.times['a'] >= 0.4 and stages.times['b'] >= 0.4
+
+
+def test_backpressure():
+    alive = []
+    lock = threading.Lock()
+
+    def start(x):
+        with lock:
+            alive.append(x)
+        return x
+
+    def slow(x):
+        time.sleep(0.01)
+        return x
+
+    def end(x):
+        with lock:
+            alive.remove(x)
+            # in queues or stages, never much more than maxsize items per stage
+            assert len(alive) <= 2 * 2 + 2
+        return x
+
+    stages = pipeline.Pipeline([('start', start), ('slow', slow), ('end', end)], 2)
+    assert list(stages.run(range(50))) == list(range(50))
+
+
+def test_error():
+    def fail(x):
+        if x == 5:
+            raise Exception("failed at 5")
+        return x
+
+    for maxsize in [0, 2]:
+        out = []
+        try:
+            for x in pipeline.Pipeline([('fail', fail), ('id', lambda x: x)], maxsize).run(range(100)):
+                out.append(x)
+            assert False
+        except Exception as e:
+            assert "failed at 5" in str(e)
+        assert out == list(range(len(out))) and len(out) <= 5
+
+    # stopping early stops the threads
+    before = threading.active_count()
+    for x in pipeline.Pipeline([('id', lambda x: x)], 1).run(range(100)):
+        if x == 3:
+            break
+    assert threading.active_count() == before
+
+
+if __name__ == "__main__":
+    test_pipeline()
+    test_overlap()
+    test_backpressure()
+    test_error()
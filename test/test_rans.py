@@ -10,12 +10,20 @@ sys.path.append('../')
 import os
 sys.path.append(os.getcwd())
 
-from encoder import rans, coder
+from encoder import rans, coder, executor, tans
 
 
 precision = 24
 #torch.manual_seed(42)
 
+
+def randomCDF(nBins, *shape):
+    # integer CDFs of random peaked distributions, every bin with non-zero freq
+    prob = np.random.rand(nBins - 1, *shape) ** 4 + 1e-3
+    prob = prob / prob.sum(0)
+    cdf = np.concatenate([np.zeros([1, *shape]), np.cumsum(prob, 0)], 0)
+    return (cdf * ((1 << precision) - nBins)).astype(np.int64) + np.arange(nBins).reshape(-1, *[1] * len(shape))
+
 def test_encodeDecode():
     #encode/decoder a MNIST image using its own distribution
 
@@ -144,5 +152,219 @@ def test_encodeDecode_otherDistr():
 '''
 
 
+def test_batchEncodeDecode():
+    nBins = 64
+    batchSize = 6
+    length = 500
+    CDFs = randomCDF(nBins, batchSize, length)
+    symbols = np.random.randint(0, nBins - 1, [batchSize, length])
+
+    state = rans.BatchStack(batchSize, capacity=8)
+    for j in reversed(range(length)):
+        state = coder.batchEncoder(CDFs[:, :, j], symbols[:, j], state, precision)
+    states = state.flatten()
+
+    # same bitstream as coding every image on its own
+    for i in range(batchSize):
+        state = rans.x_init
+        for j in reversed(range(length)):
+            state = coder.encoder(CDFs[:, i, j], symbols[i, j], state, precision)
+        assert_array_equal(rans.flatten(state), states[i])
+
+    state = rans.BatchStack.unflatten(states)
+    reconstruction = []
+    for j in range(length):
+        state, recon_symbol = coder.batchDecoder(CDFs[:, :, j], state, precision)
+        reconstruction.append(recon_symbol)
+
+    assert_array_equal(symbols, np.stack(reconstruction, 1))
+    assert np.all(state.count == 0)
+
+
+def test_arrayStack():
+    nBins = 64
+    length = 2000
+    CDF = randomCDF(nBins, length).astype(np.int32)
+    symbols = np.random.randint(0, nBins - 1, [length])
+
+    state = rans.x_init
+    stack = rans.Stack(capacity=4)
+    for j in reversed(range(length)):
+        state = coder.encoder(CDF[:, j], symbols[j], state)
+        stack = coder.encoder(CDF[:, j], symbols[j], stack)
+    arr = rans.flatten(stack)
+    assert_array_equal(rans.flatten(state), arr)
+    assert np.shares_memory(arr, stack.buf)
+    _arr = arr.copy()
+
+    stack = rans.Stack.unflatten(arr)
+    assert np.shares_memory(arr, stack.buf)
+    reconstruction = []
+    for j in range(length):
+        stack, recon_symbol = coder.decoder(CDF[:, j], stack)
+        reconstruction.append(recon_symbol)
+    assert_array_equal(symbols, np.array(reconstruction))
+
+    # coding on the decoded stack must not write into the borrowed array
+    for j in reversed(range(length)):
+        stack = coder.encoder(CDF[:, j], symbols[j], stack)
+    assert_array_equal(_arr, arr)
+    assert_array_equal(_arr, rans.flatten(stack))
+
+
+def test_lookupTable():
+    nBins = 1024
+    batchSize = 4
+    length = 300
+    CDFs = randomCDF(nBins, batchSize, length)
+    symbols = np.random.randint(0, nBins - 1, [batchSize, length])
+
+    state = rans.BatchStack(batchSize)
+    for j in reversed(range(length)):
+        state = coder.batchEncoder(CDFs[:, :, j], symbols[:, j], state, precision)
+    states = state.flatten()
+
+    for bits in [4, 8, 12]:
+        table = coder.buildTable(CDFs, precision, bits, chunk=100)
+        assert table.shape == (2 ** bits + 1, batchSize, length)
+
+        state = rans.BatchStack.unflatten(states)
+        reconstruction = []
+        for j in range(length):
+            state, recon_symbol = coder.batchDecoder(CDFs[:, :, j], state, precision, table=table[:, :, j])
+            reconstruction.append(recon_symbol)
+        assert_array_equal(symbols, np.stack(reconstruction, 1))
+
+    state = rans.unflatten(states[0])
+    for j in range(length):
+        state, recon_symbol = coder.decoder(CDFs[:, 0, j], state, table=table[:, 0, j])
+        assert recon_symbol == symbols[0, j]
+
+
+def test_interleaved():
+    nBins = 64
+    batchSize = 3
+    length = 1001
+    nstates = 4
+    CDFs = randomCDF(nBins, batchSize, length)
+    symbols = np.random.randint(0, nBins - 1, [batchSize, length])
+
+    states = coder.interleavedEncoder(CDFs, symbols, nstates, precision)
+    assert len(states) == batchSize
+
+    # every state codes its own share of the symbols independently
+    lanes = rans.deinterleave(states[1])
+    assert len(lanes) == nstates
+    for k in range(nstates):
+        state = rans.x_init
+        for j in reversed(range(k, length, nstates)):
+            state = coder.encoder(CDFs[:, 1, j], symbols[1, j], state, precision)
+        assert_array_equal(rans.flatten(state), lanes[k])
+
+    assert_array_equal(symbols, coder.interleavedDecoder(CDFs, states, precision))
+    assert_array_equal(symbols, coder.interleavedDecoder(CDFs, states, precision, table=coder.buildTable(CDFs, precision)))
+
+
+def test_codingExecutor():
+    nBins = 64
+    batchSize = 7
+    length = 300
+    CDFs = randomCDF(nBins, batchSize, length).astype(np.int32)
+    symbols = np.random.randint(0, nBins - 1, [batchSize, length])
+
+    state = rans.BatchStack(batchSize)
+    for j in reversed(range(length)):
+        state = coder.batchEncoder(CDFs[:, :, j], symbols[:, j], state, precision)
+    states = state.flatten()
+
+    with executor.CodingExecutor(2, precision, chunk=3) as pool:
+        _states, reconstruction = pool.run(CDFs, symbols)
+        for term, _term in zip(states, _states):
+            assert_array_equal(term, _term)
+        assert_array_equal(symbols, reconstruction)
+        assert_array_equal(symbols, pool.decode(CDFs, states))
+
+    with executor.CodingExecutor(2, precision, nstates=4) as pool:
+        _states = pool.encode(CDFs, symbols)
+        assert_array_equal(symbols, coder.interleavedDecoder(CDFs, _states, precision))
+
+
+def test_escapeCoder():
+    batchSize = 20
+    length = 50
+    nbins = 4096
+    window = 8
+
+    CDF = randomCDF(2 * window + 3, batchSize, length)
+    # mostly inside the window, some far out of it
+    symbols = np.random.randint(nbins // 2 - window, nbins // 2 + window + 1, [batchSize, length])
+    outside = np.random.rand(batchSize, length) < 0.1
+    symbols[outside] = np.random.randint(0, nbins, outside.sum())
+
+    s = rans.BatchStack(batchSize)
+    for j in reversed(range(length)):
+        s = coder.escapeEncoder(CDF[:, :, j], symbols[:, j], s, precision, nbins)
+    states = s.flatten()
+
+    table = coder.buildTable(CDF, precision, 4)
+    s = rans.BatchStack.unflatten(states)
+    rcnSymbols = []
+    for j in range(length):
+        s, symbol = coder.escapeDecoder(CDF[:, :, j], s, precision, nbins, table=table[:, :, j])
+        rcnSymbols.append(symbol)
+    assert_array_equal(np.stack(rcnSymbols, 1), symbols)
+
+    # values out of [0, nbins) don't fit the raw bits
+    for value in [-3, nbins, 6144]:
+        symbols[3, 7] = value
+        try:
+            coder.escapeEncoder(CDF[:, :, 7], symbols[:, 7], rans.BatchStack(batchSize), precision, nbins)
+            assert False
+        except Exception as e:
+            assert "out of [0, 4096)" in str(e)
+
+
+def test_tans():
+    tableLog = 10
+    nDists = 5
+    nSymbols = 40
+    batchSize = 7
+    length = 3000
+
+    CDF = randomCDF(nSymbols + 1, nDists)
+    # quantize to 1 << tableLog, every symbol keeping a state
+    freq = np.diff(CDF, axis=0).T / (1 << precision) * ((1 << tableLog) - nSymbols)
+    freq = np.floor(freq).astype(np.int64) + 1
+    freq[:, 0] += (1 << tableLog) - freq.sum(1)
+    table = tans.Table(freq, tableLog)
+
+    dists = np.random.randint(0, nDists, length)
+    symbols = np.stack([(np.random.rand(length, 1) > np.cumsum(freq[dists], 1) / (1 << tableLog)).sum(1) for _ in range(batchSize)])
+    raw = np.random.randint(0, 4096, [batchSize, length])
+
+    writer = tans.BitWriter(batchSize)
+    tans.encode(table, dists, symbols, writer, raw=raw, rawBits=12)
+    tans.encode(table, dists[:20], symbols[:, :20], writer)
+    streams = writer.flatten()
+
+    reader = tans.BitReader(streams)
+    rcnSymbols, rcnRaw = tans.decode(table, dists, length, reader, rawBits=12)
+    assert_array_equal(rcnSymbols, symbols)
+    escaped = symbols == nSymbols - 1
+    assert_array_equal(rcnRaw[escaped], raw[escaped])
+    rcnSymbols, _ = tans.decode(table, dists[:20], 20, reader)
+    assert_array_equal(rcnSymbols, symbols[:, :20])
+
+    entropy = -np.log2(freq[dists, symbols[0]] / (1 << tableLog)).sum() + 12 * escaped[0].sum()
+    assert 8 * streams[0].shape[0] < 1.05 * entropy
+
+
 if __name__ == "__main__":
-    test_encodeDecode()
\ No newline at end of file
+    test_encodeDecode()
+    test_batchEncodeDecode()
+    test_arrayStack()
+    test_lookupTable()
+    test_interleaved()
+    test_codingExecutor()
+    test_escapeCoder()
+    test_tans()
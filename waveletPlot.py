@@ -8,7 +8,7 @@ import flow, utils, source
 import torch, torchvision
 from torch import nn
 
-from encoder import rans, coder
+from encoder import rans, coder, container, pyramid
 from utils import cdfDiscreteLogitstic, cdfMixDiscreteLogistic
 from matplotlib import pyplot as plt
 import matplotlib
@@ -22,10 +22,12 @@ parser.add_argument("-depth", type=int, default=2, help="how many iterations to
 parser.add_argument("-best", action='store_false', help="if load the best model")
 parser.add_argument("-epoch", type=int, default=-1, help="epoch to load")
 parser.add_argument("-img", default=None, help="the img path")
+parser.add_argument("-pyramid", default=None, help="Pyramid store (see pyramid.py) to read the levels from instead of -img")
+parser.add_argument("-index", type=int, default=0, help="index of the image in the pyramid store")
 
 args = parser.parse_args()
 
-if args.img is None:
+if args.img is None and args.pyramid is None:
     raise Exception("No image input")
 
 device = torch.device("cpu" if args.cuda < 0 else "cuda:" + str(args.cuda))
@@ -52,12 +54,13 @@ else:
         except:
             HUE = True
 
-IMG = Image.open(args.img)
-IMG = torch.from_numpy(np.array(IMG)).permute([2, 0, 1])
-IMG = IMG.reshape(1, *IMG.shape).float().to(device)
+if args.pyramid is None:
+    IMG = Image.open(args.img)
+    IMG = torch.from_numpy(np.array(IMG)).permute([2, 0, 1])
+    IMG = IMG.reshape(1, *IMG.shape).float().to(device)
 
-if not HUE:
-    IMG = utils.rgb2ycc(IMG, True, True)
+    if not HUE:
+        IMG = utils.rgb2ycc(IMG, True, True)
 
 # decide which model to load
 if args.best:
@@ -80,8 +83,20 @@ elif '1to2Mera' in name:
 else:
     raise Exception("model not define")
 
+if args.pyramid is not None:
+    store = pyramid.Pyramid(args.pyramid)
+    if store.fingerprint != container.fingerprint(name):
+        raise Exception("Pyramid store was built with a different model")
+    if store.HUE != HUE:
+        raise Exception("Pyramid store and model disagree on HUE")
+    if not 0 <= args.index < len(store):
+        raise Exception("No image " + str(args.index) + " in pyramid store of " + str(len(store)))
+
 # Define dimensions
-targetSize = IMG.shape[1:]
+if args.pyramid is None:
+    targetSize = IMG.shape[1:]
+else:
+    targetSize = [3, store.length, store.length]
 dimensional = 2
 channel = targetSize[0]
 blockLength = targetSize[-1]
@@ -96,28 +111,29 @@ else:
 
 rounding = utils.roundingWidentityGradient
 
-# Building MERA mode
-if 'easyMera' in name:
-    fList = []
-    for _depth in reversed(range(args.depth)):
-        f = flow.SimpleMERA(blockLength, layerList, None, None, repeat, _depth + 1, nMixing, decimal=decimal, rounding=utils.roundingWidentityGradient).to(device)
-        fList.append(f)
-elif '1to2Mera' in name:
-    fList = []
-    for _depth in reversed(range(args.depth)):
-        f = flow.OneToTwoMERA(blockLength, layerList, None, None, repeat, _depth + 1, nMixing, decimal=decimal, rounding=utils.roundingWidentityGradient).to(device)
-        fList.append(f)
-else:
-    raise Exception("model not define")
+assert args.depth <= int(math.log(blockLength, 2))
 
-zList = []
-for _f in fList:
-    z, _ = _f.inverse(IMG)
-    zList.append(z)
+# Building MERA mode, the levels are read from the store instead with -pyramid
+if args.pyramid is None:
+    if 'easyMera' in name:
+        fList = []
+        for _depth in reversed(range(args.depth)):
+            f = flow.SimpleMERA(blockLength, layerList, None, None, repeat, _depth + 1, nMixing, decimal=decimal, rounding=utils.roundingWidentityGradient).to(device)
+            fList.append(f)
+    elif '1to2Mera' in name:
+        fList = []
+        for _depth in reversed(range(args.depth)):
+            f = flow.OneToTwoMERA(blockLength, layerList, None, None, repeat, _depth + 1, nMixing, decimal=decimal, rounding=utils.roundingWidentityGradient).to(device)
+            fList.append(f)
+    else:
+        raise Exception("model not define")
 
-z = torch.cat(zList, 0)
+    zList = []
+    for _f in fList:
+        z, _ = _f.inverse(IMG)
+        zList.append(z)
 
-assert args.depth <= int(math.log(blockLength, 2))
+    z = torch.cat(zList, 0)
 
 
 def im2grp(t):
@@ -168,25 +184,38 @@ def batchNorm(tensor, base=1.0):
 #renormFn = lambda x: grayWorld(back01(x))
 renormFn = lambda x: back01(x)
 
+# details of every level and the coarse image they are split from, of the image
+if args.pyramid is None:
+    ul = z
+    details = []
+    coarse = []
+    for _depth in reversed(range(args.depth)):
+        _x = im2grp(ul)
+        ul = _x[:, :, :, 0].reshape(*_x.shape[:2], int(_x.shape[2] ** 0.5), int(_x.shape[2] ** 0.5)).contiguous()
+        details.append(_x[:1, :, :, 1:])
+        coarse.append(ul[_depth].reshape(1, *ul.shape[1:]))
+    ul = ul[:1]
+else:
+    images = dict(store.images(loadedF, [args.index], 1))
+    coarse = [images[no] for no in range(1, args.depth + 1)]
+    details = [torch.from_numpy(np.array(store.details(no, [args.index]))).to(images[no + 1]) for no in range(args.depth)]
+    ul = coarse[-1]
+
 # collect parts
-ul = z
 UR = []
 DL = []
 DR = []
-for _depth in reversed(range(args.depth)):
-    _x = im2grp(ul)
-
-    ul = _x[:, :, :, 0].reshape(*_x.shape[:2], int(_x.shape[2] ** 0.5), int(_x.shape[2] ** 0.5)).contiguous()
-    _ul = ul[_depth].reshape(1, *ul.shape[1:])
+for no in range(args.depth):
+    _ul = coarse[no]
     if loadedF.meanNNlist is not None:
         zeroDetails = torch.round(decimal.forward_(reform(loadedF.meanNNlist[0](decimal.inverse_(_ul))).contiguous()))
     else:
-        zeroDetails = torch.round(decimal.forward_(loadedF.prior.priorList[0].mean.reshape(1, 3, 1, 3).repeat(1, 1, np.prod(ul.shape[-2:]), 1)).contiguous())
+        zeroDetails = torch.round(decimal.forward_(loadedF.prior.priorList[0].mean.reshape(1, 3, 1, 3).repeat(1, 1, np.prod(_ul.shape[-2:]), 1)).contiguous())
 
-    _x[:1, :, :, 1:] = _x[:1, :, :, 1:] - zeroDetails
-    ur = _x[:, :, :, 1].reshape(*_x.shape[:2], int(_x.shape[2] ** 0.5), int(_x.shape[2] ** 0.5)).contiguous()
-    dl = _x[:, :, :, 2].reshape(*_x.shape[:2], int(_x.shape[2] ** 0.5), int(_x.shape[2] ** 0.5)).contiguous()
-    dr = _x[:, :, :, 3].reshape(*_x.shape[:2], int(_x.shape[2] ** 0.5), int(_x.shape[2] ** 0.5)).contiguous()
+    _x = details[no] - zeroDetails
+    ur = _x[:, :, :, 0].reshape(*_ul.shape).contiguous()
+    dl = _x[:, :, :, 1].reshape(*_ul.shape).contiguous()
+    dr = _x[:, :, :, 2].reshape(*_ul.shape).contiguous()
     UR.append(renormFn(ur))
     DL.append(renormFn(dl))
     DR.append(renormFn(dr))